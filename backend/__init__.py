@@ -1 +1 @@
-from .__version__ import __version__
+from .sscAnnotat3D.__version__ import __version__
@@ -0,0 +1,185 @@
+"""
+This script contains the annotation file format used by /save_annot and /open_annot.
+
+Only the annotated slices are stored, each one as a compressed int16 plane keyed by (axis, slice):
+
+    - magic b"A3DANNOT" and the format version (little-endian uint16)
+    - the size of a json header (little-endian uint32) and the json header, with the volume shape, the codec, the
+      label names of the frontend and, for each plane, its axis, slice, offset (from the end of the header) and length
+    - the compressed planes
+
+Planes are compressed with zstandard when the package is installed, with zlib otherwise. Files saved before this
+format (a pickle of the annotation coordinates, or the older dict of coordinates) are still loaded by load().
+"""
+
+import json
+import pickle
+import struct
+import zlib
+
+import numpy as np
+from sscAnnotat3D.modules.sparse_annotation import plane_index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"A3DANNOT"
+FORMAT_VERSION = 1
+
+_header_struct = struct.Struct("<8sHI")
+
+
+def _compress(plane: np.ndarray, codec: str) -> bytes:
+    buffer = np.ascontiguousarray(plane, dtype="<i2")
+
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(buffer)
+
+    return zlib.compress(buffer, 6)
+
+
+def _decompress(payload: bytes, codec: str) -> np.ndarray:
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("This annotation was saved with zstd, install the zstandard package to open it")
+        buffer = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == "zlib":
+        buffer = zlib.decompress(payload)
+    else:
+        raise ValueError("Unknown annotation codec {}".format(codec))
+
+    return np.frombuffer(buffer, dtype="<i2")
+
+
+def is_annotation_file(path: str) -> bool:
+    """
+    Function that checks if a file is in this format, and not a legacy pickle
+
+    Args:
+        path (str): path of the annotation file
+
+    Returns:
+        (bool): True if the file starts with the magic
+
+    """
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save(path: str, annotation_image: np.ndarray, annotation_slice_dict: dict, label_names: list):
+    """
+    Function that saves the annotated slices of an annotation volume
+
+    Args:
+        path (str): output path
+        annotation_image (np.ndarray): the annotation volume (int16, -1 where there is no annotation)
+        annotation_slice_dict (dict): axis -> set of annotated slices, see AnnotationModule.annotation_slice_dict
+        label_names (list): label names sent by the frontend, returned as is by load()
+
+    Returns:
+        None
+
+    """
+    codec = "zstd" if zstandard is not None else "zlib"
+    planes = []
+    payloads = []
+    offset = 0
+
+    for axis, slice_nums in sorted(annotation_slice_dict.items()):
+        for slice_num in sorted(slice_nums):
+            payload = _compress(annotation_image[plane_index(int(axis), int(slice_num))], codec)
+            planes.append({"axis": int(axis), "slice": int(slice_num), "offset": offset, "length": len(payload)})
+            payloads.append(payload)
+            offset += len(payload)
+
+    header = {"shape": list(annotation_image.shape), "codec": codec, "labels": label_names, "planes": planes}
+    header = json.dumps(header).encode("utf-8")
+
+    with open(path, "wb") as f:
+        f.write(_header_struct.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for payload in payloads:
+            f.write(payload)
+
+
+def load(path: str, annot_module):
+    """
+    Function that loads an annotation file into an annotation module
+
+    Notes:
+        Planes are decoded straight into the annotation volume of the module. Legacy pickle files are loaded through
+        the coordinates (list format) or the dict of coordinates (oldest format).
+
+    Args:
+        path (str): path of the annotation file
+        annot_module (AnnotationModule): module whose annotation volume receives the annotation
+
+    Returns:
+        (list): the label names saved with the annotation
+
+    """
+    if not is_annotation_file(path):
+        return _load_legacy(path, annot_module)
+
+    with open(path, "rb") as f:
+        magic, version, header_size = _header_struct.unpack(f.read(_header_struct.size))
+
+        if version > FORMAT_VERSION:
+            raise ValueError("Unsupported annotation format version {}".format(version))
+
+        header = json.loads(f.read(header_size).decode("utf-8"))
+        data = f.read()
+
+    annotation_image = annot_module.annotation_image
+
+    if tuple(header["shape"]) != tuple(annotation_image.shape):
+        raise ValueError(
+            "Annotation shape {} doesn't match the image shape {}".format(tuple(header["shape"]), annotation_image.shape)
+        )
+
+    annotation_slice_dict = {0: set(), 1: set(), 2: set()}
+
+    for plane in header["planes"]:
+        plane_shape = [s for i, s in enumerate(annotation_image.shape) if i != plane["axis"]]
+        payload = data[plane["offset"] : plane["offset"] + plane["length"]]
+        annotation_image[plane_index(plane["axis"], plane["slice"])] = _decompress(payload, header["codec"]).reshape(plane_shape)
+        annotation_slice_dict[plane["axis"]].add(plane["slice"])
+
+    annot_module.touch()
+    annot_module.set_annotation_slice_dict(annotation_slice_dict)
+
+    return header["labels"]
+
+
+def _load_legacy(path: str, annot_module):
+    with open(path, "rb") as f:
+        annot_data = pickle.load(f)
+
+    if type(annot_data) == list:
+        label_names, annotation_coords, annotation_labels, annotation_slice_dict = annot_data
+        # the annotated slices first, so the coordinates are written on their planes
+        annot_module.set_annotation_slice_dict(annotation_slice_dict)
+        annot_module.set_annotation_from_coords(annotation_coords, annotation_labels)
+        return label_names
+
+    # compatibility with old annotations, a dict of coordinates
+    print("Old annotation stye, reading dictionary")
+    annot_module.set_annotation_from_dict(annot_data)
+    label_names = []
+    annotation = set()
+    for label in annot_data.values():
+        label = label[0]
+        if label not in annotation:
+            annotation.add(label)
+            label_names.append(
+                {
+                    "labelName": "Label {}".format(label) if label > 0 else "Background",
+                    "id": label,
+                    "color": [],
+                    "alpha": 1,
+                }
+            )
+
+    return label_names
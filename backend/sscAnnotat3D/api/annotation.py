@@ -3,19 +3,16 @@ default_n_threads = 32
 os.environ['OPENBLAS_NUM_THREADS'] = f"{default_n_threads}"
 os.environ['MKL_NUM_THREADS'] = f"{default_n_threads}"
 os.environ['OMP_NUM_THREADS'] = f"{default_n_threads}"
-import io
-import pickle
-import zlib
 
 import numpy as np
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
-from sscAnnotat3D import utils
+from sscAnnotat3D import annotation_file, jobs, prefetch, slice_encoding, slice_payload, utils
 from sscAnnotat3D.label import label_slice_contour
 from sscAnnotat3D.modules.magic_wand import MagicWandSelector
 from sscAnnotat3D.modules.lasso import fill_lasso
 from sscAnnotat3D.modules import annotation_module
-from sscAnnotat3D.repository import data_repo, module_repo
+from sscAnnotat3D.repository import data_repo, module_repo, slice_cache
 from werkzeug.exceptions import BadRequest
 #from harpia import morph_2D_chan_vese, morph_2D_geodesic_active_contour
 from harpia.segmentation import morphological_chan_vese,morphological_geodesic_active_contour
@@ -135,32 +132,12 @@ def open_annot():
     except:
         return handle_exception("Error while trying to get the annotation path")
 
-    with open(annot_path, "rb") as f:
-        annot_data = pickle.load(f)
-    
-    
     annot_module = annotation_module.AnnotationModule(img.shape)
-    #compatibility with old annotated
-    if type(annot_data) != list:
-        print('Old annotation stye, reading dictionary')
-        annot_module.set_annotation_from_dict(annot_data)
-        label_names = []
-        annotation = set()
-        for label in annot_data.values():
-            label = label[0]
-            if (label not in annotation):
-                annotation.add(label)
-                label_names.append({
-                    "labelName": "Label {}".format(label) if label > 0 else "Background",
-                    "id": label,
-                    "color": [],
-                    "alpha": 1
-                })
 
-    else:
-        label_names, annotation_coords, annotation_labels, annotation_slice_dict = annot_data
-        annot_img = annot_module.set_annotation_from_coords(annotation_coords, annotation_labels)
-        annot_module.set_annotation_slice_dict(annotation_slice_dict)
+    try:
+        label_names = annotation_file.load(annot_path, annot_module)
+    except Exception as e:
+        return handle_exception(f"Unable to open the annotation: {str(e)}")
 
     module_repo.set_module('annotation', module=annot_module)
 
@@ -208,7 +185,7 @@ def close_annot():
 @cross_origin()
 def save_annot():
     """
-    Function that saves the annotation as .pickle
+    Function that saves the annotation, only the annotated slices are stored (see sscAnnotat3D.annotation_file)
 
     Returns:
         (str): returns "success" if everything goes well and an error otherwise
@@ -217,10 +194,7 @@ def save_annot():
 
     annot_module = module_repo.get_module('annotation')
 
-    annotation_coords, annotation_labels = annot_module.get_annotation_coords()
-    annotation_slice_dict = annot_module.get_annotation_slice_dict()
-
-    if len(annotation_coords) == 0:
+    if annot_module is None:
         return handle_exception("Failed to fetch annotation")
     try:
         annot_path  = request.json["annot_path"]
@@ -228,10 +202,12 @@ def save_annot():
     except:
         return handle_exception("Failed to receive annotation path")
 
-    annot_data = [label_names, annotation_coords, annotation_labels, annotation_slice_dict]
-
-    with open(annot_path, "wb") as f:
-        pickle.dump(annot_data, f)
+    try:
+        annotation_file.save(
+            annot_path, annot_module.annotation_image, annot_module.annotation_slice_dict, label_names
+        )
+    except Exception as e:
+        return handle_exception(f"Unable to save the annotation: {str(e)}")
 
     return "success", 200
 
@@ -260,9 +236,13 @@ def draw():
     marker_id = annot_module.current_mk_id
 
     erase = (mode == 'erase_brush')
-    
+
+
     annot_module.draw_marker_curve(cursor_coords, marker_id, label, erase)
 
+    if request.json.get("delta", False):
+        return jsonify({"delta": slice_payload.annotation_delta(annot_module, axis, slice_num)})
+
     return "success", 200
 
 
@@ -278,16 +258,25 @@ def get_annot_slice():
     """
     slice_num = request.json["slice"]
     axis = request.json["axis"]
-    slice_range = utils.get_3d_slice_range_from(axis, slice_num)
 
-    annot_module = module_repo.get_module('annotation')
+    encoding = slice_encoding.negotiate(request)
 
-    if (annot_module != None):
-        img_slice = annot_module.annotation_image[slice_range]
+    try:
+        level = int(request.json.get("level", 0))
+        roi = utils.parse_roi(request.json.get("roi", None))
+        img_slice = slice_payload.annotation_slice(axis, slice_num, encoding=encoding, level=level, roi=roi)
+    except ValueError as e:
+        return handle_exception(str(e))
 
-        img_slice = zlib.compress(utils.toNpyBytes(img_slice))
+    if (img_slice is not None):
+        annot_module = module_repo.get_module('annotation')
+        if (annot_module != None):
+            shape = (annot_module.zsize, annot_module.ysize, annot_module.xsize)
+            prefetch.schedule(
+                'annotation', axis, slice_num, shape[utils.get_axis_num(axis)], encoding=encoding, level=level, roi=roi
+            )
 
-        return send_file(io.BytesIO(img_slice), "application/gzip")
+        return img_slice.to_response()
 
     return "test", "application/gzip"
 
@@ -309,6 +298,23 @@ def undo_annot():
     return jsonify(label_returned)
 
 
+@app.route("/redo_annot", methods=['POST'])
+@cross_origin()
+def redo_annot():
+    """
+    Function that redoes the last annotation reverted by /undo_annot
+
+    Returns:
+        (int): the label removed again (when the edit redone is a label deletion), -1 otherwise
+
+    """
+    annot_module = module_repo.get_module('annotation')
+    #when the edit redone is a label deletion we need to tell frontend to remove this label again
+    _, label_removed = annot_module.redo()
+
+    return jsonify(label_removed)
+
+
 @app.route("/delete_label_annot", methods=["POST"])
 @cross_origin()
 def delete_label_annot():
@@ -425,7 +431,7 @@ def apply_magicwand(input_id: str):
     annot_module.set_current_axis(axis_dim)
     annot_module.set_current_slice(slice_num)
 
-    img_slice = data_repo.get_image(input_id)[slice_range]
+    img_slice = data_repo.get_image(input_id, lazy=True)[slice_range]
  
     if new_click:
         upper_tolerance = python_typer((8 * (max_contrast - min_contrast)) / 100)
@@ -441,8 +447,17 @@ def apply_magicwand(input_id: str):
     #Marker id is not necessary for the magic wand logic.
     mk_id = annot_module.current_mk_id
 
+
     annot_module.labelmask_update(mask_wand > 0, label, mk_id, new_click)
 
+    if request.json.get("delta", False):
+        return jsonify(
+            {
+                "value": python_typer(img_slice[y_coord, x_coord]),
+                "delta": slice_payload.annotation_delta(annot_module, axis, slice_num),
+            }
+        )
+
     return jsonify(python_typer(img_slice[y_coord, x_coord]))
 
 @app.route("/threshold/<input_id>", methods=["POST"])
@@ -481,14 +496,22 @@ def threshold(input_id: str):
     annot_module.set_current_axis(axis_dim)
     annot_module.set_current_slice(slice_num)
 
-    img_slice = data_repo.get_image(input_id)[slice_range]
+    img_slice = data_repo.get_image(input_id, lazy=True)[slice_range]
  
     mk_id = annot_module.current_mk_id
 
     label_mask = np.logical_and(img_slice >= lower_tresh, img_slice <= upper_tresh) 
 
+
     annot_module.labelmask_update(label_mask, label, mk_id, new_click)
 
+    if request.json.get("delta", False):
+        return jsonify(
+            {
+                "current_mk_id": annot_module.current_mk_id,
+                "delta": slice_payload.annotation_delta(annot_module, axis, slice_num),
+            }
+        )
 
     return jsonify(annot_module.current_mk_id)
 
@@ -583,7 +606,7 @@ def apply_lasso(input_id: str):
     annot_module.set_current_axis(axis_dim)
     annot_module.set_current_slice(slice_num)
     slice_range = utils.get_3d_slice_range_from(axis, slice_num)
-    img_slice = data_repo.get_image('image')[slice_range]
+    img_slice = data_repo.get_image('image', lazy=True)[slice_range]
  
     mk_id = annot_module.current_mk_id
 
@@ -593,8 +616,17 @@ def apply_lasso(input_id: str):
     
     label_mask = fill_lasso(width, height, points)
 
+
     annot_module.labelmask_update(label_mask, label, mk_id, new_click=True)
 
+    if request.json.get("delta", False):
+        return jsonify(
+            {
+                "current_mk_id": annot_module.current_mk_id,
+                "delta": slice_payload.annotation_delta(annot_module, axis, slice_num),
+            }
+        )
+
     return jsonify(annot_module.current_mk_id)
 
 @app.route("/active_contour/<input_id>/<mode_id>", methods=["POST"])
@@ -648,7 +680,7 @@ def apply_active_contour(input_id: str, mode_id: str):
 
         # Get image slice and convert to float
         slice_range = utils.get_3d_slice_range_from(params["axis"], params["slice_num"])
-        img_slice = img_as_float32(data_repo.get_image("image")[slice_range])
+        img_slice = img_as_float32(data_repo.get_image("image", lazy=True)[slice_range])
         
 
         # Store the image slice for later use
@@ -743,7 +775,7 @@ def apply_active_contour_checkboard(input_id: str):
 
     # Get image slice and convert to float
     slice_range = utils.get_3d_slice_range_from(params["axis"], params["slice_num"])
-    img_slice = img_as_float32(data_repo.get_image(input_id)[slice_range])
+    img_slice = img_as_float32(data_repo.get_image(input_id, lazy=True)[slice_range])
     
     # Step 3: Initialize Level Set using Checkerboard
     init_ls = np.zeros(img_slice.shape, dtype=bool)
@@ -806,7 +838,7 @@ def niblack_preview(input_id: str):
     annot_module.set_current_axis(axis_dim)
     annot_module.set_current_slice(slice_num)
 
-    img_slice = data_repo.get_image(input_id)[slice_range]
+    img_slice = data_repo.get_image(input_id, lazy=True)[slice_range]
 
     input_img_3d = np.ascontiguousarray(img_slice.reshape((1, *img_slice.shape)),dtype=np.float32)
 
@@ -909,6 +941,8 @@ def niblack_apply(input_id: str):
             output_img[:, :, slice_num] = threshold_niblack(input,windowSize=N,weight=W,type3d=0,verbose=1,gpuMemory=0.1,ngpus=1)
 
         annot_module.annotation_image[slice_range] = np.where(output_img[slice_range] > 0, label, -1)
+        annot_module.mark_bulk_change()
+        annot_module.touch()
 
     elif convType == "3d":
         # Apply convolution in all x, y, z directions
@@ -999,6 +1033,8 @@ def sauvola_apply(input_id: str):
             output_img[:, :, slice_num] = threshold_sauvola(input,windowSize=N,range = R,weight=W,type3d=0,verbose=1,gpuMemory=0.1,ngpus=1)
 
         annot_module.annotation_image[slice_range] = np.where(output_img[slice_range] > 0, label, -1)
+        annot_module.mark_bulk_change()
+        annot_module.touch()
 
 
     elif convType == "3d":
@@ -1090,6 +1126,8 @@ def local_mean_apply(input_id: str):
             output_img[:, :, slice_num] = threshold_mean(input,windowSize=N,weight=W,type3d=0,verbose=1,gpuMemory=0.1,ngpus=1)
 
         annot_module.annotation_image[slice_range] = np.where(output_img[slice_range] > 0, label, -1)
+        annot_module.mark_bulk_change()
+        annot_module.touch()
 
     elif convType == "3d":
         # Apply convolution in all x, y, z directions
@@ -1180,6 +1218,8 @@ def local_gaussian_apply(input_id: str):
 
         #annot_module.annotation_image[slice_range] = output_img[slice_range]
         annot_module.annotation_image[slice_range] = np.where(output_img[slice_range] > 0, label, -1)
+        annot_module.mark_bulk_change()
+        annot_module.touch()
 
     elif convType == "3d":
         # Apply convolution in all x, y, z directions
@@ -1317,6 +1357,7 @@ def watershed_apply(input_id: str):
         z,x,y = watershed_relief.shape
 
         for i in range(z):
+            jobs.check_cancelled()
             watershed.watershed_meyers_2d(watershed_relief[i], markers[i], -1, x, y)
 
         img_label = data_repo.get_image('label')
@@ -2124,7 +2165,7 @@ def apply_sam():
     annot_module.set_current_axis(axis_dim)
     annot_module.set_current_slice(slice_num)
     slice_range = utils.get_3d_slice_range_from(axis, slice_num)
-    img_slice = data_repo.get_image('image')[slice_range]
+    img_slice = data_repo.get_image('image', lazy=True)[slice_range]
 
     # SAM expects uint8 RGB
     # Compute the 80th percentile (robust upper bound)
@@ -17,7 +17,7 @@ from harpia.filters.filtersChunked import(
 )
 
 from skimage.filters import gaussian as skimage_gaussian
-from sscAnnotat3D import utils
+from sscAnnotat3D import jobs, utils
 from werkzeug.exceptions import BadRequest
 from sscAnnotat3D.repository import data_repo
 from sscPySpin.filters import filter_bm3d as spin_bm3d
@@ -117,6 +117,8 @@ def gaussian_apply(input_id: str, output_id: str):
         axisIndex = axisIndexDict[request.json["axis"]]
         typeImg2d = input_img[0].dtype
         for i in range(input_img.shape[axisIndex]):
+            jobs.check_cancelled()
+
             # on the annotat3D legacy, this was implemented forcing the stack through the z axis
             if axisIndex == 0:
                 # stack following the z axis
@@ -371,6 +373,8 @@ def mean_apply(input_id: str, output_id: str):
         axisIndex = axisIndexDict[request.json["axis"]]
         typeImg2d = input_img[0].dtype
         for i in range(input_img.shape[axisIndex]):
+            jobs.check_cancelled()
+
             # on the annotat3D legacy, this was implemented forcing the stack through the z axis
             if axisIndex == 0:
                 # stack following the z axis
@@ -465,6 +469,8 @@ def unsharp_mask_apply(input_id: str, output_id: str):
         axisIndex = axisIndexDict[request.json["axis"]]
         typeImg2d = input_img[0].dtype
         for i in range(input_img.shape[axisIndex]):
+            jobs.check_cancelled()
+
             # on the annotat3D legacy, this was implemented forcing the stack through the z axis
             if axisIndex == 0:
                 # stack following the z axis
@@ -555,6 +561,8 @@ def median_apply(input_id: str, output_id: str):
         axisIndex = axisIndexDict[request.json["axis"]]
         typeImg2d = input_img[0].dtype
         for i in range(input_img.shape[axisIndex]):
+            jobs.check_cancelled()
+
             # on the annotat3D legacy, this was implemented forcing the stack through the z axis
             if axisIndex == 0:
                 # stack following the z axis
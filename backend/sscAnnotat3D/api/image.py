@@ -1,11 +1,8 @@
-import io
-import zlib
-
 import numpy as np
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
-from sscAnnotat3D import label, utils
-from sscAnnotat3D.repository import data_repo, module_repo
+from sscAnnotat3D import prefetch, pyramid, slice_encoding, slice_payload, utils
+from sscAnnotat3D.repository import data_repo, module_repo, slice_cache
 from werkzeug.exceptions import BadRequest
 from collections import defaultdict
 
@@ -23,7 +20,7 @@ app.register_error_handler(400, handle_exception)
 @app.route("/is_available_image/<image_id>", methods=["POST"])
 @cross_origin()
 def is_available_image(image_id: str):
-    image = data_repo.get_image(image_id)
+    image = data_repo.get_image(image_id, lazy=True)
     return jsonify({"available": image is not None})
 
 
@@ -31,38 +28,136 @@ def is_available_image(image_id: str):
 @cross_origin()
 def get_image_slice(image_id: str):
 
-    image = data_repo.get_image(key=image_id)
+    image = data_repo.get_image(key=image_id, lazy=True)
 
     if image is None:
         return handle_exception(f"Image {image_id} not found.")
 
     slice_num = request.json["slice"]
     axis = request.json["axis"]
-    slice_range = utils.get_3d_slice_range_from(axis, slice_num)
 
     data_repo.set_info(key="current_slice", data = {'slice_num': slice_num, 'axis': axis })
 
-    img_slice = image[slice_range]
-
     get_contour = request.json.get("contour", False)
+    encoding = slice_encoding.negotiate(request)
 
-    if get_contour:
-        img_slice = label.label_slice_contour(img_slice + 1) - 1
+    try:
+        level = int(request.json.get("level", 0))
+        roi = utils.parse_roi(request.json.get("roi", None))
+        encoded_slice = slice_payload.image_slice(
+            axis, slice_num, image_id=image_id, contour=bool(get_contour), encoding=encoding, level=level, roi=roi
+        )
+    except ValueError as e:
+        return handle_exception(str(e))
+
+    # neighbours of the level slice, one per level block
+    factor = pyramid.scale(level)
+    prefetch.schedule(
+        "image",
+        axis,
+        slice_num - slice_num % factor,
+        image.shape[utils.get_axis_num(axis)],
+        step=factor,
+        image_id=image_id,
+        contour=bool(get_contour),
+        encoding=encoding,
+        level=level,
+        roi=roi,
+    )
+
+    return encoded_slice.to_response()
+
+
+@app.route("/get_slice_tiles", methods=["POST"])
+@cross_origin()
+def get_slice_tiles():
+    """
+    Function that gets several tiles (windows of slices) in a single response
 
-    import time
+    Notes:
+        The request json has a "tiles" list, each tile is a dict with "kind" ("image", "annotation" or "superpixel"),
+        "roi" (x0, y0, x1, y1) and optionally "image_id", "axis", "slice", "level" and "contour". Missing "axis" and
+        "slice" are taken from the request json. See slice_encoding.pack_tiles for the response layout.
 
-    npy_st = time.time()
-    byte_slice = utils.toNpyBytes(img_slice)
-    npy_en = time.time()
+    Returns:
+        (flask.Response): the packed tiles
 
-    comp_st = time.time()
-    compressed_byte_slice = zlib.compress(byte_slice)
-    comp_en = time.time()
+    """
+    encoding = slice_encoding.negotiate(request)
+    tiles = []
+
+    try:
+        for tile in request.json["tiles"]:
+            kind = tile.get("kind", "image")
+            axis = tile.get("axis", request.json.get("axis"))
+            slice_num = int(tile.get("slice", request.json.get("slice")))
+            roi = utils.parse_roi(tile.get("roi", None))
+            level = int(tile.get("level", 0))
+
+            if kind == "image":
+                image_id = tile.get("image_id", "image")
+                if data_repo.get_image(image_id, lazy=True) is None:
+                    tiles.append(None)
+                    continue
+                tiles.append(
+                    slice_payload.image_slice(
+                        axis,
+                        slice_num,
+                        image_id=image_id,
+                        contour=bool(tile.get("contour", False)),
+                        encoding=encoding,
+                        level=level,
+                        roi=roi,
+                    )
+                )
+            elif kind == "annotation":
+                tiles.append(slice_payload.annotation_slice(axis, slice_num, encoding=encoding, level=level, roi=roi))
+            elif kind == "superpixel":
+                if data_repo.get_image("superpixel", lazy=True) is None:
+                    tiles.append(None)
+                    continue
+                tiles.append(slice_payload.superpixel_slice(axis, slice_num, encoding=encoding, roi=roi))
+            else:
+                return handle_exception(f"Unknown tile kind {kind}.")
+    except (KeyError, TypeError, ValueError) as e:
+        return handle_exception(f"Invalid tile request: {str(e)}")
+
+    return slice_encoding.pack_tiles(tiles)
+
+
+@app.route("/set_prefetch_config", methods=["POST"])
+@cross_origin()
+def set_prefetch_config():
+    """
+    Function that changes the slice prefetch depth and number of threads
 
-    print("npy time: ", npy_en - npy_st)
-    print("compress time: ", comp_en - comp_st)
+    Returns:
+        (dict): the prefetch depth and number of threads in use
 
-    return send_file(io.BytesIO(compressed_byte_slice), "application/gzip")
+    """
+    try:
+        depth = request.json.get("depth", None)
+        workers = request.json.get("workers", None)
+        prefetch.configure(
+            depth=int(depth) if depth is not None else None, workers=int(workers) if workers is not None else None
+        )
+    except Exception as e:
+        return handle_exception(f"Invalid prefetch config: {str(e)}")
+
+    return jsonify(prefetch.get_config())
+
+
+@app.route("/get_slice_cache_stats", methods=["POST", "GET"])
+@cross_origin()
+def get_slice_cache_stats():
+    """
+    Function that gets the hit/miss counters of the slice cache
+
+    Returns:
+        (dict): hits, misses, hitRate, entries, bytes and maxBytes of the cache
+
+    """
+    return jsonify(slice_cache.stats())
 
 
 @app.route("/get_image_info/<image_info_key>", methods=["POST"])
@@ -239,6 +334,7 @@ def crop_merge():
             "numpy",
             shape=(imageFullShape["z"], imageFullShape["y"], imageFullShape["x"]),
             dtype=image_info["imageDtype"],
+            lazy=image_info.get("imageLazy", False),
         )
         #update image shape
         annot_module = module_repo.get_module('annotation')
@@ -336,7 +432,8 @@ def crop_merge():
 @cross_origin()
 def get_open_images():
 
-    image_keys = data_repo.get_images_keys()
+    # the shm storage backend also shares the annotation volume, which is listed below
+    image_keys = [key for key in data_repo.get_images_keys() if key != "annotation"]
 
     if "image" in image_keys:
         # annotations will open alog image
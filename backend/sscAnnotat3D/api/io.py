@@ -1,3 +1,4 @@
+import json
 import os
 import os.path
 import time
@@ -6,7 +7,7 @@ import logging
 import numpy as np
 from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
-from sscAnnotat3D import utils
+from sscAnnotat3D import jobs, pyramid, snapshot, utils
 from sscAnnotat3D.repository import data_repo, module_repo
 from werkzeug.exceptions import BadRequest
 
@@ -59,7 +60,7 @@ def get_image_histogram(image_id):
     """
     start = time.process_time()
 
-    image = data_repo.get_image(key=image_id)
+    image = data_repo.get_image(key=image_id, lazy=True)
     if image is None:
         return handle_exception(f"Image {image_id} not found.")
 
@@ -172,10 +173,13 @@ def open_image(image_id: str):
 
     error_msg = ""
 
+    # memory-map raw/npy volumes instead of reading them into RAM, pages are only read when a slice touches them
+    lazy = bool(request.json.get("lazy", utils.lazy_loading_mode()))
+
     try:
         use_image_raw_parse = request.json["use_image_raw_parse"]
         if extension in tif_extensions or use_image_raw_parse:
-            image, info = utils.read_volume(image_path, "numpy")
+            image, info = utils.read_volume(image_path, "numpy", lazy=lazy)
             error_msg = "No such file or directory {}".format(image_path)
 
         else:
@@ -185,6 +189,7 @@ def open_image(image_id: str):
                 "numpy",
                 shape=(image_raw_shape[2], image_raw_shape[1], image_raw_shape[0]),
                 dtype=image_dtype,
+                lazy=lazy,
             )
 
             error_msg = (
@@ -205,12 +210,14 @@ def open_image(image_id: str):
         "imageName": file_name,
         "imageDtype": image_dtype,
         "imageFullPath": image_path,
+        "imageLazy": lazy,
     }
 
     label_list = []
     if image_id == "image":
         data_repo.set_image(key=image_id, data=image)
         data_repo.set_info(data=image_info)
+        pyramid.build_async(image_id)
         
         try:
             annot_module = module_repo.get_module("annotation")
@@ -301,7 +308,7 @@ def save_image(image_id: str):
         print(e)
         return handle_exception("Error while trying to get the image path")
 
-    image = data_repo.get_image(key=image_id)
+    image = data_repo.get_image(key=image_id, lazy=True)
     if image.size == 0:
         return handle_exception("Unable to retrieve the image !")
     image_dtype = image.dtype.name
@@ -320,3 +327,65 @@ def save_image(image_id: str):
     }
 
     return jsonify(image_info)
+
+
+def _snapshot_job(action, session_path: str):
+    def run(job):
+        manifest = action(session_path)
+        return json.dumps(manifest).encode("utf-8"), 200, "application/json"
+
+    return run
+
+
+def _run_snapshot(action, endpoint: str):
+    try:
+        session_path = request.json["session_path"]
+        background = request.json.get("background", False)
+    except Exception as e:
+        return handle_exception(f"Error while trying to get the session path: {str(e)}")
+
+    if background:
+        job = jobs.submit(_snapshot_job(action, session_path), endpoint, "POST", request.json)
+        return jsonify(job.info())
+
+    try:
+        manifest = action(session_path)
+    except Exception as e:
+        logging.error("Session snapshot failed", exc_info=True)
+        return handle_exception(f"Unable to {endpoint[1:].replace('_', ' ')}: {str(e)}")
+
+    return jsonify(manifest)
+
+
+@app.route("/save_session", methods=["POST"])
+@cross_origin()
+def save_session():
+    """
+    Function that saves the workspace (volumes, annotation, classification model and state) to a snapshot directory
+
+    Notes:
+        Only the volumes changed since the last snapshot written to the same directory are saved again. With
+        {"background": true} the snapshot runs as a job and the job status is returned, see api/jobs.py.
+
+    Returns:
+        (dict): the snapshot manifest, with the entries written in "written", or the job status
+
+    """
+    return _run_snapshot(snapshot.save, "/save_session")
+
+
+@app.route("/restore_session", methods=["POST"])
+@cross_origin()
+def restore_session():
+    """
+    Function that restores the workspace from a snapshot directory written by /save_session
+
+    Notes:
+        The volumes are memory-mapped, so the restore doesn't read them into RAM. With {"background": true} the
+        restore runs as a job and the job status is returned, see api/jobs.py.
+
+    Returns:
+        (dict): the snapshot manifest, or the job status
+
+    """
+    return _run_snapshot(snapshot.restore, "/restore_session")
@@ -0,0 +1,142 @@
+from flask import Blueprint, current_app, jsonify, request
+from flask_cors import cross_origin
+from sscAnnotat3D import jobs
+from werkzeug.exceptions import HTTPException
+
+app = Blueprint("jobs", __name__)
+
+
+def handle_exception(error_msg: str):
+    return jsonify({"error_msg": error_msg}), 400
+
+
+@app.app_errorhandler(jobs.JobCancelled)
+def job_cancelled(e):
+    return jsonify({"error_msg": str(e)}), 409
+
+
+def _endpoint_runner(flask_app, endpoint: str, method: str, payload: dict):
+    def run(job):
+        # the endpoint runs as a regular request, so it doesn't need to know it's a job
+        with flask_app.test_client() as client:
+            response = client.open(endpoint, method=method, json=payload)
+            return response.get_data(), response.status_code, response.mimetype
+
+    return run
+
+
+@app.route("/jobs/submit", methods=["POST"])
+@cross_origin()
+def submit_job():
+    """
+    Function that runs an endpoint in background
+
+    Notes:
+        The request json has the "endpoint" path (e.g. "/superpixel_segmentation_module/execute"), the http "method"
+        (POST by default) and the "payload" json sent to the endpoint.
+
+    Returns:
+        (dict): the job status, its jobId is used by the other /jobs endpoints
+
+    """
+    try:
+        endpoint = request.json["endpoint"]
+        method = request.json.get("method", "POST").upper()
+        payload = request.json.get("payload", None)
+    except Exception as e:
+        return handle_exception(f"Invalid job request: {str(e)}")
+
+    if not endpoint.startswith("/") or endpoint.startswith("/jobs"):
+        return handle_exception(f"Invalid job endpoint {endpoint}")
+
+    flask_app = current_app._get_current_object()
+
+    try:
+        flask_app.url_map.bind("").match(endpoint, method=method)
+    except HTTPException as e:
+        return handle_exception(f"Invalid job endpoint {endpoint}: {e.description}")
+
+    job = jobs.submit(_endpoint_runner(flask_app, endpoint, method, payload), endpoint, method, payload)
+
+    return jsonify(job.info())
+
+
+@app.route("/jobs", methods=["POST", "GET"])
+@cross_origin()
+def list_jobs():
+    """
+    Function that gets the status of the queued, running and last finished jobs
+
+    Returns:
+        (list): list of job status
+
+    """
+    return jsonify([job.info() for job in jobs.list_jobs()])
+
+
+@app.route("/jobs/<job_id>/status", methods=["POST", "GET"])
+@cross_origin()
+def job_status(job_id: str):
+    """
+    Function that gets the status of a job
+
+    Args:
+        job_id (str): the job id
+
+    Returns:
+        (dict): jobId, endpoint, status ("queued", "running", "done", "failed" or "cancelled"), error, progress and times
+
+    """
+    job = jobs.get(job_id)
+
+    if job is None:
+        return handle_exception(f"Job {job_id} not found.")
+
+    return jsonify(job.info())
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+@cross_origin()
+def cancel_job(job_id: str):
+    """
+    Function that cancels a job
+
+    Args:
+        job_id (str): the job id
+
+    Returns:
+        (dict): the job status
+
+    """
+    job = jobs.cancel(job_id)
+
+    if job is None:
+        return handle_exception(f"Job {job_id} not found.")
+
+    return jsonify(job.info())
+
+
+@app.route("/jobs/<job_id>/result", methods=["POST", "GET"])
+@cross_origin()
+def job_result(job_id: str):
+    """
+    Function that gets the response of the endpoint run by a job
+
+    Args:
+        job_id (str): the job id
+
+    Returns:
+        (flask.Response): the body, status code and mimetype returned by the endpoint
+
+    """
+    job = jobs.get(job_id)
+
+    if job is None:
+        return handle_exception(f"Job {job_id} not found.")
+
+    if job.result is None:
+        return handle_exception(f"Job {job_id} has no result, its status is {job.status}.")
+
+    body, status_code, mimetype = job.result
+
+    return current_app.response_class(body, status=status_code, mimetype=mimetype)
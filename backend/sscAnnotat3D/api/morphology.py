@@ -1,5 +1,5 @@
 import numpy as np
-from flask import Blueprint, request
+from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
 from harpia.morphology import (
      binary_erosion,
@@ -12,7 +12,7 @@ from harpia.morphology import (
 from skimage.morphology import disk, ball
 import numpy as np
 from sscAnnotat3D.repository import data_repo, module_repo
-from sscAnnotat3D import utils
+from sscAnnotat3D import slice_payload, utils
 
 MAX_SIZE = 1660120000 #equivalent to a 1520x1520x700 elements
 HALF_MARGIN_SIZE = 50 #how many slices will be used to correct margin issues for chunked fill_holes
@@ -83,7 +83,10 @@ def morphology_apply_2D():
     # Marker id is not necessary for the magic wand logic.
     mk_id = annot_module.current_mk_id
     annot_module.multilabel_updated(annotation_slice, mk_id, True, pixel_change)
-        
+
+    if request.json.get("delta", False):
+        return jsonify({"delta": slice_payload.annotation_delta(annot_module, axis, slice_num)})
+
     return "success", 200
 
 @app.route("/morphology/binary/morphology/label3D/", methods=["POST"])
@@ -8,7 +8,7 @@ from sscAnnotat3D.api.annotation import handle_exception
 from sscAnnotat3D.api.superpixel import _debugger_print
 from sscAnnotat3D.modules.pixel_segmentation_module import PixelSegmentationModule
 from sscAnnotat3D.modules.superpixel_segmentation_module import SuperpixelSegmentationModule
-from sscAnnotat3D.repository import data_repo, module_repo
+from sscAnnotat3D.repository import data_repo, feature_cache, module_repo
 from sscAnnotat3D import utils
 
 
@@ -362,7 +362,9 @@ def train_segmentation():
         if segm_module is None:
             return handle_exception("No existing model available to finetune. Please load model.")
         try:
-            segm_module.train(annotation_slice_dict, annotation_image, finetune=True)
+            segm_module.train(
+                annotation_slice_dict, annotation_image, finetune=True, annotation_module=annotation_module
+            )
         except Exception as e:
             return handle_exception(f"Unable to finetune! {str(e)}")
         
@@ -394,11 +396,16 @@ def train_segmentation():
             return handle_exception("Please create a superpixel of the image first.")
         if _convert_dtype_to_str(img_superpixel.dtype) != "int32":
             img_superpixel = img_superpixel.astype("int32")
-        segm_module = SuperpixelSegmentationModule(img, img_superpixel)
+        segm_module = SuperpixelSegmentationModule(
+            img,
+            img_superpixel,
+            image_version=data_repo.get_image_version("image"),
+            superpixel_version=data_repo.get_image_version("superpixel"),
+        )
     else:
         if img is None:
             return handle_exception("Needs a valid image to create module.")
-        segm_module = PixelSegmentationModule(img)
+        segm_module = PixelSegmentationModule(img, image_version=data_repo.get_image_version("image"))
 
     # Merge defaults
     data_repo.set_feature_extraction_params(key="feature_extraction_params", data=feature_extraction_params.copy())
@@ -409,7 +416,9 @@ def train_segmentation():
     module_repo.set_module(module_key, segm_module)
 
     try:
-        segm_module.train(annotation_slice_dict, annotation_image, finetune=False)
+        segm_module.train(
+            annotation_slice_dict, annotation_image, finetune=False, annotation_module=annotation_module
+        )
     except Exception as e:
         return handle_exception(f"Unable to train new model! {str(e)}")
     data_repo.set_info(key="model_status", data={'loaded': False, 'trained': True, 'pixel_type': module_type})
@@ -454,6 +463,19 @@ def preview(segm_type):
     return jsonify({"selected_features_names": selected_features_names}), 200
 
 
+@app.route("/get_feature_cache_stats", methods=["POST", "GET"])
+@cross_origin()
+def get_feature_cache_stats():
+    """
+    Function that gets the hit/miss counters of the superpixel feature cache
+
+    Returns:
+        (dict): hits, misses, hitRate, entries, spilled, bytes and maxBytes of the cache
+
+    """
+    return jsonify(feature_cache.stats())
+
+
 @app.route("/<segm_type>_segmentation_module/execute", methods=["POST"])
 @cross_origin()
 def execute(segm_type):
@@ -1,9 +1,8 @@
-import io
-import zlib
 from werkzeug.exceptions import BadRequest
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
 from sscAnnotat3D import utils
+from sscAnnotat3D import prefetch, slice_encoding, slice_payload
 from sscAnnotat3D.repository import data_repo
 from harpia.watershed.watershed import boundaries,hierarchicalWatershedChunked_GPU
 from harpia.filters.filtersChunked import sobel
@@ -14,6 +13,14 @@ import numpy as np
 app = Blueprint("superpixel", __name__)
 
 
+@app.errorhandler(BadRequest)
+def handle_exception(error_msg: str):
+    return jsonify({"error_msg": error_msg}), 400
+
+
+app.register_error_handler(400, handle_exception)
+
+
 def _debugger_print(msg: str, payload: any):
     print("\n----------------------------------------------------------")
     print("{} : {}".format(msg, payload))
@@ -96,35 +103,38 @@ def superpixel():
     return jsonify("success")        
 
 
-
 @app.route("/get_superpixel_slice", methods=["POST", "GET"])
 @cross_origin()
 def get_superpixel_slice():
     """
-    This function gets the superpixel slice value
+    This function gets the superpixel value
 
     Returns:
-        (flask.send_file): returns the superpixel value to canvas
+        (flask.Response): returns the encoded superpixel slice to canvas
 
     """
-    img_superpixels = data_repo.get_image("superpixel")
+    img_superpixels = data_repo.get_image("superpixel", lazy=True)
 
     if img_superpixels is None:
         return "failure", 400
 
     slice_num = request.json["slice"]
     axis = request.json["axis"]
-    slice_range = utils.get_3d_slice_range_from(axis, slice_num)
 
-    slice_superpixels = img_superpixels[slice_range]
-    print("superpixel shape:",slice_superpixels.shape )
+    encoding = slice_encoding.negotiate(request)
+
+    try:
+        roi = utils.parse_roi(request.json.get("roi", None))
+    except ValueError as e:
+        return handle_exception(str(e))
 
-    slice_superpixels = boundaries(slice_superpixels.astype(np.int32)).astype(np.uint8)#superpixels.superpixel_slice_borders(slice_superpixels)
-    print("superpixel shape:",slice_superpixels.shape )
+    compressed_slice_superpixels = slice_payload.superpixel_slice(axis, slice_num, encoding=encoding, roi=roi)
 
-    compressed_slice_superpixels = zlib.compress(utils.toNpyBytes(slice_superpixels))
+    prefetch.schedule(
+        "superpixel", axis, slice_num, img_superpixels.shape[utils.get_axis_num(axis)], encoding=encoding, roi=roi
+    )
 
-    return send_file(io.BytesIO(compressed_slice_superpixels), "application/gzip")
+    return compressed_slice_superpixels.to_response()
 
 @app.route("/merge_superpixels", methods=["POST", "GET"])
 @cross_origin()
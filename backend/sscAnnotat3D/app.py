@@ -13,6 +13,7 @@ from sscAnnotat3D.__version__ import __version__
 from sscAnnotat3D.api import annotation, filters, morphology, segmentation_model
 from sscAnnotat3D.api import image as apiimage
 from sscAnnotat3D.api import io as apiio
+from sscAnnotat3D.api import jobs as apijobs
 from sscAnnotat3D.api import superpixel
 from sscAnnotat3D.repository import data_repo
 
@@ -45,6 +46,7 @@ app.register_blueprint(apiimage.app)
 app.register_blueprint(filters.app)
 app.register_blueprint(morphology.app)
 app.register_blueprint(segmentation_model.app)
+app.register_blueprint(apijobs.app)
 
 
 image = None
@@ -152,6 +154,6 @@ if __name__ == "__main__":
     LOG_LEVEL = os.getenv("ANNOTAT3D_LOG_LEVEL", "DEBUG")
     logging.root.setLevel(LOG_LEVEL)
 
-    # WARNING: only one process can be used, as we store images in memory
-    # to be able to use more processes we should find a better way to store data
+    # WARNING: only one process can be used with the default memory storage backend.
+    # Set ANNOTAT3D_STORAGE_BACKEND=shm to share the volumes between processes (e.g. gunicorn workers serving slices)
     app.run(host=os.getenv("FLASK_RUN_HOST"), port=os.getenv("FLASK_RUN_PORT"), debug=True, processes=1, threaded=True)
@@ -363,11 +363,7 @@ def pixel_feature_extraction(img, **kwargs):
     print("................\n")
     sigmas = np.array(sigmas, "float32")
     pixel_features = pixel_feature_extract(img_float, sigmas, features_args, verbose=0, gpuMemory=0.4)
-    print("[DEBUG] Pixel Features:",
-    "min:", pixel_features.min(),
-    "max:", pixel_features.max(),
-    "mean:", pixel_features.mean(),
-    "std:", pixel_features.std())
+    log_feature_stats("Pixel features", pixel_features)
     print("................\n")
 
     end = time.time()
@@ -376,6 +372,28 @@ def pixel_feature_extraction(img, **kwargs):
     return pixel_features
 
 
+def log_feature_stats(name, features):
+    """
+    Function that logs the min, max, mean and std of features, only if utils.debug_feature_stats() is enabled
+
+    Args:
+        name (str): name of the features in the log
+        features (array): the features
+
+    Returns:
+        None
+
+    """
+    if not utils.debug_feature_stats():
+        return
+
+    logger.debug(
+        "{}: shape {} min {} max {} mean {} std {}".format(
+            name, features.shape, features.min(), features.max(), features.mean(), features.std()
+        )
+    )
+
+
 def superpixel_feature_extraction(
     img,
     img_superpixels,
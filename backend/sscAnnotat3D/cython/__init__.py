@@ -1 +1,2 @@
 from .annotation import *
+from .stroke import *
@@ -0,0 +1,32 @@
+cimport cython
+from libc.string cimport memset
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void cython_draw_spans(unsigned char[:, ::1] mask, int[:, ::1] centers, int[::1] span_rows, int[::1] half_widths):
+    """
+    Draws a brush disk on each center of a stroke, row by row.
+
+    Each row of the disk is a span of columns: for the k-th row, mask[row + span_rows[k], col - half_widths[k]:col +
+    half_widths[k] + 1] is set to 1 for each (row, col) in centers. Spans out of the mask are clipped.
+    """
+    cdef Py_ssize_t i, k
+    cdef int row, start, end
+    cdef int height = mask.shape[0]
+    cdef int width = mask.shape[1]
+
+    with nogil:
+        for i in range(centers.shape[0]):
+            for k in range(span_rows.shape[0]):
+                row = centers[i, 0] + span_rows[k]
+                if row < 0 or row >= height:
+                    continue
+
+                start = centers[i, 1] - half_widths[k]
+                end = centers[i, 1] + half_widths[k] + 1
+                start = start if start > 0 else 0
+                end = end if end < width else width
+
+                if end > start:
+                    memset(&mask[row, start], 1, end - start)
@@ -0,0 +1,275 @@
+"""
+This script contains the background job manager.
+
+Long-running endpoints (segmentation execute, filters, superpixel, morphology, training, ...) can be submitted as a job
+instead of being called directly. The job runs the same endpoint on a worker thread, so the request returns at once and
+the client polls the job status, with the progress of the "main" progress bar updated by the endpoint, and gets the
+response of the endpoint from the job result when it finishes. Jobs wait in a queue while the workers are busy.
+
+The jobs run in threads of the backend process, since the volumes and modules live in its memory. The number of workers
+is read from the env variable ANNOTAT3D_JOB_WORKERS (1 by default, so jobs changing the same volumes run one after the
+other) and the number of finished jobs kept with their results from ANNOTAT3D_JOB_HISTORY (32 by default).
+
+Cancelling a running job is cooperative: long loops call check_cancelled() between slices or blocks, which raises
+JobCancelled when the job running in the current thread was cancelled. The loops only store their output after the
+last slice or block, so a cancelled job leaves the volumes as they were.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sscAnnotat3D import progressbar
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_finished_status = (DONE, FAILED, CANCELLED)
+
+# job running in the current thread
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """
+    Raised by check_cancelled() when the job running in the current thread was cancelled.
+    """
+
+    pass
+
+
+class Job:
+    """
+    A request to an endpoint that runs in background.
+
+    Args:
+        job_id (str): the job id
+        endpoint (str): path of the endpoint, e.g. "/superpixel"
+        method (str): http method used to call the endpoint
+        payload (dict): json body sent to the endpoint
+
+    """
+
+    def __init__(self, job_id: str, endpoint: str, method: str = "POST", payload: dict = None):
+        self.job_id = job_id
+        self.endpoint = endpoint
+        self.method = method
+        self.payload = payload
+        self.status = QUEUED
+        self.error = None
+        self.cancel_requested = False
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.progress = progressbar.ConsoleProgressBar()
+        self.future = None
+        # response of the endpoint: (body, status code, mimetype)
+        self.result = None
+
+    def info(self):
+        """
+        Build the status of the job sent to the frontend
+
+        Returns:
+            (dict): jobId, endpoint, status, error, progress (cur and max) and the created, started and finished times
+
+        """
+        return {
+            "jobId": self.job_id,
+            "endpoint": self.endpoint,
+            "status": self.status,
+            "error": self.error,
+            "cancelRequested": self.cancel_requested,
+            "progress": {"cur": self.progress.cur(), "max": self.progress.max()},
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    """
+    Run jobs on a thread pool and keep their status and results.
+
+    Args:
+        workers (int): number of jobs running at the same time
+        history (int): number of finished jobs kept, the oldest ones are forgotten first
+
+    """
+
+    def __init__(self, workers: int = 1, history: int = 32):
+        self.workers = workers
+        self.history = history
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="annotat3d_job")
+
+    def submit(self, run, endpoint: str, method: str = "POST", payload: dict = None):
+        with self._lock:
+            job = Job(str(next(self._ids)), endpoint, method, payload)
+            self._jobs[job.job_id] = job
+            self._forget_finished()
+
+        job.future = self._executor.submit(self._run, job, run)
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str):
+        job = self.get(job_id)
+        if job is None:
+            return None
+
+        job.cancel_requested = True
+        if job.future is not None and job.future.cancel():
+            # still in the queue, it will never run
+            self._finish(job, CANCELLED)
+
+        return job
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in _finished_status]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _finish(self, job: Job, status: str, error: str = None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+
+        with self._lock:
+            self._forget_finished()
+
+    def _run(self, job: Job, run):
+        if job.cancel_requested:
+            self._finish(job, CANCELLED)
+            return
+
+        job.status = RUNNING
+        job.started = time.time()
+        progressbar.bind({"main": job.progress})
+        _local.job = job
+
+        try:
+            job.result = run(job)
+        except JobCancelled:
+            self._finish(job, CANCELLED)
+            return
+        except Exception as e:
+            if job.cancel_requested:
+                self._finish(job, CANCELLED)
+            else:
+                logging.exception("Job {} ({}) failed".format(job.job_id, job.endpoint))
+                self._finish(job, FAILED, str(e))
+            return
+        finally:
+            _local.job = None
+            progressbar.bind(None)
+
+        body, status_code, _ = job.result
+        if status_code >= 400 and job.cancel_requested:
+            # the endpoint turned JobCancelled into an error response
+            self._finish(job, CANCELLED)
+        elif status_code >= 400:
+            self._finish(job, FAILED, body.decode("utf-8", errors="replace"))
+        else:
+            self._finish(job, DONE)
+
+
+_manager = JobManager(
+    workers=int(os.environ.get("ANNOTAT3D_JOB_WORKERS", 1)), history=int(os.environ.get("ANNOTAT3D_JOB_HISTORY", 32))
+)
+
+
+def submit(run, endpoint: str, method: str = "POST", payload: dict = None):
+    """
+    Function that queues a job
+
+    Args:
+        run (callable): function called as run(job) on a worker thread, returns the (body, status code, mimetype) of
+            the response
+        endpoint (str): path of the endpoint run by the job
+        method (str): http method used to call the endpoint
+        payload (dict): json body sent to the endpoint
+
+    Returns:
+        (Job): the queued job
+
+    """
+    return _manager.submit(run, endpoint, method, payload)
+
+
+def get(job_id: str):
+    """
+    Function that gets a job
+
+    Args:
+        job_id (str): the job id
+
+    Returns:
+        (Job): the job, or None if it doesn't exist or was forgotten
+
+    """
+    return _manager.get(job_id)
+
+
+def list_jobs():
+    """
+    Function that gets the jobs, in the order they were submitted
+
+    Returns:
+        (list): list of Job
+
+    """
+    return _manager.list()
+
+
+def cancel(job_id: str):
+    """
+    Function that cancels a job. A queued job never runs, a running job is flagged with cancel_requested and stops at
+    its next check_cancelled().
+
+    Args:
+        job_id (str): the job id
+
+    Returns:
+        (Job): the job, or None if it doesn't exist
+
+    """
+    return _manager.cancel(job_id)
+
+
+def check_cancelled():
+    """
+    Function that stops the job running in the current thread if it was cancelled. It does nothing outside a job, so
+    the same code runs as a regular request.
+
+    Notes:
+        Loops call it once per slice or block and only store their result (output image, label, prediction) after
+        the last one, so a cancelled job leaves the stored data untouched.
+
+    Raises:
+        JobCancelled: if the job was cancelled
+
+    Returns:
+        None
+
+    """
+    job = getattr(_local, "job", None)
+
+    if job is not None and job.cancel_requested:
+        raise JobCancelled("Job {} was cancelled".format(job.job_id))
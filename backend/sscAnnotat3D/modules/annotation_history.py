@@ -0,0 +1,222 @@
+"""
+This script contains the undo/redo history of the AnnotationModule.
+
+Each edit is stored as the bounding box of the changed pixels of every slice it touched, with the zlib compressed
+content of the box before and after the edit, so a brush stroke costs a few hundred bytes instead of a copy of the
+slice. The history has no limit on the number of edits, only on the bytes it holds: the oldest edits are dropped when
+the budget, read from the env variable ANNOTAT3D_UNDO_BYTES (64MB by default), is exceeded.
+"""
+
+import os
+import threading
+import zlib
+from collections import deque
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = int(os.environ.get("ANNOTAT3D_UNDO_BYTES", 64 * 1024**2))
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, (int, np.integer))
+
+
+class PlanePatch:
+    """
+    Change of a single slice, restricted to the bounding box of the changed pixels.
+
+    Args:
+        get_slice (list|tuple): index of the slice in the annotation volume
+        before (np.ndarray): 2D slice (or window of the slice) before the change
+        after (np.ndarray): 2D slice (or window of the slice) after the change
+        origin (tuple): (row, col) of the window in the slice, (0, 0) for the whole slice
+
+    """
+
+    __slots__ = ("get_slice", "bbox", "shape", "dtype", "_before", "_after")
+
+    def __init__(self, get_slice, before: np.ndarray, after: np.ndarray, origin: tuple = (0, 0)):
+        self.get_slice = tuple(get_slice)
+        self.bbox = None
+        self.shape = None
+        self.dtype = before.dtype
+        self._before = b""
+        self._after = b""
+
+        changed = before != after
+        rows = np.flatnonzero(changed.any(axis=1))
+
+        if rows.size > 0:
+            cols = np.flatnonzero(changed.any(axis=0))
+            window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            row, col = origin
+            self.bbox = (int(rows[0]) + row, int(rows[-1]) + 1 + row, int(cols[0]) + col, int(cols[-1]) + 1 + col)
+            self.shape = before[window].shape
+            self._before = zlib.compress(np.ascontiguousarray(before[window]), 1)
+            self._after = zlib.compress(np.ascontiguousarray(after[window], dtype=self.dtype), 1)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._before) + len(self._after)
+
+    def _window_index(self) -> tuple:
+        index = list(self.get_slice)
+        dims = [i for i, k in enumerate(index) if not _is_int(k)]
+        index[dims[0]] = slice(self.bbox[0], self.bbox[1])
+        index[dims[1]] = slice(self.bbox[2], self.bbox[3])
+        return tuple(index)
+
+    def content(self, undo: bool = True) -> np.ndarray:
+        """
+        Content of the box before (undo) or after (redo) the change
+        """
+        payload = self._before if undo else self._after
+        return np.frombuffer(zlib.decompress(payload), dtype=self.dtype).reshape(self.shape)
+
+    def apply(self, annotation_image, undo: bool = True):
+        """
+        Write the content of the box before (undo) or after (redo) the change
+
+        Args:
+            annotation_image (np.ndarray | SparseAnnotationVolume): the annotation volume
+            undo (bool): if True writes the content before the change, otherwise after
+
+        """
+        if self.bbox is None:
+            return
+
+        annotation_image[self._window_index()] = self.content(undo)
+
+
+class HistoryEntry:
+    """
+    An edit of the annotation, one patch per slice touched.
+
+    Args:
+        patches (list): list of PlanePatch
+        label (int): label removed by the edit, -1 for drawings
+
+    """
+
+    __slots__ = ("patches", "label", "marker_id")
+
+    def __init__(self, patches: list, label: int = -1):
+        self.patches = [patch for patch in patches if patch.bbox is not None]
+        self.label = label
+        self.marker_id = None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(patch.nbytes for patch in self.patches)
+
+    def apply(self, annotation_image, undo: bool = True):
+        for patch in reversed(self.patches) if undo else self.patches:
+            patch.apply(annotation_image, undo)
+
+
+class AnnotationHistory:
+    """
+    Undo and redo stacks of annotation edits, bounded by the bytes of the stored patches.
+
+    Args:
+        max_bytes (int): budget of the compressed patches kept for undo and redo
+
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._undo = deque()
+        self._redo = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._undo)
+
+    def record(self, changes: list, label: int = -1):
+        """
+        Function that records an edit, the redo stack is discarded
+
+        Args:
+            changes (list): list of (get_slice, slice before, slice after), one for each slice changed. A window of the
+                slice can be given as (get_slice, window before, window after, (row, col) of the window)
+            label (int): label removed by the edit, -1 for drawings
+
+        Returns:
+            (HistoryEntry): the edit recorded
+
+        """
+        entry = HistoryEntry([PlanePatch(*change) for change in changes], label)
+
+        with self._lock:
+            self._bytes -= sum(redo_entry.nbytes for redo_entry in self._redo)
+            self._redo = []
+
+            self._undo.append(entry)
+            self._bytes += entry.nbytes
+
+            # the oldest edits are forgotten first, the last one is always kept
+            while self._bytes > self.max_bytes and len(self._undo) > 1:
+                self._bytes -= self._undo.popleft().nbytes
+
+        return entry
+
+    def undo(self, annotation_image, marker_id: int = None):
+        """
+        Function that reverts the last edit
+
+        Args:
+            annotation_image (np.ndarray | SparseAnnotationVolume): the annotation volume
+            marker_id (int): marker removed by the undo, given back by redo
+
+        Returns:
+            (HistoryEntry): the reverted edit, or None if there's nothing to undo
+
+        """
+        with self._lock:
+            if len(self._undo) == 0:
+                return None
+
+            entry = self._undo.pop()
+            entry.marker_id = marker_id
+            entry.apply(annotation_image, undo=True)
+            self._redo.append(entry)
+
+            return entry
+
+    def redo(self, annotation_image):
+        """
+        Function that applies again the last reverted edit
+
+        Args:
+            annotation_image (np.ndarray | SparseAnnotationVolume): the annotation volume
+
+        Returns:
+            (HistoryEntry): the edit applied, or None if there's nothing to redo
+
+        """
+        with self._lock:
+            if len(self._redo) == 0:
+                return None
+
+            entry = self._redo.pop()
+            entry.apply(annotation_image, undo=False)
+            self._undo.append(entry)
+
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._undo.clear()
+            self._redo = []
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Function that gets the size of the history
+
+        Returns:
+            (dict): undo and redo (number of edits), bytes and maxBytes
+
+        """
+        return {"undo": len(self._undo), "redo": len(self._redo), "bytes": self._bytes, "maxBytes": self.max_bytes}
@@ -6,10 +6,74 @@ from operator import itemgetter
 
 import numpy as np
 from skimage import draw
-from sscAnnotat3D import aux_functions
+from sscAnnotat3D import aux_functions, stroke
+from sscAnnotat3D.modules.annotation_history import AnnotationHistory
+from sscAnnotat3D.modules.sparse_annotation import SparseAnnotationVolume, plane_index
+from sscAnnotat3D.repository import data_repo
 from time import time
 from itertools import repeat
-from collections import deque
+import itertools
+
+"""
+counter used to version the annotation volume, it's global so a new AnnotationModule never reuses a version
+"""
+_annotation_versions = itertools.count(1)
+
+
+def _greedy_slice_cover(coords: np.ndarray, shape: tuple):
+    """
+    Greedy cover of 3D coordinates by axis-aligned slices: the slice holding most of the remaining points is taken at
+    each iteration, until every point lies on a taken slice.
+
+    The number of points per slice of each axis is computed once with bincount, and decremented by the points covered
+    at each iteration, so every point is visited once per axis instead of once per iteration.
+
+    Args:
+        coords (np.ndarray): (N, 3) array of z, y, x coordinates
+        shape (tuple): shape of the volume
+
+    Returns:
+        (dict): axis -> set of slices, as AnnotationModule.annotation_slice_dict
+
+    """
+    annotation_slice_dict = {0: set(), 1: set(), 2: set()}
+    counts = [np.bincount(coords[:, axis], minlength=shape[axis]) for axis in range(3)]
+    # points sorted by their slice on each axis, the points of a slice are order[axis][bounds[s]:bounds[s + 1]]
+    order = [np.argsort(coords[:, axis], kind="stable") for axis in range(3)]
+    bounds = [np.concatenate(([0], np.cumsum(count))) for count in counts]
+    remaining = np.ones(len(coords), dtype=bool)
+
+    while True:
+        best_axis = int(np.argmax([count.max() if count.size > 0 else 0 for count in counts]))
+        best_value = int(np.argmax(counts[best_axis]))
+
+        if counts[best_axis].size == 0 or counts[best_axis][best_value] == 0:
+            break
+
+        annotation_slice_dict[best_axis].add(best_value)
+
+        covered = order[best_axis][bounds[best_axis][best_value] : bounds[best_axis][best_value + 1]]
+        covered = covered[remaining[covered]]
+        remaining[covered] = False
+
+        for axis in range(3):
+            counts[axis] -= np.bincount(coords[covered, axis], minlength=shape[axis])
+
+    return annotation_slice_dict
+
+
+def _mask_window(mask: np.ndarray) -> tuple:
+    """
+    Bounding box of the True pixels of a 2D mask, as a (row slice, col slice) window, empty if the mask is empty.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+
+    if rows.size == 0:
+        return slice(0, 0), slice(0, 0)
+
+    cols = np.flatnonzero(mask.any(axis=0))
+    return slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1)
+
 
 class AnnotationModule:
     """docstring for Annotation"""
@@ -19,7 +83,8 @@ class AnnotationModule:
         logging.debug("Creating Annotation_Canvas")
 
         self.zsize, self.ysize, self.xsize = image_shape
-        self.__annotation_image = (-1) * np.ones((self.zsize, self.ysize, self.xsize), dtype="int16")
+        self.version = next(_annotation_versions)
+        self._store_annotation_image(self._new_annotation_image())
 
         self.volume_data = kwargs["image"] if "image" in kwargs else None
         self.xyslice = 0
@@ -40,7 +105,10 @@ class AnnotationModule:
         self.create_labels()
 
         self.annotation_slice_dict = {0: set(), 1: set(), 2: set()}
-        self.annotation_history = deque(maxlen=5)
+        self.annotation_history = AnnotationHistory()
+        # the annotation is empty, no label is on any plane
+        self._label_planes = defaultdict(set)
+        self._changed_windows = dict()
 
     @property
     def clipping_plane_dist(self):
@@ -257,7 +325,7 @@ class AnnotationModule:
             s = [slice(None, None, None), slice(None, None, None), slice(None, None, None)]
             slice_num = [self.xyslice, self.xzslice, self.yzslice]
             s[self.current_axis] = slice_num[self.current_axis]
-            return s
+            return tuple(s)
 
     ##maybe add a remove slice annotated
     def add_slice_annotated(self):
@@ -311,6 +379,193 @@ class AnnotationModule:
     def annotation_image(self):
         return self.__annotation_image
 
+    def _new_annotation_image(self):
+        """
+        Empty annotation volume (-1 everywhere).
+
+        Notes:
+            Only the annotated planes are stored (see SparseAnnotationVolume), except with the shm storage backend,
+            where other server processes need the dense volume in shared memory.
+
+        """
+        shape = (self.zsize, self.ysize, self.xsize)
+
+        if data_repo.get_storage_backend() == "shm":
+            return np.full(shape, -1, dtype="int16")
+
+        return SparseAnnotationVolume(shape, dtype="int16", fill_value=-1)
+
+    def _store_annotation_image(self, annotation_image):
+        """
+        Replace the annotation volume.
+
+        Notes:
+            With the shm storage backend the volume is placed in shared memory under the "annotation" key, so other
+            server processes can serve its slices. In-place edits are then done directly over the shared segment.
+
+        Args:
+            annotation_image (np.ndarray | SparseAnnotationVolume): the new annotation volume
+
+        """
+        if data_repo.get_storage_backend() == "shm":
+            data_repo.set_image("annotation", np.asarray(annotation_image))
+            annotation_image = data_repo.get_image("annotation")
+
+        self.__annotation_image = annotation_image
+        self.mark_bulk_change()
+        self.touch()
+
+    def mark_bulk_change(self):
+        """
+        Discard the index of the planes holding each label, it's rebuilt from the annotated planes when needed, and mark
+        every plane as changed. This must be called after writes to the annotation volume that are not done by the 2D
+        drawing functions.
+
+        """
+        self._label_planes = None
+        self._plane_versions = {}
+        self._bulk_version = next(_annotation_versions)
+
+    def _label_index(self):
+        """
+        Index of the annotated planes that may hold each label, label -> set of (axis, slice).
+
+        Notes:
+            Drawings add their plane to the label drawn, planes are only checked (and dropped if the label isn't there
+            anymore) when the label is removed, so the index holds at least every annotated plane with the label.
+
+        """
+        if self._label_planes is None:
+            label_planes = defaultdict(set)
+            for axis, slice_nums in self.annotation_slice_dict.items():
+                for slice_num in slice_nums:
+                    for label in np.unique(self.__annotation_image[plane_index(axis, slice_num)]):
+                        if label >= 0:
+                            label_planes[int(label)].add((axis, slice_num))
+            self._label_planes = label_planes
+
+        return self._label_planes
+
+    def _plane_changed(self, get_slice, labels=(), bbox=None):
+        """
+        Mark the plane of get_slice as changed and add it to the index of each label drawn on it. The bbox
+        (row0, row1, col0, col1) of the changed pixels is added to the window changed by the last edit, see
+        changed_window.
+        """
+        axis = next(i for i, k in enumerate(get_slice) if isinstance(k, (int, np.integer)))
+        self._plane_versions[(axis, int(get_slice[axis]))] = next(_annotation_versions)
+
+        if bbox is not None:
+            previous = self._changed_windows.get((axis, int(get_slice[axis])), None)
+            if previous is not None:
+                bbox = (
+                    min(bbox[0], previous[0]), max(bbox[1], previous[1]),
+                    min(bbox[2], previous[2]), max(bbox[3], previous[3]),
+                )
+            self._changed_windows[(axis, int(get_slice[axis]))] = bbox
+
+        if self._label_planes is None:
+            return
+
+        for label in labels:
+            if label >= 0:
+                self._label_planes[int(label)].add((axis, int(get_slice[axis])))
+
+    def changed_window(self, axis: int, slice_num: int):
+        """
+        Window of a plane changed by the last edit, so only this window has to be sent to the frontend.
+
+        Notes:
+            An edit that first reverts the previous iteration (new_click=False) changes the union of both windows. A
+            change in a plane of another axis changes the line where it crosses this plane.
+
+        Args:
+            axis (int): 0 (XY), 1 (XZ) or 2 (YZ)
+            slice_num (int): the slice along the axis
+
+        Returns:
+            (tuple): (row0, row1, col0, col1) of the plane, or None if the last edit didn't change it
+
+        """
+        window = None
+
+        for (other_axis, other_slice), bbox in self._changed_windows.items():
+            # box of the change in the volume, then its intersection with the plane
+            ranges = [None] * 3
+            ranges[other_axis] = (other_slice, other_slice + 1)
+            dims = [i for i in range(3) if i != other_axis]
+            ranges[dims[0]], ranges[dims[1]] = bbox[0:2], bbox[2:4]
+
+            if not ranges[axis][0] <= slice_num < ranges[axis][1]:
+                continue
+
+            rows, cols = [ranges[i] for i in range(3) if i != axis]
+            if window is None:
+                window = (rows[0], rows[1], cols[0], cols[1])
+            else:
+                window = (
+                    min(window[0], rows[0]), max(window[1], rows[1]), min(window[2], cols[0]), max(window[3], cols[1])
+                )
+
+        return window
+
+    def _update_current_slice(self, window: tuple, mask, values):
+        """
+        Write a window of the current slice, only the window is copied and recorded for undo.
+
+        Args:
+            window (tuple): (row slice, col slice) of the current slice holding every pixel to change
+            mask (np.ndarray): bool mask of the pixels to change in the window, None to write the whole window
+            values (int | np.ndarray): value, or values of the masked pixels, to write
+
+        """
+        self.add_slice_annotated()
+        get_slice = self._get_current_slice_indexing()
+        window_index = list(get_slice)
+        window_index[[i for i in range(3) if i != self.current_axis][0]] = window[0]
+        window_index[[i for i in range(3) if i != self.current_axis][1]] = window[1]
+        window_index = tuple(window_index)
+
+        before = np.array(self.__annotation_image[window_index])
+        after = before.copy()
+        if mask is None:
+            after[...] = values
+        else:
+            after[mask] = values
+        self.__annotation_image[window_index] = after
+
+        entry = self.annotation_history.record([(get_slice, before, after, (window[0].start, window[1].start))])
+        bbox = entry.patches[0].bbox if entry.patches else None
+        self._plane_changed(get_slice, np.unique(after[after != before]), bbox)
+
+    def changed_planes(self, version):
+        """
+        Planes changed after an annotation version, so trainings can reuse what they extracted from the other planes.
+
+        Notes:
+            A plane crosses every plane of the other axes, a change in it also changes a line of each one of them.
+
+        Args:
+            version (int): annotation version, the value of self.version at that moment
+
+        Returns:
+            (set): (axis, slice) of the planes drawn after version, or None if the annotation volume was written as a
+            whole (loaded, thresholded, ...) after it, so any voxel may have changed
+
+        """
+        if version is None or self._bulk_version > version:
+            return None
+
+        return {plane for plane, plane_version in self._plane_versions.items() if plane_version > version}
+
+    def touch(self):
+        """
+        Change the annotation version, this must be called after any change in the annotation volume, so caches of its
+        slices are not used anymore.
+
+        """
+        self.version = next(_annotation_versions)
+
     def get_labels_object(self):
         return self.added_labels
 
@@ -325,40 +580,31 @@ class AnnotationModule:
 
         # updating the marker id, the remove label is considered an erase (of label) action
         self.order_markers.add(marker_id)
-
-        slices_coords_removed = []
-        # iteration through all the dict to get last label added equal to label_id coords
-        for axis, slice_nums in self.annotation_slice_dict.items():
-            for slice_num in slice_nums:
-                # Extract the appropriate slice along the given axis
-                annot_slice = np.take(self.__annotation_image, slice_num, axis=axis)
-                # Find where the label is located at
-                bool_mask = annot_slice == label_id
-
-                rr, cc = np.nonzero(bool_mask)
-                fixed_slice = np.zeros_like(rr)
-                fixed_slice[:] = slice_num
-                # Depending on the axis, build the coordinate tuples accordingly
-                if axis == 0:
-                    coords = (fixed_slice, rr, cc)
-                    slices_coords_removed.append(coords)
-                    self.__annotation_image[coords] = -1
-                elif axis == 1:
-                    coords = (fixed_slice, rr, cc)
-                    slices_coords_removed.append(coords)
-                    self.__annotation_image[coords] = -1
-                elif axis == 2:
-                    coords = (rr, cc, fixed_slice)
-                    slices_coords_removed.append(coords)
-                    self.__annotation_image[coords] = -1
-                else:
-                    raise ValueError(f"Unsupported axis: {axis}")
-        
-        self.annotation_history.append(['label_removed', slices_coords_removed, label_id])
+        self._changed_windows = dict()
+
+        slices_removed = []
+        # only the planes indexed with the label can hold it
+        for axis, slice_num in sorted(self._label_index().pop(label_id, ())):
+            get_slice = plane_index(axis, slice_num)
+            annot_slice = self.__annotation_image[get_slice]
+            # Find where the label is located at
+            label_mask = annot_slice == label_id
+            if not label_mask.any():
+                continue
+
+            before = annot_slice.copy()
+            annot_slice[label_mask] = -1
+            self.__annotation_image[get_slice] = annot_slice
+            slices_removed.append((get_slice, before, annot_slice))
+
+        entry = self.annotation_history.record(slices_removed, label=label_id)
+        for patch in entry.patches:
+            self._plane_changed(patch.get_slice, bbox=patch.bbox)
 
         # update the label list
         added_labels = [l for l in self.added_labels if l.id != label_id]
         self.added_labels = added_labels
+        self.touch()
 
         ###end###
 
@@ -366,7 +612,9 @@ class AnnotationModule:
         self.annotation_slice_dict = {0: set(), 1: set(), 2: set()}
         self.order_markers = set()
         self.added_labels = []
-        self.__annotation_image = (-1) * np.ones((self.zsize, self.ysize, self.xsize), dtype="int16")
+        self.annotation_history.clear()
+        self._store_annotation_image(self._new_annotation_image())
+        self._label_planes = defaultdict(set)
 
     def get_radius(self):
         return self.radius
@@ -392,35 +640,55 @@ class AnnotationModule:
         return valid_coords
 
     def undo(self):
+        self._changed_windows = dict()
         print("gonna undo ...", self.order_markers)
         if len(self.order_markers) > 0:
             marker_to_remove = max(self.order_markers)
             print("marker_to_remove", marker_to_remove)
             self.order_markers.remove(marker_to_remove)
             
-            if len(self.annotation_history) > 0:
-                # get last annoted coords
-                last_activity = self.annotation_history.pop()
-
-                # we need to tell the frontend that the label has returned
-                if 'label_removed' in last_activity:
-                    _ , slices_coords_removed, label_restored = last_activity
-                    for coords_removed in slices_coords_removed:
-                        self.__annotation_image[coords_removed] = label_restored
-                else:
-                    label_restored = -1
-                    get_slice, last_slice = last_activity
-                    self.__annotation_image[get_slice] = last_slice
-
-                return marker_to_remove, label_restored
+            # the last edit is written back, if it was a label removal we need to tell the frontend that the label
+            # has returned
+            last_activity = self.annotation_history.undo(self.__annotation_image, marker_to_remove)
+            if last_activity is not None:
+                for patch in last_activity.patches:
+                    self._plane_changed(patch.get_slice, np.unique(patch.content(undo=True)), patch.bbox)
+                self.touch()
+                return marker_to_remove, last_activity.label
         return None, -1
 
+    def redo(self):
+        """
+        Apply again the last edit reverted by undo, new edits discard the edits to redo.
+
+        Returns:
+            (tuple): the marker id given back and the label removed again by the edit (-1 if it was a drawing)
+
+        """
+        self._changed_windows = dict()
+        last_activity = self.annotation_history.redo(self.__annotation_image)
+        if last_activity is None:
+            return None, -1
+
+        for patch in last_activity.patches:
+            self._plane_changed(patch.get_slice, np.unique(patch.content(undo=False)), patch.bbox)
+
+        if last_activity.marker_id is not None:
+            self.order_markers.add(last_activity.marker_id)
+
+        if last_activity.label >= 0:
+            self.added_labels = [l for l in self.added_labels if l.id != last_activity.label]
+
+        self.touch()
+        return last_activity.marker_id, last_activity.label
+
     @property
     def current_mk_id(self):
         marker_id = max(self.order_markers) + 1 if self.order_markers else 1
         return marker_id
 
     def labelmask_update(self, label_mask, marker_lb, marker_id, new_click):
+        self._changed_windows = dict()
 
         # Undo previous iteration        
         if new_click == False:
@@ -430,16 +698,19 @@ class AnnotationModule:
         self.order_markers.add(marker_id)
 
         if label_mask.ndim == 2:
-            # Get the coordinates where the mask is non-zero to draw
-            self.add_slice_annotated()
-            get_slice = self._get_current_slice_indexing()
-            self.annotation_history.append([get_slice, self.__annotation_image[get_slice].copy()])
-            self.__annotation_image[get_slice][label_mask] = marker_lb
+            # only the bounding box of the mask is copied and written
+            window = _mask_window(label_mask)
+            self._update_current_slice(window, label_mask[window], marker_lb)
 
         else:
             self.__annotation_image[label_mask] = marker_lb
+            self.mark_bulk_change()
+
+        self.touch()
 
     def multilabel_updated(self, new_annot, marker_id, new_click = True, annot_mask = None):
+        self._changed_windows = dict()
+
         #if there are no changes do nothing
         if annot_mask is not None and not annot_mask.any():
             return
@@ -452,13 +723,16 @@ class AnnotationModule:
         self.order_markers.add(marker_id)
 
         if new_annot.ndim == 2:
-            # Get the coordinates where the mask is non-zero to draw
-                self.add_slice_annotated()
-                get_slice = self._get_current_slice_indexing()
-                self.annotation_history.append([get_slice, self.__annotation_image[get_slice].copy()])
-                self.__annotation_image[get_slice] = new_annot
+            # only the bounding box of the changed pixels is copied and written, when they're given
+                if annot_mask is not None:
+                    window = _mask_window(annot_mask)
+                    self._update_current_slice(window, annot_mask[window], new_annot[window][annot_mask[window]])
+                else:
+                    window = (slice(0, new_annot.shape[0]), slice(0, new_annot.shape[1]))
+                    self._update_current_slice(window, None, new_annot)
+                self.touch()
         else:
-            self.__annotation_image = new_annot
+            self._store_annotation_image(new_annot)
 
     def draw_marker_curve(self, cursor_coords, marker_id, marker_lb, erase=False):
 
@@ -466,77 +740,26 @@ class AnnotationModule:
         ## Updating the markers with the current marker id ##
         self.order_markers.add(marker_id)
 
-        ### Creating the mask in the size of the brush ###
-        radius = self.radius
-        size = 2 * radius + 1
-        disk_mask = np.zeros((size, size), dtype=np.bool_)
-        rr, cc = draw.disk((radius, radius), radius)
-        disk_mask[rr, cc] = True
-
-        ### Create a mask image for adding the drawings ###
-        width, height = self.get_current_slice_shape()
-        pencil_drawing_bool = np.zeros((width, height), dtype=np.bool_)
-
-        for coord in cursor_coords:
-            # check if its valid coord, invert for y (or z),x mode. Coord inputs are in x,y (or z).
-            if self.valid_coords(coord[::-1]):
-                y, x = list(map(int, np.floor(coord)))
-                # ensure the drawing of the disk is within the image range
-                x_start = max(0, x - radius)
-                y_start = max(0, y - radius)
-                x_end = min(width, x + radius + 1)
-                y_end = min(height, y + radius + 1)
-
-                mask_x_start = radius - (x - x_start)
-                mask_y_start = radius - (y - y_start)
-                mask_x_end = radius + (x_end - x)
-                mask_y_end = radius + (y_end - y)
-
-                # make the drawing
-                pencil_drawing_bool[x_start:x_end, y_start:y_end] += disk_mask[mask_x_start:mask_x_end, mask_y_start:mask_y_end]
+        ### Create a mask image with the stroke, coord inputs are in x,y (or z) ###
+        points = np.flip(np.reshape(np.asarray(cursor_coords, dtype=np.float64), (-1, 2)), axis=1)
+        # only the bounding box of the stroke is copied and written
+        pencil_drawing_bool, window = stroke.rasterize_window(points, self.radius, self.get_current_slice_shape())
 
         if erase:
             marker_lb = -1
 
-        self.add_slice_annotated()
-        get_slice = self._get_current_slice_indexing()
-        self.annotation_history.append([get_slice, self.__annotation_image[get_slice].copy()])
-        self.__annotation_image[get_slice][pencil_drawing_bool] = marker_lb
+        self._changed_windows = dict()
+        self._update_current_slice(window, pencil_drawing_bool, marker_lb)
+        self.touch()
 
         # print('draw backend time {}'.format(time()-start))
 
     def draw_init_levelset(self, cursor_coords):
         #same as funtion of draw_marker_curve, excpet it returns the bool image array
 
-        ### Creating the mask in the size of the brush ###
-        radius = 3
-        size = 2 * radius + 1
-        disk_mask = np.zeros((size, size), dtype=np.bool_)
-        rr, cc = draw.disk((radius, radius), radius)
-        disk_mask[rr, cc] = True
-
-        ### Create a mask image for adding the drawings ###
-        height, width = self.get_current_slice_shape()
-        image = np.zeros((height, width), dtype=np.bool_)
-        #print(image.shape)
-        for coord in cursor_coords:
-            # check if its valid coord, invert for y (or z),x mode. Coord inputs are in x,y (or z).
-            if self.valid_coords(coord):
-                x, y = list(map(int, np.floor(coord)))
-                # ensure the drawing of the disk is within the image range
-                x_start = max(0, x - radius)
-                y_start = max(0, y - radius)
-                x_end = min(height, x + radius + 1)
-                y_end = min(width, y + radius + 1)
-
-                mask_x_start = radius - (x - x_start)
-                mask_y_start = radius - (y - y_start)
-                mask_x_end = radius + (x_end - x)
-                mask_y_end = radius + (y_end - y)
-
-                # make the drawing
-                image[x_start:x_end, y_start:y_end] += disk_mask[mask_x_start:mask_x_end, mask_y_start:mask_y_end]
-        
+        ### Create a mask image with the stroke, with a brush of radius 3 ###
+        image = stroke.rasterize(cursor_coords, 3, self.get_current_slice_shape())
+
         return image
 
     def get_annotation_slice_dict(self):
@@ -549,6 +772,7 @@ class AnnotationModule:
     
     def set_annotation_slice_dict(self, annotation_slice_dict):
         self.annotation_slice_dict = annotation_slice_dict
+        self.mark_bulk_change()
         
     def get_annotation_coords(self):
 
@@ -592,68 +816,27 @@ class AnnotationModule:
         return (z_all, y_all, x_all), annotation_labels
 
     def set_annotation_from_coords(self, annotation_coords, annotation_labels):
+        if isinstance(self.__annotation_image, SparseAnnotationVolume):
+            # the coordinates lie on the annotated planes, store them first so the volume is kept sparse
+            for axis, slice_nums in self.annotation_slice_dict.items():
+                for slice_num in slice_nums:
+                    self.__annotation_image.add_plane(axis, slice_num)
+
         self.__annotation_image[annotation_coords] = annotation_labels
+        self.mark_bulk_change()
+        self.touch()
 
     def set_annotation_from_dict(self, annotation_dict):
-        for coord3D, marker_lb in annotation_dict.items():
-            marker_lb = marker_lb[0]
-            self.__annotation_image[coord3D] = marker_lb
-
         """
-        Extract slices by vectorizing the counting of unique values along each axis.
-        This function converts the coordinates into a NumPy array and uses np.unique 
-        to count how many times each value appears for each axis among the remaining points.
-        
-        At each iteration:
-        - For each axis, compute the unique values and their counts from the remaining points.
-        - Identify the (axis, value) pair with the highest count.
-        - Add that value to the slices dictionary for that axis.
-        - Eliminate all points with that value along the selected axis.
+        Load the old annotation format, a dict of 3D coordinate -> (label, marker). The annotated slices are rebuilt as
+        a small set of planes that covers all the coordinates, then the coordinates are written at once.
         """
-        coords = list(annotation_dict.keys())
-        remaining = coords.copy()
-        annotation_slice_dict = {0: set(), 1: set(), 2: set()}
-        # Convert the list of coordinates to a NumPy array
-        arr = np.array(coords)
-        print(arr)
-        print(arr.shape)
-        
-        # Initialize the output dictionary
-        annotation_slice_dict = {0: set(), 1: set(), 2: set()}
-        
-        # Create a boolean mask for points that are still remaining (True means the point is not yet eliminated)
-        mask = np.ones(arr.shape[0], dtype=bool)
-        
-        while np.any(mask):
-            best_axis = None
-            best_value = None
-            best_count = 0
-            
-            # Evaluate each axis vectorized over the current (remaining) points
-            for axis in range(3):
-                # Extract the values for the current axis from remaining points
-                current_values = arr[mask, axis]
-                # Get unique values and their counts
-                uniq, counts = np.unique(current_values, return_counts=True)
-                if counts.size > 0:
-                    idx = np.argmax(counts)
-                    # Check if this axis/value pair is the best so far
-                    if counts[idx] > best_count:
-                        best_count = counts[idx]
-                        best_axis = axis
-                        best_value = uniq[idx]
-            
-            # If no valid best slice is found, break out of the loop
-            if best_axis is None:
-                break
-            
-            # Record the slice (axis and its value)
-            annotation_slice_dict[best_axis].add(best_value)
-            # Update the mask: remove all points that have best_value on best_axis
-            mask = mask & (arr[:, best_axis] != best_value)
-        
-        self.annotation_slice_dict = annotation_slice_dict
-            
+        coords = np.array(list(annotation_dict.keys()), dtype=np.int64).reshape(-1, 3)
+        labels = np.fromiter((marker_lb[0] for marker_lb in annotation_dict.values()), dtype=np.int16, count=len(coords))
+
+        self.annotation_slice_dict = _greedy_slice_cover(coords, self.__annotation_image.shape)
+        self.set_annotation_from_coords(tuple(coords.T), labels)
+
     def set_annotation_image(self, annotation_image):
-        self.__annotation_image = annotation_image
+        self._store_annotation_image(annotation_image)
 
@@ -13,6 +13,7 @@ import pickle
 import shutil
 import time
 from abc import abstractmethod
+from itertools import zip_longest
 from pathlib import Path
 
 import joblib
@@ -54,6 +55,8 @@ __adaboost_params__ = {"n_estimators": [10**i for i in range(1, 3)]}
 
 __max_mem_usage__ = int(512 * 1024**3)
 __max_available_mem_usage_percentage__ = 0.8
+# rows of features standardized at once, small enough to stay in the CPU caches
+__feat_scaling_chunk_bytes__ = 4 * 1024**2
 
 def create_classifier(classifier, **params):
     # classifiers that do NOT support warm_start
@@ -80,6 +83,11 @@ def create_classifier(classifier, **params):
         raise Exception("Invalid classifier")
 
 
+# Training data extracted from each block of annotated slices by the last train. Segmentation modules are created again
+# on every train, the blocks are kept here so the next train only extracts what the annotations changed since then.
+_training_blocks = {"key": None, "annotation_version": None, "blocks": {}}
+
+
 # from profilehooks import timecall
 # from decorate_all_methods import decorate_all_methods
 from sklearn import metrics
@@ -261,6 +269,101 @@ class ClassifierSegmentationModule(SegmentationModule):
         key = key + "_"
         return dict(((k[len(key) :], val) for k, val in parameters.items() if k.startswith(key)))
 
+    @staticmethod
+    def _annotated_blocks(annotation_slice_dict):
+        """
+        Split the annotated slices of each axis in blocks of consecutive slices, the blocks of the axes are interleaved.
+
+        Args:
+            annotation_slice_dict (dict): axis -> annotated slice indices
+
+        Returns:
+            (list): (axis, tuple of slice indices) of each block
+
+        """
+        axis_blocks = {}
+        for axis, indices in annotation_slice_dict.items():
+            blocks = []
+            for idx in sorted(indices):
+                if blocks and idx == blocks[-1][-1] + 1:
+                    blocks[-1].append(idx)
+                else:
+                    blocks.append([idx])
+            axis_blocks[axis] = blocks
+
+        axes = sorted(axis_blocks)
+        interleaved_blocks = []
+        for group in zip_longest(*[axis_blocks[axis] for axis in axes], fillvalue=None):
+            for axis, block in zip(axes, group):
+                if block is not None:
+                    interleaved_blocks.append((axis, tuple(block)))
+
+        return interleaved_blocks
+
+    @staticmethod
+    def _block_index(axis, block):
+        if axis not in (0, 1, 2):
+            raise ValueError(f"Invalid axis {axis}")
+
+        index = [slice(None)] * 3
+        index[axis] = list(block)
+        return tuple(index)
+
+    @staticmethod
+    def _feature_halo(sigmas):
+        """
+        Number of slices around a block that change its features, the footprint of the largest sigma.
+        """
+        if len(sigmas) == 0:
+            return 1
+
+        return int(math.ceil(4 * float(np.max(sigmas)))) + 1
+
+    @staticmethod
+    def _previous_training_blocks(key, annotation_module=None):
+        """
+        Get the training data of the blocks extracted by the last train with the same key.
+
+        Args:
+            key (tuple): blocks are only reused under the same key (image version, feature parameters, ...), nothing is
+                reused if it's None
+            annotation_module (AnnotationModule): module of the annotation trained, if None every plane is taken as
+                changed
+
+        Returns:
+            (tuple): dict of (axis, block) -> block data, and the planes changed since the last train (None if any voxel
+            may have changed)
+
+        """
+        if key is None or _training_blocks["key"] != key:
+            return {}, None
+
+        if annotation_module is None:
+            return _training_blocks["blocks"], None
+
+        return _training_blocks["blocks"], annotation_module.changed_planes(_training_blocks["annotation_version"])
+
+    @staticmethod
+    def _keep_training_blocks(key, blocks, annotation_version):
+        """
+        Keep the training data of the blocks of this train, replacing the blocks of the last one.
+        """
+        global _training_blocks
+        if key is None:
+            _training_blocks = {"key": None, "annotation_version": None, "blocks": {}}
+        else:
+            _training_blocks = {"key": key, "annotation_version": annotation_version, "blocks": blocks}
+
+    @staticmethod
+    def _block_changed(axis, block, changed_planes):
+        """
+        Check if the annotation of a block changed, a changed plane of another axis crosses every block.
+        """
+        if changed_planes is None:
+            return True
+
+        return any(plane_axis != axis or plane_slice in block for plane_axis, plane_slice in changed_planes)
+
     # does not implement load label capability
     def load_label(self, label):
         pass
@@ -283,9 +386,6 @@ class ClassifierSegmentationModule(SegmentationModule):
 
             logging.debug("-- Computing feature scaling parameters from training data")
 
-            if self._training_features.shape != self._training_features_raw.shape:
-                self._training_features = np.array(self._training_features_raw, dtype="float32")
-
             sentry_sdk.set_context(
                 "Feature params",
                 {"dtype": self._training_features_raw.dtype, "shape": self._training_features_raw.shape},
@@ -298,12 +398,8 @@ class ClassifierSegmentationModule(SegmentationModule):
                 with parallel_backend("threading"):
                     self._feat_scaler = StandardScaler()
                     self._feat_scaler.fit(self._training_features_raw)
-                    spin_feat_extraction.spin_standardize_feature_vectors(
-                        self._training_features_raw,
-                        self._training_features,
-                        self._feat_scaler.mean_,
-                        self._feat_scaler.scale_,
-                    )
+                    # the raw features are kept unscaled, they are saved with the training data
+                    self._training_features = self._scale_feats(self._training_features_raw)
                     # self._training_features = self._feat_scaler.fit_transform(self._training_features_raw)
                     logging.debug("training labels raw: {}".format(self._training_labels_raw))
                     self._training_labels = np.array(self._training_labels_raw)
@@ -359,12 +455,8 @@ class ClassifierSegmentationModule(SegmentationModule):
 
         if classifier_trained:
             logging.debug("--> Completed")
-
-        print("[DEBUG] Scaled stats:",
-            "min:", X.min(),
-            "max:", X.max(),
-            "mean:", X.mean(),
-            "std:", X.std())
+            if len(self._training_labels_raw) > 0:
+                functions.log_feature_stats("Scaled training features", self._training_features)
 
         return classifier_trained, training_time, selected_features_names
 
@@ -563,17 +655,24 @@ class ClassifierSegmentationModule(SegmentationModule):
             self._generic_batch_classify(X, self._model, prediction, nsamples_step)
         return prediction
 
-    def _predict_labels(self, features):
+    def _predict_labels(self, features, channels_first=False, overwrite=False):
+        """
+        Predict the labels of the features with the trained model.
+
+        Args:
+            features (np.ndarray): (N, nfeats) features, or (nfeats, N) if channels_first
+            channels_first (bool): whether the features are (nfeats, N), as the pixel features are extracted
+            overwrite (bool): whether the features can be scaled in place, they're not used by the caller anymore
 
+        Returns:
+            (tuple): the labels predicted and the time of each step
+
+        """
         feat_scaling_start = time.time()
-        X_scaled = self._scale_feats(features)
+        X_scaled = self._scale_feats(features, channels_first=channels_first, overwrite=overwrite)
+
+        functions.log_feature_stats("Scaled features", X_scaled)
 
-        print("[DEBUG] Scaled stats:",
-            "min:", X_scaled.min(),
-            "max:", X_scaled.max(),
-            "mean:", X_scaled.mean(),
-            "std:", X_scaled.std())
-        
         feat_scaling_end = time.time()
         feat_scaling_time = feat_scaling_end - feat_scaling_start
 
@@ -901,19 +1000,44 @@ class ClassifierSegmentationModule(SegmentationModule):
             if self._parent is not None:
                 self._parent.seng_gui_message(title, msg, msg_type)
 
-    def _scale_feats(self, feats):
-        if self._feat_scaler is not None:
-            logging.debug("-- Scaling features for prediction from training")
-            logging.debug("--- Copying features {} {}".format(feats.shape, feats.dtype))
-            X_scaled = np.empty(feats.shape, feats.dtype)
-            spin_feat_extraction.spin_standardize_feature_vectors(
-                feats, X_scaled, self._feat_scaler.mean_, self._feat_scaler.scale_
-            )
+    def _scale_feats(self, feats, channels_first=False, overwrite=False):
+        """
+        Standardize features with the scaler fitted on the training features, in float32.
 
-            # logging.debug('feats: ', X_scaled[0,...], X_scaled[1,...])
-        else:
+        Notes:
+            Rows are scaled in chunks of __feat_scaling_chunk_bytes__, written straight into the (N, nfeats) C
+            contiguous float32 array the classifiers read, so no other copy of the features is made.
+
+        Args:
+            feats (np.ndarray): (N, nfeats) features, or (nfeats, N) if channels_first
+            channels_first (bool): whether the features are (nfeats, N)
+            overwrite (bool): whether the features can be scaled in place, only if they are already (N, nfeats) C
+                contiguous float32
+
+        Returns:
+            (np.ndarray): (N, nfeats) scaled features
+
+        """
+        if self._feat_scaler is None:
             logging.debug("-- WARNING: Using features without scaling since no feature scaler was available")
-            X_scaled = feats
+            return feats.T if channels_first else feats
+
+        logging.debug("-- Scaling features for prediction from training")
+
+        nfeats, nsamples = feats.shape if channels_first else feats.shape[::-1]
+        in_place = overwrite and not channels_first and feats.dtype == np.float32 and feats.flags.c_contiguous
+        X_scaled = feats if in_place else np.empty((nsamples, nfeats), dtype=np.float32)
+        logging.debug("--- Scaling features {} {} {}".format(feats.shape, feats.dtype, "in place" if in_place else ""))
+
+        mean = self._feat_scaler.mean_.astype(np.float32)
+        scale = self._feat_scaler.scale_.astype(np.float32)
+
+        chunk = max(1, __feat_scaling_chunk_bytes__ // max(1, nfeats * 4))
+        for i in range(0, nsamples, chunk):
+            last_i = min(nsamples, i + chunk)
+            rows = feats[:, i:last_i].T if channels_first else feats[i:last_i]
+            np.subtract(rows, mean, out=X_scaled[i:last_i])
+            np.divide(X_scaled[i:last_i], scale, out=X_scaled[i:last_i])
 
         return X_scaled
 
@@ -965,28 +1089,27 @@ class ClassifierSegmentationModule(SegmentationModule):
         selected_supervoxel_feat_pooling = self._feature_extraction_params["selected_supervoxel_feat_pooling"]
 
         feats_per_sigma = intensity + edges + texture + shape_index + lbp 
-        
-        if superpixel:
-                output_mean = int("mean" in selected_supervoxel_feat_pooling)
-                output_min = int("min" in selected_supervoxel_feat_pooling)
-                output_max = int("max" in selected_supervoxel_feat_pooling)
-                
-                feats_per_sigma = feats_per_sigma * (output_max + output_mean + output_min)
-
 
         nsigmas = len(self._feature_extraction_params["sigmas"])
 
-        total_features = feats_per_sigma * nsigmas
-
-        nsuperpixels = self.max_superpixel_label
+        # a split extraction also reads a halo of slices around each block, see _feature_halo
+        halo = self._feature_halo(self._feature_extraction_params["sigmas"])
+        num_voxels = self._image.size + 2 * halo * (self._image.size // max(1, self._image.shape[0]))
 
-      
         sizeof_float = np.dtype("float32").itemsize
+        # features of each voxel, the superpixel features are pooled from them.
         # Multiplying by 2 due to the
+        memory = 2 * num_voxels * feats_per_sigma * nsigmas * sizeof_float
+
         if superpixel:
-            memory = 2 * nsuperpixels * total_features * sizeof_float
-        else:
-            memory = 2 * self._image.size * total_features * sizeof_float
+                output_mean = int("mean" in selected_supervoxel_feat_pooling)
+                output_min = int("min" in selected_supervoxel_feat_pooling)
+                output_max = int("max" in selected_supervoxel_feat_pooling)
+
+                total_features = feats_per_sigma * (output_max + output_mean + output_min) * nsigmas
+                nsuperpixels = self.max_superpixel_label
+
+                memory += 2 * nsuperpixels * total_features * sizeof_float
 
         return memory
 
@@ -1,9 +1,12 @@
 import gc
+import json
 import logging
 import math
 import os.path
 import pickle
+import queue
 import shutil
+import threading
 import time
 from operator import itemgetter
 from pathlib import Path
@@ -17,7 +20,7 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.utils import assert_all_finite, parallel_backend
 from sscAnnotat3D import aux_functions as functions
-from sscAnnotat3D import progressbar, utils
+from sscAnnotat3D import jobs, progressbar, utils
 
 from .classifier_segmentation_module import ClassifierSegmentationModule
 
@@ -31,9 +34,12 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
         auto_save=False,
         workspace=os.path.join(Path.home().absolute().as_posix(), "workspace_Annotat3D"),
         parent=None,
+        **kwargs
     ):
 
         super().__init__(image, auto_save, workspace, parent)
+        # version of the image in data_repo, the training features of each annotated block are kept under it
+        self._image_version = kwargs.get("image_version", None)
 
         self._superpixel_params["pixel_segmentation"] = True
 
@@ -50,8 +56,10 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
     def _classify_pixels(self, pixel_map):
         start = time.time()
         nfeats, z, y, x = pixel_map.shape
-        pixel_features = pixel_map.reshape((nfeats, z * y * x)).T
-        prediction, prediction_times = self._predict_labels(pixel_features)
+        # scaled straight into the (N, nfeats) layout of the classifier
+        prediction, prediction_times = self._predict_labels(
+            pixel_map.reshape((nfeats, z * y * x)), channels_first=True
+        )
         end = time.time()
         test_time = end - start
         start_assignment = time.time()
@@ -65,18 +73,22 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
         self,
         annotation_slice_dict: dict[int, list[int]],
         annotation_image: np.ndarray,
+        annotation_module=None,
     ) -> tuple[np.ndarray, np.ndarray]:
         """
         Extract pixel-level features in consecutive slice blocks across axes.
 
+        Only the blocks changed since the last train are read again (see AnnotationModule.changed_planes), and their
+        features are only extracted again if voxels that weren't annotated in the last train are annotated now.
+
         Parameters
         ----------
-        img : np.ndarray
-            Input image (3D).
         annotation_slice_dict : dict[int, list[int]]
             Dict mapping axis -> list of annotated slice indices.
         annotation_image : np.ndarray
             Label image (same shape as img).
+        annotation_module : AnnotationModule, optional
+            Module of the annotation, its changed planes tell which blocks to read again. If None, every block is read.
 
         Returns
         -------
@@ -86,71 +98,48 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
             Corresponding labels, shape (N_pixels,).
         """
 
-        # --- helper: split consecutive indices into blocks
-        def consecutive_blocks(indices):
-            blocks, block = [], []
-            for i, idx in enumerate(indices):
-                if i == 0 or idx == indices[i - 1] + 1:
-                    block.append(idx)
-                else:
-                    blocks.append(block)
-                    block = [idx]
-            if block:
-                blocks.append(block)
-            return blocks
-
-
-
-        # --- prepare blocks per axis
-        axis_indices = {axis: sorted(indices) for axis, indices in annotation_slice_dict.items()}
-        axis_blocks = {axis: consecutive_blocks(idxs) for axis, idxs in axis_indices.items()}
-
-        # --- round-robin interleave of blocks
-        from itertools import zip_longest
-        interleaved_blocks = []
-        for group in zip_longest(*[axis_blocks[a] for a in sorted(axis_blocks)], fillvalue=None):
-            for axis, block in enumerate(group):
-                if block is not None:
-                    interleaved_blocks.append((axis, block))
-
-        print(interleaved_blocks)
-        print(annotation_slice_dict)
-        # --- feature + label accumulation
-        X_all, Y_all = [], []
-
-        for axis, block in interleaved_blocks:
+        key = self._training_blocks_key()
+        annotation_version = annotation_module.version if annotation_module is not None else None
+        previous_blocks, changed_planes = self._previous_training_blocks(key, annotation_module)
+
+        # --- features + labels of the annotated voxels of each block
+        blocks = {}
+        num_extracted = 0
+
+        for axis, block in self._annotated_blocks(annotation_slice_dict):
+            previous = previous_blocks.get((axis, block), None)
+
+            if previous is not None and not self._block_changed(axis, block, changed_planes):
+                blocks[(axis, block)] = previous
+                continue
+
             # build a block (can be >1 slices if consecutive)
-            if axis == 0:
-                image_block = self.image[block, :, :]
-                label = annotation_image[block, :, :]
-            elif axis == 1:
-                image_block = self.image[:, block, :]
-                label = annotation_image[:, block, :]
-            elif axis == 2:
-                image_block = self.image[:, :, block]
-                label = annotation_image[:, :, block]
-            else:
-                raise ValueError(f"Invalid axis {axis}")
+            index = self._block_index(axis, block)
+            label = np.asarray(annotation_image[index]).ravel()
+            coords = np.flatnonzero(label >= 0)
 
-            # reshape into (1, Y, X) style
-            if image_block.ndim == 2:
-                image_block = image_block.reshape(1, *image_block.shape)
+            X = None
+            if previous is not None:
+                # features of the voxels annotated in the last train didn't change
+                rows = np.searchsorted(previous["coords"], coords)
+                if (rows < previous["coords"].size).all() and np.array_equal(previous["coords"][rows], coords):
+                    X = previous["X"][rows]
 
-            # feature extraction
-            features = functions.pixel_feature_extraction(image_block, **self._feature_extraction_params)
+            if X is None:
+                features = functions.pixel_feature_extraction(self.image[index], **self._feature_extraction_params)
+                # (N_pixels_block, num_features) of the annotated voxels
+                X = features.reshape(features.shape[0], -1)[:, coords].T
+                num_extracted += 1
 
-            # flatten block features + labels
-            X_all.append(features.reshape(features.shape[0], -1).T)  # (N_pixels_block, num_features)
-            Y_all.append(label.ravel())                              # (N_pixels_block,)
+            blocks[(axis, block)] = {"coords": coords, "X": X, "Y": label[coords]}
+
+        logging.debug("Features extracted for {} of {} annotated blocks".format(num_extracted, len(blocks)))
 
         # --- concatenate everything
-        X_all = np.vstack(X_all)
-        Y_all = np.hstack(Y_all)
+        X_all = np.vstack([block_data["X"] for block_data in blocks.values()])
+        Y_all = np.hstack([block_data["Y"] for block_data in blocks.values()])
 
-        # --- mask unlabeled pixels
-        valid_mask = Y_all >= 0
-        X_all = X_all[valid_mask]
-        Y_all = Y_all[valid_mask]
+        self._keep_training_blocks(key, blocks, annotation_version)
 
         self._training_features = X_all
         self._training_features_raw = X_all
@@ -158,7 +147,17 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
         
         return X_all, Y_all
 
-    def train(self, annotation_slice_dict, annotation_image, finetune: bool = False):
+    def _training_blocks_key(self):
+        if self._image_version is None:
+            return None
+
+        return (
+            self._module_name,
+            self._image_version,
+            json.dumps(self._feature_extraction_params, sort_keys=True, default=str),
+        )
+
+    def train(self, annotation_slice_dict, annotation_image, finetune: bool = False, annotation_module=None):
         """
         Train the pixel classifier on the provided annotations.
         Stores the trained classifier and feature set in this object.
@@ -167,12 +166,14 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
             annotation_slice_dict (dict): annotation slices
             annotation_image (ndarray): full annotation image
             finetune (bool): whether to fine-tune an already trained classifier
+            annotation_module (AnnotationModule): module of the annotation, so only the blocks changed since the last
+                train are extracted again
         """
         with sentry_sdk.start_transaction(name="Pixel Segmentation Train", op="pixel classification") as t:
             if len(annotation_slice_dict) <= 0:
                 return None, []
 
-            _,_ = self.extract_pixel_features_in_blocks(annotation_slice_dict, annotation_image)
+            _,_ = self.extract_pixel_features_in_blocks(annotation_slice_dict, annotation_image, annotation_module)
 
             # train classifier
             with sentry_sdk.start_span(op="Training classifier"):
@@ -182,7 +183,9 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
             # === NEW: keep track of full state for saving ===
             self._classifier_trained = classifier_trained
             self._selected_features_names = selected_features_names
-            self._training_labels = annotation_image.ravel()   # or better: the labels actually passed to _train_classifiermes
+            # labels of the annotated voxels, plus -1 (not annotated) as the whole annotation volume had, without
+            # reading the volume again
+            self._training_labels = np.append(np.unique(self._training_labels_raw), -1)
 
             return classifier_trained, selected_features_names
 
@@ -309,30 +312,28 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
                     if features is None:
                         logging.debug("\n\n**** Extracting features for the entire image IN BLOCKS ****")
 
-                        block_size = max(1, math.ceil(image.shape[0] // memory_splitting_factor))
-                        logging.debug("**** Splitting image into blocks of %d slices" % block_size)
+                        # blocks in memory at once: the one classified, the ones queued and the one being extracted
+                        depth = utils.execute_pipeline_depth()
+                        blocks_in_flight = depth + 2 if depth > 0 else 1
+                        block_slices = image.shape[0] // (memory_splitting_factor * blocks_in_flight)
+                        # each block is extracted with a halo of slices on both sides, see _feature_blocks
+                        halo = self._feature_halo(self._feature_extraction_params.get("sigmas", []))
+                        block_size = max(halo, block_slices - 2 * halo, 1)
+                        logging.debug("**** Splitting image into blocks of %d slices, halo of %d slices" % (block_size, halo))
 
                         features_shape = np.zeros(2, dtype="int")
                         nblocks = 0
 
-                        for z in range(0, image.shape[0], block_size):
-                            z1 = min(image.shape[0], z + block_size)
+                        for z, z1, features_block, extraction_time in self._feature_blocks(image, block_size):
+                            jobs.check_cancelled()
                             logging.debug("**** Processing block (%d:%d)" % (z, z1 - 1))
 
-                            image_block = image[z:z1]
-                            start_feature_extraction_time = time.time()
-
-                            features_block = functions.pixel_feature_extraction(image_block, **self._feature_extraction_params)
-
-
-                            end_feature_extraction_time = time.time()
-
                             pred[z:z1], assignment, test, predict_times = self._classify_pixels(features_block)
 
-                            feature_extraction_time += end_feature_extraction_time - start_feature_extraction_time
+                            feature_extraction_time += extraction_time
                             test_time += test
                             assignment_time += assignment
-                            cur_block_size = image_block.shape[0]
+                            cur_block_size = z1 - z
                             # I don't know why this was previously done like this, but it was bugged.
                             #features_shape += np.array(features_block.shape, dtype="int") * cur_block_size
                             if len(total_predict_times) == 0:
@@ -387,6 +388,77 @@ class PixelSegmentationModule(ClassifierSegmentationModule):
             mainbar.reset()
             return pred, self._feature_extraction_params
 
+    def _feature_blocks(self, image, block_size):
+        """
+        Extract the pixel features of the image in blocks of slices (axis 0). The extraction runs in a thread up to
+        utils.execute_pipeline_depth() blocks ahead of the caller, so the next blocks are extracted while the current
+        one is classified.
+
+        Each block is extracted with a halo of slices for the largest sigma (see _feature_halo) and cropped, so
+        splitting the image in more blocks doesn't add seams to the features.
+
+        Args:
+            image (np.ndarray): the image
+            block_size (int): number of slices of each block
+
+        Yields:
+            (tuple): first and last (exclusive) slice of the block, its features and the feature extraction time
+
+        """
+        blocks = [(z, min(image.shape[0], z + block_size)) for z in range(0, image.shape[0], block_size)]
+        depth = utils.execute_pipeline_depth()
+
+        # slices read around each block so the filters see the same neighbourhood as in the whole image
+        halo = self._feature_halo(self._feature_extraction_params.get("sigmas", []))
+
+        def extract(z, z1):
+            start = time.time()
+            r0, r1 = max(0, z - halo), min(image.shape[0], z1 + halo)
+            features = functions.pixel_feature_extraction(image[r0:r1], **self._feature_extraction_params)
+            # a copy of the block, so the features of the halo are freed before it's queued
+            features_block = np.ascontiguousarray(features[:, z - r0 : z1 - r0])
+            del features
+            return z, z1, features_block, time.time() - start
+
+        if depth == 0:
+            for z, z1 in blocks:
+                yield extract(z, z1)
+            return
+
+        ready = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for z, z1 in blocks:
+                    if stop.is_set() or not put(extract(z, z1)):
+                        return
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, name="pixel-feature-extraction", daemon=True)
+        producer.start()
+
+        try:
+            for _ in blocks:
+                item = ready.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # the caller stopped early (cancelled job or error), the producer is left waiting on the queue
+            stop.set()
+            producer.join()
+
     def has_preview(self):
         """
         This function always return True and represents that an image have a preview
@@ -0,0 +1,454 @@
+"""
+This script contains the sparse annotation volume used by the AnnotationModule.
+
+Annotations are drawn on a few slices, so instead of a dense int16 volume filled with -1, only the annotated planes are
+stored, keyed by (axis, slice). Voxels outside the stored planes are -1. Planes of different axes intersect on a line,
+writes to a plane are copied to the intersecting lines of the other planes, so every stored plane is always up to date.
+
+The volume can be indexed like the dense np.ndarray it replaces:
+
+    - a slice along an axis, with optional windows on the other axes (e.g. vol[10], vol[:, 5, 100:200]), is read and
+      written as a plane. Reads return a copy, so in-place edits must be written back (vol[index] = edited_slice)
+    - a list of slices along an axis (e.g. vol[:, [3, 4, 5], :]) is read as a stack of planes
+    - a sub-volume read with slices (e.g. vol[10:20, :, 30:40]) returns a cropped SparseAnnotationVolume
+    - voxel coordinates (vol[(z, y, x)] with int arrays) are read and written on the stored planes
+
+Any other write (3D masks, sub-volumes, voxels outside the stored planes) converts the volume to a dense np.ndarray
+kept inside the object, every later operation then runs on it. Reads return copies in both modes. Other reads, numpy
+functions and the np.ndarray methods listed in _dense_methods run on a dense copy, a warning is logged each time the
+whole volume is built this way.
+"""
+
+import logging
+import threading
+
+import numpy as np
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+def _is_int_sequence(value) -> bool:
+    if isinstance(value, (list, tuple, range)):
+        return all(_is_int(v) for v in value)
+
+    return isinstance(value, np.ndarray) and value.ndim == 1 and np.issubdtype(value.dtype, np.integer)
+
+
+# np.ndarray methods that run on the dense volume, any other attribute raises AttributeError
+_dense_methods = frozenset(
+    (
+        "all", "any", "argmax", "argmin", "astype", "clip", "flatten", "max", "mean", "min", "nonzero", "ravel",
+        "reshape", "squeeze", "std", "sum", "tobytes", "tolist", "transpose",
+    )
+)
+
+
+def plane_index(axis: int, slice_num: int) -> tuple:
+    """
+    Function that builds the index of a plane of a 3D volume
+
+    Args:
+        axis (int): 0 (XY), 1 (XZ) or 2 (YZ)
+        slice_num (int): the slice along the axis
+
+    Returns:
+        (tuple): index such that volume[index] is the plane
+
+    """
+    index = [slice(None)] * 3
+    index[axis] = slice_num
+    return tuple(index)
+
+
+class SparseAnnotationVolume(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Annotation volume that only stores the annotated planes.
+
+    Args:
+        shape (tuple): (z, y, x) shape of the volume
+        dtype (np.dtype): dtype of the volume
+        fill_value (int): value of the voxels outside the stored planes
+
+    """
+
+    def __init__(self, shape: tuple, dtype=np.int16, fill_value: int = -1):
+        self._shape = tuple(int(s) for s in shape)
+        self._dtype = np.dtype(dtype)
+        self.fill_value = fill_value
+        self._planes = dict()
+        self._dense = None
+        self._lock = threading.RLock()
+        # crops (blocks read for training, slabs saved, ...) are small, only the whole volume is logged when made dense
+        self._log_dense = True
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return int(np.prod(self._shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self._dtype.itemsize
+
+    @property
+    def stored_nbytes(self):
+        """
+        Bytes used by the stored planes, or by the dense volume after a dense write
+        """
+        if self._dense is not None:
+            return self._dense.nbytes
+
+        return sum(plane.nbytes for plane in list(self._planes.values()))
+
+    @property
+    def is_dense(self) -> bool:
+        return self._dense is not None
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __repr__(self):
+        if self._dense is not None:
+            return "SparseAnnotationVolume(shape={}, dense)".format(self._shape)
+        return "SparseAnnotationVolume(shape={}, planes={})".format(self._shape, len(self._planes))
+
+    def planes(self) -> list:
+        """
+        Function that gets the stored planes
+
+        Returns:
+            (list): sorted list of (axis, slice), empty after a dense write
+
+        """
+        return sorted(self._planes.keys())
+
+    def _plane_shape(self, axis: int) -> tuple:
+        return tuple(s for i, s in enumerate(self._shape) if i != axis)
+
+    def _intersection(self, axis: int, slice_num: int, other_axis: int, other_slice: int):
+        """
+        Index of the line where the plane (axis, slice_num) meets the plane (other_axis, other_slice), in the 2D
+        coordinates of the plane (axis, slice_num).
+        """
+        index = [slice(None)] * 2
+        index[[i for i in range(3) if i != axis].index(other_axis)] = other_slice
+        return tuple(index)
+
+    def _compose_plane(self, axis: int, slice_num: int) -> np.ndarray:
+        """
+        Build a plane that is not stored, from the lines of the stored planes of the other axes.
+        """
+        plane = np.full(self._plane_shape(axis), self.fill_value, dtype=self._dtype)
+
+        for (other_axis, other_slice), other in list(self._planes.items()):
+            if other_axis != axis:
+                plane[self._intersection(axis, slice_num, other_axis, other_slice)] = other[
+                    self._intersection(other_axis, other_slice, axis, slice_num)
+                ]
+
+        return plane
+
+    def _read_plane(self, axis: int, slice_num: int, window: tuple = ()) -> np.ndarray:
+        if not 0 <= slice_num < self._shape[axis]:
+            raise IndexError("index {} is out of bounds for axis {} with size {}".format(slice_num, axis, self._shape[axis]))
+
+        plane = self._planes.get((axis, slice_num), None)
+        if plane is not None:
+            # only the window is copied
+            return plane[window].copy()
+
+        return self._compose_plane(axis, slice_num)[window]
+
+    def _write_plane(self, axis: int, slice_num: int, window: tuple, value):
+        with self._lock:
+            plane = self._planes.get((axis, slice_num), None)
+            if plane is None:
+                plane = self._read_plane(axis, slice_num)
+
+            plane[window] = value
+            self._planes[(axis, slice_num)] = plane
+
+            # keep the intersecting lines of the other planes up to date
+            for (other_axis, other_slice), other in self._planes.items():
+                if other_axis != axis:
+                    other[self._intersection(other_axis, other_slice, axis, slice_num)] = plane[
+                        self._intersection(axis, slice_num, other_axis, other_slice)
+                    ]
+
+    def add_plane(self, axis: int, slice_num: int):
+        """
+        Function that stores a plane, so the voxels of this plane can be written with coordinates
+
+        Args:
+            axis (int): 0 (XY), 1 (XZ) or 2 (YZ)
+            slice_num (int): the slice along the axis
+
+        Returns:
+            None
+
+        """
+        if self._dense is None and (axis, slice_num) not in self._planes:
+            self._write_plane(axis, int(slice_num), (), self._read_plane(axis, int(slice_num)))
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Function that builds the dense volume
+
+        Returns:
+            (np.ndarray): a new dense volume
+
+        """
+        if self._dense is not None:
+            return self._dense.copy()
+
+        dense = np.full(self._shape, self.fill_value, dtype=self._dtype)
+        for (axis, slice_num), plane in list(self._planes.items()):
+            dense[plane_index(axis, slice_num)] = plane
+
+        return dense
+
+    def densify(self):
+        """
+        Function that converts the volume to a dense np.ndarray, used for writes that are not planes
+        """
+        with self._lock:
+            if self._dense is None:
+                if self._log_dense:
+                    logging.warning("Converting {} to a dense volume ({} bytes)".format(self, self.nbytes))
+                self._dense = self.to_dense()
+                self._planes = dict()
+
+    def copy(self):
+        other = SparseAnnotationVolume(self._shape, self._dtype, self.fill_value)
+        other._log_dense = self._log_dense
+
+        # plane writes hold the lock, the copy never has a plane written on some of its lines only
+        with self._lock:
+            other._dense = self._dense.copy() if self._dense is not None else None
+            other._planes = {key: plane.copy() for key, plane in list(self._planes.items())}
+
+        return other
+
+    def _normalize_key(self, key):
+        # lists of slices are used as tuples, as old numpy versions did
+        if isinstance(key, list) and any(isinstance(k, slice) for k in key):
+            key = tuple(key)
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (3 - len(key) + 1) + key[i + 1 :]
+
+        return key + (slice(None),) * (3 - len(key))
+
+    def _plane_key(self, key: tuple):
+        """
+        (axis, selector, window) if the key selects slices along a single axis, None otherwise.
+        """
+        if len(key) != 3:
+            return None
+
+        selectors = [i for i, k in enumerate(key) if not isinstance(k, slice)]
+
+        if len(selectors) != 1 or not (_is_int(key[selectors[0]]) or _is_int_sequence(key[selectors[0]])):
+            return None
+
+        axis = selectors[0]
+        window = tuple(k for i, k in enumerate(key) if i != axis)
+        return axis, key[axis], window
+
+    def _coordinates_key(self, key: tuple):
+        if len(key) != 3 or not all(_is_int(k) or _is_int_sequence(k) for k in key):
+            return None
+
+        coords = np.broadcast_arrays(*[np.asarray(k) for k in key])
+        return tuple(np.where(c < 0, c + s, c) for c, s in zip(coords, self._shape))
+
+    def _normalize_slice(self, axis: int, slice_num: int) -> int:
+        slice_num = int(slice_num)
+        return slice_num + self._shape[axis] if slice_num < 0 else slice_num
+
+    def __getitem__(self, key):
+        if self._dense is not None:
+            value = self._dense[self._normalize_key(key) if isinstance(key, list) else key]
+            # views are copied, as the reads of the stored planes
+            return value.copy() if isinstance(value, np.ndarray) and np.may_share_memory(value, self._dense) else value
+
+        original_key = key
+        key = self._normalize_key(key)
+        plane_key = self._plane_key(key)
+
+        if plane_key is not None:
+            axis, selector, window = plane_key
+
+            if _is_int(selector):
+                return self._read_plane(axis, self._normalize_slice(axis, selector), window)
+
+            planes = [self._read_plane(axis, self._normalize_slice(axis, s), window) for s in selector]
+            if len(planes) == 0:
+                shape = list(np.empty(self._plane_shape(axis), dtype=bool)[window].shape)
+                shape.insert(axis, 0)
+                return np.empty(shape, dtype=self._dtype)
+            return np.stack(planes, axis=axis)
+
+        coords = self._coordinates_key(key)
+
+        if coords is not None:
+            shape = coords[0].shape
+            coords = tuple(c.ravel() for c in coords)
+            values = np.full(coords[0].size, self.fill_value, dtype=self._dtype)
+            for axis, slice_num, indices in self._group_by_plane(coords):
+                plane = self._planes[(axis, slice_num)]
+                values[indices] = plane[tuple(c[indices] for i, c in enumerate(coords) if i != axis)]
+            values = values.reshape(shape)
+            return values[()] if values.ndim == 0 else values
+
+        if all(isinstance(k, slice) for k in key) and all(k.step in (None, 1) for k in key):
+            return self._crop(key)
+
+        return self._materialize()[original_key]
+
+    def _crop(self, key: tuple):
+        ranges = [k.indices(s)[:2] for k, s in zip(key, self._shape)]
+        cropped = SparseAnnotationVolume([max(0, stop - start) for start, stop in ranges], self._dtype, self.fill_value)
+        cropped._log_dense = False
+
+        for (axis, slice_num), plane in list(self._planes.items()):
+            start, stop = ranges[axis]
+            if start <= slice_num < stop:
+                window = tuple(slice(*r) for i, r in enumerate(ranges) if i != axis)
+                cropped._planes[(axis, slice_num - start)] = plane[window].copy()
+
+        return cropped
+
+    def __setitem__(self, key, value):
+        if self._dense is None:
+            normalized = self._normalize_key(key)
+            plane_key = self._plane_key(normalized)
+
+            if plane_key is not None and _is_int(plane_key[1]):
+                axis, selector, window = plane_key
+                self._write_plane(axis, self._normalize_slice(axis, selector), window, value)
+                return
+
+            coords = self._coordinates_key(normalized)
+
+            if coords is not None and self._write_coordinates(coords, value):
+                return
+
+            # not a plane, the annotation is kept dense from now on
+            self.densify()
+
+        self._dense[self._normalize_key(key) if isinstance(key, list) else key] = value
+
+    def _group_by_plane(self, coords: tuple):
+        """
+        Group flat voxel coordinates by the stored plane holding them, yields (axis, slice, indices of the voxels). A
+        voxel on the line where two stored planes cross is in both groups.
+        """
+        for axis in range(3):
+            slices, inverse = np.unique(coords[axis], return_inverse=True)
+            stored = np.array([(axis, int(s)) in self._planes for s in slices], dtype=bool)
+
+            if not stored.any():
+                continue
+
+            # voxels sorted by their slice, the voxels of slices[k] are order[bounds[k]:bounds[k + 1]]
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=slices.size))))
+
+            for k in np.flatnonzero(stored):
+                yield axis, int(slices[k]), order[bounds[k] : bounds[k + 1]]
+
+    def _write_coordinates(self, coords: tuple, value) -> bool:
+        """
+        Write voxels given by coordinates on the stored planes, returns False (without writing) if some voxel is not in
+        a stored plane.
+        """
+        with self._lock:
+            value = np.broadcast_to(np.asarray(value, dtype=self._dtype), coords[0].shape).ravel()
+            coords = tuple(c.ravel() for c in coords)
+            groups = list(self._group_by_plane(coords))
+            covered = np.zeros(coords[0].shape, dtype=bool)
+
+            for _, _, indices in groups:
+                covered[indices] = True
+
+            if not covered.all():
+                return False
+
+            for axis, slice_num, indices in groups:
+                plane = self._planes[(axis, slice_num)]
+                plane[tuple(c[indices] for i, c in enumerate(coords) if i != axis)] = value[indices]
+
+            return True
+
+    def take(self, indices, axis=None, out=None, mode="raise"):
+        if axis is None or out is not None or self._dense is not None:
+            return np.take(self._materialize(), indices, axis=axis, out=out, mode=mode)
+
+        if isinstance(indices, np.ndarray) and indices.ndim == 0:
+            indices = int(indices)
+
+        return self[plane_index(axis, indices)]
+
+    def _materialize(self) -> np.ndarray:
+        """
+        The dense volume, built from the stored planes (and logged, as it costs as much as the dense annotation) if the
+        volume is sparse. Don't write to it, writes of a sparse volume are lost.
+        """
+        if self._dense is not None:
+            return self._dense
+
+        if self._log_dense:
+            logging.warning("Building a dense copy of {} ({} bytes)".format(self, self.nbytes))
+        return self.to_dense()
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self._materialize()
+        if copy and dense is self._dense:
+            dense = dense.copy()
+        return dense if dtype is None else dense.astype(dtype, copy=False)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x._materialize() if isinstance(x, SparseAnnotationVolume) else x for x in inputs)
+
+        outputs = kwargs.get("out", ())
+        if any(isinstance(x, SparseAnnotationVolume) for x in outputs):
+            # in-place operations (e.g. vol += 1) write to the volume, it's converted to dense first
+            for x in outputs:
+                if isinstance(x, SparseAnnotationVolume):
+                    x.densify()
+            kwargs["out"] = tuple(x._dense if isinstance(x, SparseAnnotationVolume) else x for x in outputs)
+
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+
+        if len(outputs) > 0 and result is not None:
+            # numpy returns the out arrays, the volumes are returned instead of their dense arrays
+            dense_outputs = {id(x._dense): x for x in outputs if isinstance(x, SparseAnnotationVolume)}
+            if isinstance(result, tuple):
+                return tuple(dense_outputs.get(id(r), r) for r in result)
+            return dense_outputs.get(id(result), result)
+
+        return result
+
+    def __getattr__(self, name):
+        # the np.ndarray methods of _dense_methods (astype, ravel, max, ...) run on the dense volume
+        if name not in _dense_methods:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return getattr(self._materialize(), name)
@@ -23,7 +23,8 @@ from sscAnnotat3D import cython
 from harpia.featureExtraction import superpixel_pooling_feature
 
 from .. import aux_functions as functions
-from .. import progressbar, utils
+from .. import jobs, progressbar, utils
+from ..repository import feature_cache
 from .classifier_segmentation_module import ClassifierSegmentationModule
 
 
@@ -48,6 +49,9 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
         self._superpixels = superpixels
         self._min_superpixel_label = superpixels.min()
         self._max_superpixel_label = superpixels.max()
+        # versions of the image and superpixels in data_repo, the features of the whole volume are cached under them
+        self._image_version = kwargs.get("image_version", None)
+        self._superpixel_version = kwargs.get("superpixel_version", None)
 
         functions.log_usage(
             op_type="load_module_" + self._module_name,
@@ -107,6 +111,8 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
                     image, superpixel_type=superpixel_type, **params
                 )
 
+            # these superpixels are not in data_repo, their features are not cached
+            self._superpixel_version = None
             self.reset_features()
 
         total_end = time.time()
@@ -215,13 +221,73 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
 
         return features_args, sigmas, total_features
 
+    def _features_cache_key(self):
+        features_args, sigmas, _ = self._get_feature_args()
+        return feature_cache.make_key(
+            self._image_version, self._superpixel_version, features_args, sigmas, self._min_superpixel_label
+        )
+
+    def _training_superpixel_labels(self, annotation_image, annotation_slice_dict):
+        """
+        Majority vote label of each annotated superpixel, sorted by superpixel id.
+        """
+        majority = self.superpixel_majority_voting(annotation_slice_dict, annotation_image, self._superpixels)
+
+        ids = np.fromiter(majority.keys(), dtype=np.int64, count=len(majority))
+        labels = np.fromiter(majority.values(), dtype=np.int16, count=len(majority))
+        order = np.argsort(ids)
+        ids, labels = ids[order], labels[order]
+
+        valid_mask = (ids >= self._min_superpixel_label) & (labels >= 0)
+
+        return ids[valid_mask], labels[valid_mask]
+
+    def _training_rows_in_slabs(self, ids, num_slabs, features_args, sigmas, total_features):
+        """
+        Extract the features of the given superpixels with the slabs of _execute_in_slabs, so they are the same rows
+        its prediction uses.
+
+        The rows are kept for the next train with the same image, superpixels and params, which only extracts the
+        superpixels annotated since then.
+        """
+        key = self._training_blocks_key()
+        previous_rows, _ = self._previous_training_blocks(key)
+        kept_ids = previous_rows.get("ids", np.zeros(0, dtype=np.int64))
+        kept_features = previous_rows.get("features", np.zeros((0, total_features), dtype=np.float32))
+
+        missing = np.setdiff1d(ids, kept_ids, assume_unique=True)
+        logging.debug("Features extracted for {} of {} annotated superpixels".format(missing.size, ids.size))
+
+        if missing.size > 0:
+            wanted = np.zeros(int(self._max_superpixel_label) + 1, dtype=bool)
+            wanted[missing] = True
+            slab_size = max(1, math.ceil(self._superpixels.shape[0] / max(1, num_slabs)))
+
+            new_ids, new_features = [kept_ids], [kept_features]
+            for slab_superpixels, features_slab, _, _ in self._slab_features(slab_size, features_args, sigmas, wanted):
+                new_ids.append(slab_superpixels)
+                new_features.append(np.asarray(features_slab[1:], dtype=np.float32))
+
+            kept_ids = np.concatenate(new_ids).astype(np.int64)
+            kept_features = np.concatenate(new_features)
+            order = np.argsort(kept_ids)
+            kept_ids, kept_features = kept_ids[order], kept_features[order]
+
+            self._keep_training_blocks(key, {"ids": kept_ids, "features": kept_features}, None)
+
+        return kept_features[np.searchsorted(kept_ids, ids)]
+
     def extract_superpixel_features_in_blocks(
         self,
         annotation_image: np.ndarray,
-        annotation_slice_dict: dict[int, list[int]]
+        annotation_slice_dict: dict[int, list[int]],
     ) -> tuple[np.ndarray, np.ndarray]:
         """
-        Extract superpixel-level features across annotated slice blocks.
+        Extract the features of the annotated superpixels and their majority vote labels.
+
+        The features are the rows execute classifies: the cached features of the whole volume when they fit in memory
+        (extracted and cached here on a miss), or the rows of the slabs of _execute_in_slabs otherwise. The slab rows
+        are kept for the next train, which only extracts the superpixels annotated since this one.
 
         Parameters
         ----------
@@ -237,106 +303,37 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
         Y_all : np.ndarray
             Majority-vote labels for each valid superpixel.
         """
-
-        from itertools import zip_longest
-
-        # Helper: split consecutive indices into blocks
-        def consecutive_blocks(indices):
-            blocks, block = [], []
-            for i, idx in enumerate(indices):
-                if i == 0 or idx == indices[i - 1] + 1:
-                    block.append(idx)
-                else:
-                    blocks.append(block)
-                    block = [idx]
-            if block:
-                blocks.append(block)
-            return blocks
-
-        # === Internal state ===
-        image = self._image
-        superpixels = self._superpixels
-
         features_args, sigmas, total_features = self._get_feature_args()
+        ids, Y_valid = self._training_superpixel_labels(annotation_image, annotation_slice_dict)
+
+        # features of the whole volume extracted by a previous execute with the same image, superpixels and params
+        cache_key = self._features_cache_key()
+        features = feature_cache.get(cache_key)
+
+        if features is None:
+            valid, memory_splitting_factor = self._validate_feature_extraction_memory_usage()
+            if valid:
+                logging.debug("Extracting the superpixel features of the entire image for training")
+                features = functions.superpixel_feature_extraction(
+                    self.image, self._superpixels, features_args, sigmas, self._min_superpixel_label
+                )
+                feature_cache.put(cache_key, features)
 
-        # === Define vectors ===
-        num_superpixels = int(self._max_superpixel_label + self._min_superpixel_label + 1)
-        X_all = np.zeros((num_superpixels, total_features), dtype=np.float32)
-        Y_all = np.full(num_superpixels, -1, dtype=np.int16)
-
-        # === Prepare interleaved slice blocks ===
-        axis_indices = {axis: sorted(indices) for axis, indices in annotation_slice_dict.items()}
-        axis_blocks = {axis: consecutive_blocks(idxs) for axis, idxs in axis_indices.items()}
-
-        interleaved_blocks = []
-        for group in zip_longest(*[axis_blocks[a] for a in sorted(axis_blocks)], fillvalue=None):
-            for axis, block in enumerate(group):
-                if block is not None:
-                    interleaved_blocks.append((axis, block))
-
-        # === Iterate through interleaved slice blocks ===
-        for axis, block in interleaved_blocks:
-            if axis == 0:
-                img_block = image[block, :, :]
-                sp_block = superpixels[block, :, :]
-                lbl_block = annotation_image[block, :, :]
-            elif axis == 1:
-                img_block = image[:, block, :]
-                sp_block = superpixels[:, block, :]
-                lbl_block = annotation_image[:, block, :]
-            elif axis == 2:
-                img_block = image[:, :, block]
-                sp_block = superpixels[:, :, block]
-                lbl_block = annotation_image[:, :, block]
-            else:
-                raise ValueError(f"Invalid axis {axis}")
-
-            # Ensure 3D (Z, Y, X)
-            if img_block.ndim == 2:
-                img_block = img_block[None, :, :]
-                sp_block = sp_block[None, :, :]
-                lbl_block = lbl_block[None, :, :]
-
-            # Local ID remapping
-            sp_min = sp_block.min()
-            sp_block_local = sp_block - sp_min
-            #unique_local = np.unique(sp_block_local)
-            #global_ids = unique_local + sp_min
-
-            # === Feature extraction ===
-            feat_block = functions.superpixel_feature_extraction(
-                img_block,
-                sp_block_local,
-                features_args,
-                sigmas,
-                0,
-            )
-
-            # === Majority vote labels ===
-            mask = lbl_block >= 0
-            sp_ids = sp_block_local[mask].ravel().astype('int32')
-            labels_per_id = lbl_block[mask].ravel().astype('int32')
-
-            maj_labels = cython.annotation.cython_majority_vote(sp_ids, labels_per_id)
-
-            local_ids = np.fromiter(maj_labels.keys(), dtype=np.int32)
-            label_for_ids = np.fromiter(maj_labels.values(), dtype=np.int32)
-
-            X_all[local_ids + sp_min] = feat_block[local_ids]
-            Y_all[local_ids + sp_min] = label_for_ids
-
-        # === Keep valid superpixels only ===
-        valid_mask = Y_all >= 0
-        X_valid = X_all[valid_mask]
-        Y_valid = Y_all[valid_mask]
+        if features is not None:
+            X_valid = np.asarray(features[ids - self._min_superpixel_label], dtype=np.float32)
+        else:
+            X_valid = self._training_rows_in_slabs(ids, memory_splitting_factor, features_args, sigmas, total_features)
 
         self._training_features = X_valid
         self._training_features_raw = X_valid
         self._training_labels_raw = Y_valid
 
-        
         return X_valid, Y_valid
 
+    def _training_blocks_key(self):
+        features_key = self._features_cache_key()
+        return (self._module_name, features_key) if features_key is not None else None
+
     def train(self, annotation_slice_dict, annotation_image, finetune: bool = False, **kwargs):
         """
         Train the superpixel classifier on the provided annotations.
@@ -402,15 +399,22 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
                 sp_id_max = preview_superpixels.max()
 
                 features_args, sigmas, _ = self._get_feature_args()
-                start = time.time()
-                local_feat_block = functions.superpixel_feature_extraction(
-                preview_image,
-                preview_superpixels,
-                features_args,
-                sigmas,
-                sp_id_min
-                )
-                print("Feature Extraction Time Preview:", time.time() - start)
+                cached_features = feature_cache.get(self._features_cache_key())
+                if cached_features is not None:
+                    # rows of the superpixels sp_id_min..sp_id_max
+                    local_feat_block = cached_features[
+                        sp_id_min - self._min_superpixel_label : sp_id_max - self._min_superpixel_label + 1
+                    ]
+                else:
+                    start = time.time()
+                    local_feat_block = functions.superpixel_feature_extraction(
+                    preview_image,
+                    preview_superpixels,
+                    features_args,
+                    sigmas,
+                    sp_id_min
+                    )
+                    print("Feature Extraction Time Preview:", time.time() - start)
 
 
 
@@ -491,8 +495,6 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
 
             selected_superpixels = None
             preview_bounding_box = None
-            image = self._image.astype("int32") if self._image.dtype != "int32" else self._image
-
             superpixels = self._superpixels
 
             if "selected_superpixels" in kwargs:
@@ -504,18 +506,21 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
             memory_splitting_factor = 2
 
             feature_extraction_time = 0.0
-            
+            features_args, sigmas, _ = self._get_feature_args()
+            cache_key = self._features_cache_key()
+            cached_features = feature_cache.get(cache_key)
 
             with sentry_sdk.start_span(op="Feature extraction"):
-                if self._features is None or force_feature_extraction:
-                    #valid, memory_splitting_factor = self._validate_feature_extraction_memory_usage(**kwargs)
-                    valid = True
+                if cached_features is not None:
+                    # same image, superpixels and params of a previous extraction
+                    logging.debug("\n\n**** Reusing the cached features for the entire image ****")
+                    self._features = cached_features
+                elif self._features is None or force_feature_extraction:
+                    valid, memory_splitting_factor = self._validate_feature_extraction_memory_usage(**kwargs)
                     if valid:
                         logging.debug("\n\n**** Extracting features for the entire image AT ONCE ****")
                         start_feature_extraction_time = time.time()
 
-                        features_args, sigmas, _ = self._get_feature_args()
-
                         self._features = functions.superpixel_feature_extraction(
                         self.image,
                         self._superpixels,
@@ -529,6 +534,8 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
                         feature_extraction_time += end_feature_extraction_time - start_feature_extraction_time
 
                         print("Feature Extraction Time:", feature_extraction_time)
+
+                        feature_cache.put(cache_key, self._features)
                     else:
                         # Ensuring that superpixel features are disregarded. It might be the case that the user previously computed
                         # features that fit in memory, but now s/he is requesting features that do not fit in memory. Hence,
@@ -556,60 +563,15 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
                     total_predict_times = {}
 
                     if features is None:
-                        features_args, sigmas, _ = self._get_feature_args()
-
-                        logging.debug("\n\n**** Extracting features for the entire image IN BLOCKS ****")
-
-                        block_size = max(1, math.ceil(image.shape[0] // memory_splitting_factor))
-                        logging.debug("**** Splitting image into blocks of %d slices" % block_size)
-
-                        features_shape = np.zeros(2, dtype="int")
-                        nblocks = 0
+                        logging.debug("\n\n**** Extracting features for the entire image IN SLABS ****")
 
-                        for z in range(0, image.shape[0], block_size):
-                            z1 = min(image.shape[0], z + block_size)
-                            logging.debug("**** Processing block (%d:%d)" % (z, z1 - 1))
-
-                            image_block = image[z:z1]
-                            superpixels_block = superpixels[z:z1]
-                            pred_block = pred[z:z1]
-
-                            start_feature_extraction_time = time.time()
-
-                            features_block = functions.superpixel_feature_extraction(
-                                image_block,
-                                self.superpixels,
-                                superpixels_block,
-                                sigmas,
-                                superpixels_block.min()
-                                )
-
-                            end_feature_extraction_time = time.time()
-
-                            assignment, test, predict_times = self._classify_superpixels(
-                                features_block, pred_block, superpixels_block, None
-                            )
-                            # min_superpixel_id=min_superpixel_label,
-                            # max_superpixel_id=max_superpixel_label)
-
-                            feature_extraction_time += end_feature_extraction_time - start_feature_extraction_time
-                            test_time += test
-                            assignment_time += assignment
-
-                            cur_block_size = image_block.shape[0]
-                            # Considering only the number of feature channels when computing superpixel features blockwise
-                            features_shape += np.array(features_block.shape, dtype="int") * cur_block_size
-
-                            if len(total_predict_times) == 0:
-                                total_predict_times = predict_times
-                            else:
-                                for k in total_predict_times:
-                                    total_predict_times[k] += predict_times[k]
-
-                            # Feature shape is a weighted average combination of all feature shapes of each block
-                            nblocks += cur_block_size
-                        # Computing average amount of superpixel feature vectors computed per block
-                        features_shape = (features_shape / max(1, nblocks)).astype("int32")
+                        (
+                            feature_extraction_time,
+                            test_time,
+                            assignment_time,
+                            total_predict_times,
+                            features_shape,
+                        ) = self._execute_in_slabs(pred, memory_splitting_factor, features_args, sigmas)
 
                     else:
                         features_shape = features.shape
@@ -657,6 +619,152 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
 
             return pred, features_args
 
+    def _superpixels_z_range(self):
+        """
+        First and last slice (axis 0) of each superpixel, -1 for the labels without voxels.
+        """
+        superpixels = self._superpixels
+        z_first = np.full(int(self._max_superpixel_label) + 1, -1, dtype=np.int64)
+        z_last = np.full(int(self._max_superpixel_label) + 1, -1, dtype=np.int64)
+
+        for z in range(superpixels.shape[0]):
+            ids = np.unique(superpixels[z])
+            z_first[ids[z_first[ids] < 0]] = z
+            z_last[ids] = z
+
+        return z_first, z_last
+
+    def _slab_features(self, slab_size, features_args, sigmas, wanted=None):
+        """
+        Extract the features of the superpixels slab by slab (along axis 0), so the features of the whole image are
+        never in memory.
+
+        Notes:
+            Each superpixel belongs to the slab of its first slice. The features of a slab are extracted from the slices
+            of its superpixels plus a halo for the filters, so they are the same as the features extracted from the
+            whole image. The slices read are capped at two slabs (plus the halo): superpixels taller than that are
+            pooled over their slices in this range only, so a few tall superpixels never pull the whole volume in a
+            slab. With a single slab nothing is capped.
+
+        Args:
+            slab_size (int): number of slices of each slab
+            features_args (dict): feature flags and pooling, see _get_feature_args
+            sigmas (np.ndarray): sigmas of the features
+            wanted (np.ndarray): bool mask of the superpixel ids to extract, all of them if None
+
+        Yields:
+            (tuple): ids of the superpixels of the slab, their features (row k + 1 for ids[k], row 0 pools the voxels
+                of the other superpixels), and the first slice of the slab and the last slice (+1) of its superpixels
+
+        """
+        image = self.image
+        superpixels = self._superpixels
+        nz = superpixels.shape[0]
+
+        halo = self._feature_halo(sigmas)
+        z_first, z_last = self._superpixels_z_range()
+        # superpixel id -> row of its features in the slab (0 for the superpixels of other slabs)
+        local_ids = np.zeros(z_first.size, dtype=np.int32)
+
+        logging.debug("**** Splitting image into slabs of %d slices, halo of %d slices" % (slab_size, halo))
+
+        for z in range(0, nz, slab_size):
+            jobs.check_cancelled()
+            z1 = min(nz, z + slab_size)
+
+            in_slab = (z_first >= z) & (z_first < z1)
+            if wanted is not None:
+                in_slab &= wanted[: z_first.size]
+            slab_superpixels = np.flatnonzero(in_slab)
+            if slab_superpixels.size == 0:
+                continue
+
+            # slices with voxels of the slab superpixels (capped), and the slices read for the features
+            zend = int(z_last[slab_superpixels].max()) + 1
+            zmax = min(zend, z + 2 * slab_size)
+            r0, r1 = max(0, z - halo), min(nz, zmax + halo)
+            logging.debug("**** Processing slab (%d:%d), reading (%d:%d)" % (z, zmax - 1, r0, r1 - 1))
+
+            local_ids[slab_superpixels] = np.arange(1, slab_superpixels.size + 1, dtype=np.int32)
+            superpixels_local = local_ids[superpixels[r0:r1]]
+            local_ids[slab_superpixels] = 0
+            # the voxels after the cap only feed the filters
+            superpixels_local[zmax - r0 :] = 0
+
+            features_slab = functions.superpixel_feature_extraction(
+                image[r0:r1], superpixels_local, features_args, sigmas, 0
+            )
+
+            yield slab_superpixels, features_slab, z, zend
+
+    def _execute_in_slabs(self, pred, num_slabs, features_args, sigmas):
+        """
+        Extract features and classify the superpixels slab by slab (along axis 0), see _slab_features.
+
+        Notes:
+            The number of slabs comes from _validate_feature_extraction_memory_usage, whose estimate counts the
+            features of each voxel as well as the pooled features.
+
+        Args:
+            pred (np.ndarray): output labels, same shape of the superpixels
+            num_slabs (int): number of slabs, see _validate_feature_extraction_memory_usage
+            features_args (dict): feature flags and pooling, see _get_feature_args
+            sigmas (np.ndarray): sigmas of the features
+
+        Returns:
+            (tuple): feature extraction time, test time, assignment time, predict times and the average feature shape
+                of the slabs
+
+        """
+        superpixels = self._superpixels
+        nz = superpixels.shape[0]
+
+        slab_size = max(1, math.ceil(nz / max(1, num_slabs)))
+        # superpixel id -> its row in the prediction of the slab (0 for the superpixels of other slabs)
+        local_ids = np.zeros(int(self._max_superpixel_label) + 1, dtype=np.int32)
+
+        feature_extraction_time = test_time = assignment_time = 0.0
+        total_predict_times = {}
+        features_shape = np.zeros(2, dtype="int")
+        nslabs = 0
+
+        slabs = self._slab_features(slab_size, features_args, sigmas)
+        start_feature_extraction_time = time.time()
+
+        for slab_superpixels, features_slab, z, zend in slabs:
+            feature_extraction_time += time.time() - start_feature_extraction_time
+
+            start = time.time()
+            # row 0 pools the voxels of the other slabs
+            prediction, predict_times = self._predict_labels(features_slab[1:], overwrite=True)
+            test_time += time.time() - start
+
+            start = time.time()
+            prediction = np.concatenate(([0], np.asarray(prediction))).astype(pred.dtype)
+            local_ids[slab_superpixels] = np.arange(1, slab_superpixels.size + 1, dtype=np.int32)
+            # the slices of tall superpixels are written a slab at a time
+            for zz in range(z, zend, slab_size):
+                written = local_ids[superpixels[zz : min(zend, zz + slab_size)]]
+                np.copyto(pred[zz : zz + written.shape[0]], prediction[written], where=written > 0)
+            local_ids[slab_superpixels] = 0
+            assignment_time += time.time() - start
+
+            features_shape += np.array(features_slab.shape, dtype="int") - [1, 0]
+            nslabs += 1
+
+            if len(total_predict_times) == 0:
+                total_predict_times = predict_times
+            else:
+                for k in total_predict_times:
+                    total_predict_times[k] += predict_times[k]
+
+            start_feature_extraction_time = time.time()
+
+        # average amount of superpixel feature vectors computed per slab
+        features_shape = (features_shape / max(1, nslabs)).astype("int32")
+
+        return feature_extraction_time, test_time, assignment_time, total_predict_times, features_shape
+
     def _classify_superpixels(self, superpixel_features, pred, superpixels, selected_superpixels = None):
         logging.debug("Predicting...")
         start = time.time()
@@ -664,14 +772,7 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
         # we pass global features, so min_superpixel_id is always 1
         min_superpixel_id, max_superpixel_id = self._min_superpixel_label, self._max_superpixel_label
 
-        logging.info(
-            "superpixel_features: {} {} {} {}".format(
-                superpixel_features.mean(),
-                superpixel_features.min(),
-                superpixel_features.max(),
-                superpixel_features.shape,
-            )
-        )
+        functions.log_feature_stats("Superpixel features", superpixel_features)
 
         prediction, predict_times = self._predict_labels(superpixel_features)
         logging.info("-- Converting result to array")
@@ -701,8 +802,9 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
 
         return assignment_time, test_time, predict_times
 
-    def set_superpixel(self, superpixels):
+    def set_superpixel(self, superpixels, superpixel_version=None):
         self._superpixels = superpixels
+        self._superpixel_version = superpixel_version
 
         if superpixels is not None:
             self.max_superpixel_label = superpixels.max()
@@ -718,6 +820,9 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
         pixel_labels = []
         start = time.time()
         for axis, slice_nums in annotation_slice_dict.items():
+            if len(slice_nums) == 0:
+                continue
+
             annot_slices = np.take(annotation_image, list(slice_nums), axis=axis)
             superpixel_slices = np.take(superpixels, list(slice_nums), axis=axis)
 
@@ -726,8 +831,11 @@ class SuperpixelSegmentationModule(ClassifierSegmentationModule):
             superpixel_slices_ids.append(superpixel_slices[bool_mask])
             pixel_labels.append(annot_slices[bool_mask])
 
-        superpixel_slices_ids = np.concatenate(superpixel_slices_ids)
-        pixel_labels = np.concatenate(pixel_labels)
+        if len(pixel_labels) == 0:
+            return {}
+
+        superpixel_slices_ids = np.concatenate(superpixel_slices_ids).astype("int32")
+        pixel_labels = np.concatenate(pixel_labels).astype("int32")
 
         majority = cython.annotation.cython_majority_vote(superpixel_slices_ids, pixel_labels)
 
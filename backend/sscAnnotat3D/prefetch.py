@@ -0,0 +1,178 @@
+"""
+This script contains the slice prefetcher.
+
+After a slice is served, the next and previous slices along the same axis are compressed on a thread pool and stored in
+the slice cache, so stepping through a stack is served from memory. Each kind of slice (image, annotation, superpixel)
+registers a builder, a function with the signature builder(axis, slice_num, prefetch=True, **params) that puts the
+compressed slice in the cache.
+
+The depth (number of slices prefetched on each side) and the number of threads are read from the env variables
+ANNOTAT3D_PREFETCH_DEPTH (4 by default, 0 disables prefetching) and ANNOTAT3D_PREFETCH_WORKERS (2 by default).
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SlicePrefetcher:
+    """
+    Prefetch slices around the last requested one.
+
+    Args:
+        depth (int): number of slices prefetched before and after the requested slice
+        workers (int): number of threads used to build the slices
+
+    """
+
+    def __init__(self, depth: int = 4, workers: int = 2):
+        self.depth = depth
+        self.workers = workers
+        self._builders = dict()
+        self._pending = dict()
+        self._axis = None
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="annotat3d_prefetch")
+
+    def register(self, kind: str, builder):
+        self._builders[kind] = builder
+
+    def configure(self, depth: int = None, workers: int = None):
+        if depth is not None:
+            self.depth = depth
+
+        if workers is not None and workers != self.workers:
+            self.cancel()
+            self._executor.shutdown(wait=False)
+            self.workers = workers
+            self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="annotat3d_prefetch")
+
+    def cancel(self):
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+
+        for future in pending:
+            future.cancel()
+
+    def schedule(self, kind: str, axis: str, slice_num: int, n_slices: int, step: int = 1, **params):
+        if self.depth <= 0 or kind not in self._builders:
+            return
+
+        if axis != self._axis:
+            # the user changed the axis, the slices prefetched along the old one are not needed anymore
+            self.cancel()
+            self._axis = axis
+
+        # nearest slices first, alternating forward and backward
+        offsets = [sign * offset for offset in range(1, self.depth + 1) for sign in (1, -1)]
+
+        params_key = tuple(sorted(params.items()))
+        neighbours = [slice_num + offset * step for offset in offsets if 0 <= slice_num + offset * step < n_slices]
+        wanted = set((kind, axis, neighbour, params_key) for neighbour in neighbours)
+
+        with self._lock:
+            # slices out of the new window are not needed anymore (e.g. the user jumped with the slider). Each set of
+            # params (e.g. each image_id, the frontend requests image, label and future on every slice change) keeps
+            # its own window
+            for key in [key for key in self._pending if key[0] == kind and key[3] == params_key and key not in wanted]:
+                self._pending.pop(key).cancel()
+
+            for neighbour in neighbours:
+                key = (kind, axis, neighbour, params_key)
+                if key in self._pending:
+                    continue
+
+                future = self._executor.submit(self._build, kind, axis, neighbour, params)
+                self._pending[key] = future
+                future.add_done_callback(lambda future, key=key: self._done(key, future))
+
+    def _done(self, key: tuple, future):
+        with self._lock:
+            if self._pending.get(key, None) is future:
+                del self._pending[key]
+
+    def _build(self, kind: str, axis: str, slice_num: int, params: dict):
+        try:
+            self._builders[kind](axis, slice_num, prefetch=True, **params)
+        except Exception as e:
+            # prefetching is best effort, the slice is built again when requested
+            logging.debug("Failed to prefetch {} slice {} ({}): {}".format(kind, slice_num, axis, e))
+
+
+_prefetcher = SlicePrefetcher(
+    depth=int(os.environ.get("ANNOTAT3D_PREFETCH_DEPTH", 4)), workers=int(os.environ.get("ANNOTAT3D_PREFETCH_WORKERS", 2))
+)
+
+
+def register(kind: str, builder):
+    """
+    Function that registers the builder of a kind of slice
+
+    Args:
+        kind(str): kind of slice, e.g. "image", "annotation" or "superpixel"
+        builder(callable): function called as builder(axis, slice_num, prefetch=True, **params)
+
+    Returns:
+        None
+
+    """
+    _prefetcher.register(kind, builder)
+
+
+def schedule(kind: str, axis: str, slice_num: int, n_slices: int, step: int = 1, **params):
+    """
+    Function that prefetches the slices around slice_num. Pending prefetches are cancelled if the axis changed.
+
+    Args:
+        kind(str): kind of slice, e.g. "image", "annotation" or "superpixel"
+        axis(str): The axis to be considered ('XY' | 'XZ' | 'YZ')
+        slice_num(int): the slice requested by the frontend
+        n_slices(int): number of slices along the axis
+        step(int): distance between the prefetched slices, e.g. the downsampling factor of a pyramid level, where
+            consecutive slices are the same level slice
+        **params: extra parameters forwarded to the builder
+
+    Returns:
+        None
+
+    """
+    _prefetcher.schedule(kind, axis, slice_num, n_slices, step, **params)
+
+
+def cancel():
+    """
+    Function that cancels the pending prefetches
+
+    Returns:
+        None
+
+    """
+    _prefetcher.cancel()
+
+
+def configure(depth: int = None, workers: int = None):
+    """
+    Function that changes the prefetch depth and the number of threads
+
+    Args:
+        depth(int): number of slices prefetched on each side, 0 disables prefetching
+        workers(int): number of threads used to build the slices
+
+    Returns:
+        None
+
+    """
+    _prefetcher.configure(depth, workers)
+
+
+def get_config():
+    """
+    Function that gets the prefetch depth and the number of threads
+
+    Returns:
+        (dict): depth and workers
+
+    """
+    return {"depth": _prefetcher.depth, "workers": _prefetcher.workers}
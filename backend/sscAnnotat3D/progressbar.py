@@ -1,7 +1,11 @@
+import threading
 from threading import Timer
 
 _progress_bars = {}
 
+# progress bars of the current thread, e.g. the bars of a background job (see sscAnnotat3D.jobs)
+_local = threading.local()
+
 
 def register(level):
     global _progress_bars
@@ -10,9 +14,26 @@ def register(level):
 
 def get(level):
     global _progress_bars
+    local_bars = getattr(_local, "bars", None)
+    if local_bars is not None and level in local_bars:
+        return local_bars[level]
     return _progress_bars.get(level, None)
 
 
+def bind(bars):
+    """
+    Function that replaces the progress bars seen by progressbar.get in the current thread
+
+    Args:
+        bars (dict): level -> progress bar, None restores the global progress bars
+
+    Returns:
+        None
+
+    """
+    _local.bars = bars
+
+
 class ConsoleProgressBar:
 
     def __init__(self, widget=None):
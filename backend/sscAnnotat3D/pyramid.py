@@ -0,0 +1,271 @@
+"""
+This script contains the multi-resolution pyramid used to send zoomed-out slices to the frontend.
+
+Level 0 is the volume in data_repo, level L is downsampled by 2**L along every axis, so it can be sliced along any axis.
+Images are downsampled by the mean and label volumes ("label", "superpixel", "annotation") by the mode, so no new label
+is created. Levels are built lazily on the first request, or in the background after an image is opened, and are
+rebuilt when the volume version changes.
+
+The maximum level is read from the env variable ANNOTAT3D_PYRAMID_LEVELS (3 by default, 0 disables the pyramid).
+"""
+
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sscAnnotat3D.repository import data_repo
+
+MAX_LEVEL = int(os.environ.get("ANNOTAT3D_PYRAMID_LEVELS", 3))
+
+_label_keys = ("label", "superpixel", "annotation")
+
+# number of blocks processed at once by the mode, bounds the memory used by the pairwise comparison
+_mode_chunk = 1 << 18
+
+
+def is_label_volume(image_id: str) -> bool:
+    return image_id in _label_keys
+
+
+def scale(level: int) -> int:
+    """
+    Function that gets the downsampling factor of a level
+
+    Args:
+        level (int): pyramid level
+
+    Returns:
+        (int): 2**level
+
+    """
+    return 2**level
+
+
+def _mode(blocks: np.ndarray) -> np.ndarray:
+    """
+    Most frequent value along the last axis, ties are broken by the first value found in the block.
+
+    """
+    flat = blocks.reshape(-1, blocks.shape[-1])
+    out = np.empty(flat.shape[0], dtype=blocks.dtype)
+
+    for start in range(0, flat.shape[0], _mode_chunk):
+        values = flat[start : start + _mode_chunk]
+        counts = (values[:, :, None] == values[:, None, :]).sum(axis=-1)
+        out[start : start + _mode_chunk] = values[np.arange(values.shape[0]), counts.argmax(axis=-1)]
+
+    return out.reshape(blocks.shape[:-1])
+
+
+def downsample(data: np.ndarray, label: bool = False) -> np.ndarray:
+    """
+    Function that downsamples an array by 2 along every axis
+
+    Notes:
+        Odd axes are padded by replicating the last element, so the result has ceil(size / 2) elements per axis.
+
+    Args:
+        data (np.ndarray): 2D slice or 3D volume
+        label (bool): if True uses the mode of each block, otherwise the mean
+
+    Returns:
+        (np.ndarray): the downsampled array, with the same dtype
+
+    """
+    data = np.asarray(data)
+    pad = [(0, s % 2) for s in data.shape]
+
+    if any(p[1] for p in pad):
+        data = np.pad(data, pad, mode="edge")
+
+    ndim = data.ndim
+    out_shape = [s // 2 for s in data.shape]
+    blocks = data.reshape([v for s in out_shape for v in (s, 2)])
+    # moves the 2 elements of each axis to the end, one block per row
+    blocks = blocks.transpose([2 * i for i in range(ndim)] + [2 * i + 1 for i in range(ndim)])
+    blocks = blocks.reshape(out_shape + [2**ndim])
+
+    if label:
+        return _mode(blocks)
+
+    mean = blocks.mean(axis=-1, dtype=np.float32)
+    if np.issubdtype(data.dtype, np.integer):
+        mean = np.rint(mean)
+
+    return mean.astype(data.dtype)
+
+
+def downsample_slice(img_slice: np.ndarray, level: int, label: bool = False) -> np.ndarray:
+    """
+    Function that downsamples a 2D slice to a pyramid level
+
+    Args:
+        img_slice (np.ndarray): 2D slice at full resolution
+        level (int): pyramid level
+        label (bool): if True uses the mode of each block, otherwise the mean
+
+    Returns:
+        (np.ndarray): the downsampled slice
+
+    """
+    for _ in range(level):
+        img_slice = downsample(img_slice, label)
+
+    return img_slice
+
+
+def align_roi(roi: tuple, level: int, slice_shape: tuple) -> tuple:
+    """
+    Function that expands a ROI, in full resolution slice coordinates, to the blocks of a pyramid level
+
+    Args:
+        roi (tuple): (x0, y0, x1, y1) in full resolution, x is the slice column and y the slice row
+        level (int): pyramid level
+        slice_shape (tuple): full resolution slice shape (rows, cols)
+
+    Returns:
+        (tuple): the aligned (x0, y0, x1, y1)
+
+    """
+    factor = scale(level)
+    x0, y0, x1, y1 = roi
+
+    return (
+        (x0 // factor) * factor,
+        (y0 // factor) * factor,
+        min(math.ceil(x1 / factor) * factor, slice_shape[1]),
+        min(math.ceil(y1 / factor) * factor, slice_shape[0]),
+    )
+
+
+def scale_roi(roi: tuple, level: int) -> tuple:
+    """
+    Function that converts a ROI from full resolution slice coordinates to the coordinates of a pyramid level
+
+    Args:
+        roi (tuple): (x0, y0, x1, y1) in full resolution
+        level (int): pyramid level
+
+    Returns:
+        (tuple): (x0, y0, x1, y1) in the level coordinates
+
+    """
+    if roi is None:
+        return None
+
+    factor = scale(level)
+    x0, y0, x1, y1 = roi
+
+    return x0 // factor, y0 // factor, math.ceil(x1 / factor), math.ceil(y1 / factor)
+
+
+class ImagePyramid:
+    """
+    Downsampled levels of a volume.
+
+    Args:
+        version (int): version of the volume in data_repo
+        label (bool): if True uses the mode to downsample, otherwise the mean
+
+    """
+
+    def __init__(self, version, label: bool = False):
+        self.version = version
+        self.label = label
+        self._levels = dict()
+        self._lock = threading.Lock()
+
+    def get_level(self, volume, level: int):
+        if level == 0:
+            return volume
+
+        with self._lock:
+            for current in range(1, level + 1):
+                if current not in self._levels:
+                    previous = volume if current == 1 else self._levels[current - 1]
+                    self._levels[current] = self._downsample_volume(previous)
+
+            return self._levels[level]
+
+    def _downsample_volume(self, volume):
+        out_shape = tuple(math.ceil(s / 2) for s in volume.shape)
+        out = np.empty(out_shape, dtype=volume.dtype)
+
+        # slabs of 2 slices, so memory-mapped or on-disk volumes are never read as a whole
+        for z in range(0, volume.shape[0], 2):
+            out[z // 2] = downsample(volume[z : z + 2], self.label)[0]
+
+        return out
+
+
+_pyramids = dict()
+_pyramids_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="annotat3d_pyramid")
+
+
+def _get_pyramid(image_id: str):
+    version = data_repo.get_image_version(image_id)
+
+    with _pyramids_lock:
+        pyramid = _pyramids.get(image_id, None)
+        if pyramid is None or pyramid.version != version:
+            pyramid = ImagePyramid(version, is_label_volume(image_id))
+            _pyramids[image_id] = pyramid
+
+    return pyramid
+
+
+def get_level(image_id: str, level: int):
+    """
+    Function that gets a pyramid level of an image in data_repo, building it if needed
+
+    Args:
+        image_id (str): image key in data_repo
+        level (int): pyramid level, 0 is the volume itself
+
+    Returns:
+        (np.ndarray): the volume downsampled by 2**level, or None if the image doesn't exist
+
+    """
+    if level < 0 or level > MAX_LEVEL:
+        raise ValueError("Invalid pyramid level {}. Possible values: 0 to {}".format(level, MAX_LEVEL))
+
+    volume = data_repo.get_image(image_id, lazy=True)
+
+    if volume is None:
+        with _pyramids_lock:
+            _pyramids.pop(image_id, None)
+        return None
+
+    if level == 0:
+        return volume
+
+    return _get_pyramid(image_id).get_level(volume, level)
+
+
+def _build(image_id: str, level: int):
+    try:
+        get_level(image_id, level)
+    except Exception as e:
+        logging.warning("Failed to build the pyramid of {}: {}".format(image_id, e))
+
+
+def build_async(image_id: str, level: int = None):
+    """
+    Function that builds the pyramid of an image in background
+
+    Args:
+        image_id (str): image key in data_repo
+        level (int): the last level built, MAX_LEVEL by default
+
+    Returns:
+        None
+
+    """
+    level = MAX_LEVEL if level is None else level
+
+    if level > 0:
+        _executor.submit(_build, image_id, level)
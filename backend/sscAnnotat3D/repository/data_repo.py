@@ -5,10 +5,12 @@ saved on the backend
 
 import numpy as np
 
+from . import feature_cache, image_store, slice_cache
+
 """
-dict that contains the loaded image, superpixel and label
+storage backend that contains the loaded image, superpixel and label
 """
-__images = dict()
+__images = image_store.create_store()
 
 """
 dict that contains the annotations and their respective coordinates
@@ -47,6 +49,8 @@ def contiguous(array: np.ndarray) -> np.ndarray:
     """
     Check if the array is configous if not, make it contigous (bug fixfor the cython wrapper in backend spin).
 
+    Notes:
+        Memory-mapped and on-disk volumes are returned untouched, copying them would read the whole file into RAM.
 
     Args:
         array (np.ndarray): contigous, none or non contigous array
@@ -54,7 +58,7 @@ def contiguous(array: np.ndarray) -> np.ndarray:
         array (np.ndarray): contigous array
 
     """
-    if array is None:
+    if not isinstance(array, np.ndarray) or isinstance(array, np.memmap):
         pass
 
     elif not array.flags["C_CONTIGUOUS"]:
@@ -119,6 +123,50 @@ def get_superpixel_state():
     return __superpixel_state
 
 
+def set_storage_backend(backend: str = "memory", **kwargs):
+    """
+    Function that changes the storage backend used for images, superpixels and labels
+
+    Notes:
+        The volumes already loaded are moved to the new backend.
+
+    Args:
+        backend(str): backend name, "memory", "hdf5" or "shm"
+        **kwargs: options forwarded to the backend, see image_store.create_store
+
+    Returns:
+        None
+
+    """
+    global __images
+    new_store = image_store.create_store(backend, **kwargs)
+
+    for key in __images.keys():
+        data = __images.get(key)
+        if isinstance(data, image_store.ChunkedVolume):
+            data = np.asarray(data)
+        elif isinstance(data, np.ndarray) and __images.name == image_store.SharedMemoryImageStore.name:
+            # shared segments are released when the old backend is closed
+            data = data.copy()
+        new_store.set(key, contiguous(data))
+
+    __images.close()
+    __images = new_store
+    slice_cache.clear()
+    feature_cache.clear()
+
+
+def get_storage_backend():
+    """
+    Function that gets the name of the storage backend in use
+
+    Returns:
+        (str): backend name, "memory", "hdf5" or "shm"
+
+    """
+    return __images.name
+
+
 def set_image(key="image", data: np.ndarray = None):
     """
     Function that set an image, superpixel or label
@@ -132,21 +180,50 @@ def set_image(key="image", data: np.ndarray = None):
 
     """
     if data is not None:
-        __images[key] = contiguous(data)
+        __images.set(key, contiguous(data))
+        slice_cache.invalidate(key)
+        feature_cache.invalidate(key)
 
 
-def get_image(key="image"):
+def get_image(key="image", lazy: bool = False):
     """
     Function that get an image, superpixel or label
 
+    Notes:
+        With the hdf5 backend, lazy=True returns an image_store.ChunkedVolume, where slicing only decompresses the
+        chunks touched. Otherwise, the whole volume is read as a np.ndarray.
+
     Args:
         key(str): This key can be "image", "superpixel" or "label"
+        lazy(bool): if True, returns the on-disk volume without reading it into RAM
 
     Returns:
         (np.ndarray): returns the data based on the key
 
     """
-    return contiguous(__images.get(key, None))
+    data = __images.get(key)
+
+    if isinstance(data, image_store.ChunkedVolume) and not lazy:
+        data = np.asarray(data)
+
+    return contiguous(data)
+
+
+def get_image_version(key="image"):
+    """
+    Function that gets the version of an image, superpixel or label
+
+    Notes:
+        The version changes every time the data is set, so it can be used to key caches of derived data.
+
+    Args:
+        key(str): This key can be "image", "superpixel" or "label"
+
+    Returns:
+        (int): the version, or None if there's no data for this key
+
+    """
+    return __images.version(key)
 
 
 def get_images_keys():
@@ -158,7 +235,7 @@ def get_images_keys():
         list: list of avaible keys
 
     """
-    return list(__images.keys())  # + list(__annotations.keys())
+    return __images.keys()  # + list(__annotations.keys())
 
 
 def delete_image(key="image"):
@@ -172,7 +249,9 @@ def delete_image(key="image"):
         None
 
     """
-    del __images[key]
+    __images.delete(key)
+    slice_cache.invalidate(key)
+    feature_cache.invalidate(key)
 
 
 def set_annotation(key="annotation", data: dict = None):
@@ -311,3 +390,39 @@ def loadedEnv(key="loaded"):
     _loadedEnv["loaded"] = True
 
     return previous
+
+
+def get_session_state():
+    """
+    Function that gets the session state that is not a volume: image info, superpixel state, feature extraction
+    params, classification model and annotations
+
+    Returns:
+        (dict): the state, used by sscAnnotat3D.snapshot
+
+    """
+    return {
+        "info": dict(__info),
+        "superpixel_state": dict(__superpixel_state),
+        "feature_extraction_params": dict(__feature_extraction_params),
+        "model_complete": dict(__model_complete),
+        "annotations": dict(__annotations),
+    }
+
+
+def set_session_state(state: dict):
+    """
+    Function that restores the session state saved by get_session_state
+
+    Args:
+        state (dict): the state returned by get_session_state
+
+    Returns:
+        None
+
+    """
+    __info.update(state.get("info", {}))
+    __superpixel_state.update(state.get("superpixel_state", {}))
+    __feature_extraction_params.update(state.get("feature_extraction_params", {}))
+    __model_complete.update(state.get("model_complete", {}))
+    __annotations.update(state.get("annotations", {}))
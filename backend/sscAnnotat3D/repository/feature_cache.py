@@ -0,0 +1,235 @@
+"""
+This script contains the cache of the superpixel features of the whole volume, shared by the segmentation modules.
+
+The segmentation module is created again on every train, so the features extracted by an execute would be lost. They are
+kept here under a hash of the image and superpixel versions (see data_repo.get_image_version) and the feature extraction
+parameters, so train, preview and execute reuse them while the image, the superpixels and the parameters don't change.
+
+Features are kept in RAM up to ANNOTAT3D_FEATURE_CACHE_BYTES (1 GB by default, least recently used features are evicted
+first). Larger features are spilled to a .npy file in ANNOTAT3D_FEATURE_CACHE_PATH (a directory in the system temp dir by
+default) and memory-mapped when read, only the last ANNOTAT3D_FEATURE_CACHE_SPILLED (2 by default) files are kept.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+def make_key(image_version, superpixel_version, features_args: dict, sigmas, min_superpixel_label: int):
+    """
+    Function that builds the key of the superpixel features
+
+    Args:
+        image_version (int): version of the image in data_repo
+        superpixel_version (int): version of the superpixels in data_repo
+        features_args (dict): feature flags and pooling, see SuperpixelSegmentationModule._get_feature_args
+        sigmas (array_like): sigmas of the features
+        min_superpixel_label (int): superpixel id of the first row of the features
+
+    Returns:
+        (str): hash of the parameters, or None if a version is unknown (the data is not in data_repo)
+
+    """
+    if image_version is None or superpixel_version is None:
+        return None
+
+    params = {
+        "image": image_version,
+        "superpixel": superpixel_version,
+        "features_args": features_args,
+        "sigmas": [float(s) for s in np.ravel(sigmas)],
+        "min_superpixel_label": int(min_superpixel_label),
+    }
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class FeatureCache:
+    """
+    Thread safe cache of feature arrays, in RAM up to a budget in bytes and memory-mapped from disk above it
+
+    Args:
+        max_bytes (int): maximum number of bytes kept in RAM
+        spill_path (str): directory of the spilled features
+        max_spilled (int): maximum number of spilled features kept on disk
+
+    """
+
+    def __init__(self, max_bytes: int, spill_path: str, max_spilled: int):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.max_spilled = max_spilled
+        # key -> (features, spill file or None, image keys the features depend on)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, features: np.ndarray, depends_on: tuple = ("image", "superpixel")):
+        if key is None:
+            return
+
+        spill_file = None
+
+        if features.nbytes > self.max_bytes:
+            if self.max_spilled <= 0:
+                return
+            try:
+                os.makedirs(self.spill_path, exist_ok=True)
+                spill_file = os.path.join(self.spill_path, "{}.{}.npy".format(key, uuid.uuid4().hex[:8]))
+                np.save(spill_file, features)
+                features = np.load(spill_file, mmap_mode="c")
+            except OSError as e:
+                logging.warning("Unable to spill the superpixel features to {}: {}".format(self.spill_path, e))
+                return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (features, spill_file, tuple(depends_on))
+
+            if spill_file is None:
+                self._nbytes += features.nbytes
+
+            while self._nbytes > self.max_bytes:
+                self._remove(next(k for k, entry in self._entries.items() if entry[1] is None))
+
+            spilled = [k for k, entry in self._entries.items() if entry[1] is not None]
+            for k in spilled[: max(0, len(spilled) - self.max_spilled)]:
+                self._remove(k)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        features, spill_file, _ = entry
+
+        if spill_file is None:
+            self._nbytes -= features.nbytes
+        else:
+            del features
+            try:
+                os.remove(spill_file)
+            except OSError:
+                # still mapped by a running segmentation on some platforms, it's a temp file anyway
+                pass
+
+    def invalidate(self, image_key: str):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if image_key in entry[2]]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": self._hits / requests if requests > 0 else 0.0,
+                "entries": len(self._entries),
+                "spilled": sum(1 for entry in self._entries.values() if entry[1] is not None),
+                "bytes": self._nbytes,
+                "maxBytes": self.max_bytes,
+            }
+
+
+_cache = FeatureCache(
+    int(os.environ.get("ANNOTAT3D_FEATURE_CACHE_BYTES", 1024 * 1024 * 1024)),
+    os.environ.get("ANNOTAT3D_FEATURE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "annotat3d_features")),
+    int(os.environ.get("ANNOTAT3D_FEATURE_CACHE_SPILLED", 2)),
+)
+
+
+def get(key: str):
+    """
+    Function that gets features from the cache
+
+    Args:
+        key(str): key built by make_key
+
+    Returns:
+        (np.ndarray): the features (copy-on-write memmap if spilled), or None if they're not in the cache
+
+    """
+    return _cache.get(key)
+
+
+def put(key: str, features: np.ndarray, depends_on: tuple = ("image", "superpixel")):
+    """
+    Function that adds features to the cache, spilling them to disk if they don't fit in RAM
+
+    Args:
+        key(str): key built by make_key, nothing is cached if it's None
+        features(np.ndarray): the features
+        depends_on(tuple): image keys of data_repo the features were computed from
+
+    Returns:
+        None
+
+    """
+    _cache.put(key, features, depends_on)
+
+
+def invalidate(image_key: str):
+    """
+    Function that removes the features computed from an image
+
+    Args:
+        image_key(str): image key in data_repo, e.g. "image" or "superpixel"
+
+    Returns:
+        None
+
+    """
+    _cache.invalidate(image_key)
+
+
+def clear():
+    """
+    Function that removes all features from the cache
+
+    Returns:
+        None
+
+    """
+    _cache.clear()
+
+
+def stats():
+    """
+    Function that gets the cache statistics
+
+    Returns:
+        (dict): hits, misses, hitRate, entries, spilled, bytes and maxBytes
+
+    """
+    return _cache.stats()
@@ -0,0 +1,489 @@
+"""
+This script contains the storage backends used by data_repo to keep the image, superpixel and label volumes.
+
+The default backend keeps every volume in RAM, as annotat3d always did. The hdf5 backend writes each volume to its own
+chunked and compressed file, so volumes larger than RAM stay on disk and a slice read only decompresses the chunks it
+touches. The shm backend places volumes in shared memory segments, so several server processes can read them without
+copying.
+"""
+
+import fcntl
+import itertools
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import h5py
+import numpy as np
+
+"""
+counter used to version the volumes of the in-process backends, a volume set after a delete never reuses a version
+"""
+_versions_counter = itertools.count(1)
+
+
+def _is_simple_index(key) -> bool:
+    """
+    Check if an index can be handled directly by h5py (ints, slices with positive step and Ellipsis)
+
+    Args:
+        key: index used in __getitem__ or __setitem__
+
+    Returns:
+        (bool): True if h5py can read or write the selection without materializing the volume
+
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    for k in key:
+        if k is Ellipsis or isinstance(k, (int, np.integer)):
+            continue
+        if isinstance(k, slice) and (k.step is None or k.step > 0):
+            continue
+        return False
+
+    return True
+
+
+class ChunkedVolume(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    ndarray-like view over a chunked HDF5 dataset.
+
+    Indexing with ints and slices only reads (or writes) the chunks touched by the selection. Any other numpy
+    operation materializes the whole volume in RAM through __array__.
+
+    Args:
+        dataset (h5py.Dataset): dataset that holds the volume
+
+    """
+
+    def __init__(self, dataset: h5py.Dataset):
+        self._dataset = dataset
+
+    @property
+    def dataset(self) -> h5py.Dataset:
+        return self._dataset
+
+    @property
+    def shape(self) -> tuple:
+        return self._dataset.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dataset.dtype
+
+    @property
+    def ndim(self) -> int:
+        return self._dataset.ndim
+
+    @property
+    def size(self) -> int:
+        return self._dataset.size
+
+    @property
+    def nbytes(self) -> int:
+        return self._dataset.size * self._dataset.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            key = tuple(key)
+
+        if _is_simple_index(key):
+            return self._dataset[key]
+
+        return np.asarray(self)[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, list):
+            key = tuple(key)
+
+        if _is_simple_index(key):
+            self._dataset[key] = np.asarray(value, dtype=self.dtype)
+        else:
+            data = np.asarray(self)
+            data[key] = value
+            self._dataset[...] = data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._dataset[...]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(np.asarray(x) if isinstance(x, ChunkedVolume) else x for x in inputs)
+        if "out" in kwargs:
+            kwargs["out"] = tuple(np.asarray(x) if isinstance(x, ChunkedVolume) else x for x in kwargs["out"])
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # ndarray methods (astype, min, max, copy, ...) are applied over the materialized volume
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(np.asarray(self), name)
+
+
+class MemoryImageStore:
+    """
+    Backend that keeps every volume as an in-RAM np.ndarray. This is the default backend.
+
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._images = dict()
+        self._versions = dict()
+
+    def get(self, key: str):
+        return self._images.get(key, None)
+
+    def version(self, key: str):
+        return self._versions.get(key, None)
+
+    def set(self, key: str, data):
+        self._images[key] = data
+        self._versions[key] = next(_versions_counter)
+
+    def delete(self, key: str):
+        del self._images[key]
+        del self._versions[key]
+
+    def keys(self) -> list:
+        return list(self._images.keys())
+
+    def close(self):
+        self._images.clear()
+        self._versions.clear()
+
+
+class HDF5ImageStore:
+    """
+    Backend that writes each 3D volume to a chunked and compressed HDF5 file.
+
+    Notes:
+        Scalars, 2D data and other small objects (e.g. "GeodesicTresh") are kept in RAM, as only volumes benefit from
+        chunked storage.
+
+    Args:
+        path (str): directory where the volumes are stored. A temporary directory is created if it's None
+        chunk_size (int): size of each chunk edge
+        compression (str): h5py compression filter ("lzf", "gzip" or "none")
+
+    """
+
+    name = "hdf5"
+
+    def __init__(self, path: str = None, chunk_size: int = 64, compression: str = "lzf"):
+        self._owns_path = path is None
+        self.path = tempfile.mkdtemp(prefix="annotat3d_") if path is None else path
+        os.makedirs(self.path, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.compression = None if compression in (None, "", "none") else compression
+        self._files = dict()
+        self._versions = dict()
+        self._memory = MemoryImageStore()
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, "{}.h5".format(key))
+
+    def _chunks(self, shape: tuple) -> tuple:
+        return tuple(max(1, min(self.chunk_size, s)) for s in shape)
+
+    def get(self, key: str):
+        if key in self._files:
+            return ChunkedVolume(self._files[key]["data"])
+
+        return self._memory.get(key)
+
+    def version(self, key: str):
+        return self._versions.get(key, None)
+
+    def set(self, key: str, data):
+        self._versions[key] = next(_versions_counter)
+
+        if isinstance(data, ChunkedVolume) and key in self._files and data.dataset == self._files[key]["data"]:
+            return
+
+        if not isinstance(data, (np.ndarray, ChunkedVolume)) or data.ndim != 3:
+            self._delete_file(key)
+            self._memory.set(key, data)
+            return
+
+        if key in self._memory.keys():
+            self._memory.delete(key)
+
+        self._write(key, data)
+
+    def _write(self, key: str, data):
+        tmp_filename = self._filename(key) + ".tmp"
+        with h5py.File(tmp_filename, "w") as f:
+            dataset = f.create_dataset(
+                "data", shape=data.shape, dtype=data.dtype, chunks=self._chunks(data.shape), compression=self.compression
+            )
+            # writes by slabs of chunks, so memory-mapped or on-disk inputs are never read as a whole
+            step = dataset.chunks[0]
+            for z in range(0, data.shape[0], step):
+                dataset[z : z + step] = data[z : z + step]
+
+        self._delete_file(key)
+        os.replace(tmp_filename, self._filename(key))
+        self._files[key] = h5py.File(self._filename(key), "r+")
+
+    def _delete_file(self, key: str):
+        f = self._files.pop(key, None)
+        if f is not None:
+            f.close()
+            os.remove(self._filename(key))
+
+    def delete(self, key: str):
+        if key in self._files:
+            self._delete_file(key)
+        else:
+            self._memory.delete(key)
+        del self._versions[key]
+
+    def keys(self) -> list:
+        return list(self._files.keys()) + self._memory.keys()
+
+    def close(self):
+        for key in list(self._files.keys()):
+            self._delete_file(key)
+        self._memory.close()
+        self._versions.clear()
+        if self._owns_path:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SharedMemoryImageStore:
+    """
+    Backend that places each np.ndarray in a multiprocessing.shared_memory segment.
+
+    A json registry (guarded by a file lock) maps each key to its segment name, shape, dtype and version, so every
+    process using the same path sees the same volumes. Arrays returned by get are views over the shared segment, in-place
+    changes are seen by all processes. Other objects (e.g. "GeodesicTresh") are pickled next to the registry.
+
+    Notes:
+        Segments are owned by the registry, not by the process that created them, so they are only released by delete
+        or close.
+
+    Args:
+        path (str): directory of the registry, all processes must use the same path
+
+    """
+
+    name = "shm"
+
+    def __init__(self, path: str = None):
+        self.path = os.path.join(tempfile.gettempdir(), "annotat3d_shm") if path is None else path
+        os.makedirs(self.path, exist_ok=True)
+        self._registry_filename = os.path.join(self.path, "registry.json")
+        self._lock_filename = os.path.join(self.path, "registry.lock")
+        # per process attachments: key -> (version, value, shared_memory.SharedMemory or None)
+        self._attached = dict()
+
+    @contextmanager
+    def _lock(self, exclusive: bool = False):
+        with open(self._lock_filename, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_registry(self) -> dict:
+        if not os.path.isfile(self._registry_filename):
+            return dict()
+
+        with open(self._registry_filename, "r") as f:
+            return json.load(f)
+
+    def _write_registry(self, registry: dict):
+        tmp_filename = self._registry_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(registry, f)
+        os.replace(tmp_filename, self._registry_filename)
+
+    def _object_filename(self, key: str) -> str:
+        return os.path.join(self.path, "{}.pkl".format(key))
+
+    @staticmethod
+    def _open_segment(segment: str, create: bool = False, size: int = 0) -> shared_memory.SharedMemory:
+        shm = shared_memory.SharedMemory(name=segment, create=create, size=size)
+        # the resource tracker would unlink the segment when this process exits, even if others still use it
+        if sys.version_info < (3, 13):
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    def _detach(self, key: str):
+        attached = self._attached.pop(key, None)
+        if attached is not None and attached[2] is not None:
+            try:
+                attached[2].close()
+            except BufferError:
+                # there are still views over the old segment, the mapping is released along with them
+                pass
+
+    def _release(self, entry: dict, key: str):
+        if entry["kind"] == "array":
+            try:
+                shm = self._open_segment(entry["segment"])
+                shm.close()
+                if sys.version_info < (3, 13):
+                    # unlink also unregisters the segment from the resource tracker
+                    resource_tracker.register(shm._name, "shared_memory")
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        elif os.path.isfile(self._object_filename(key)):
+            os.remove(self._object_filename(key))
+
+    def get(self, key: str):
+        with self._lock():
+            entry = self._read_registry().get(key, None)
+
+        if entry is None:
+            self._detach(key)
+            return None
+
+        attached = self._attached.get(key, None)
+        if attached is not None and attached[0] == entry["version"]:
+            return attached[1]
+
+        self._detach(key)
+        if entry["kind"] == "array":
+            shm = self._open_segment(entry["segment"])
+            value = np.ndarray(tuple(entry["shape"]), dtype=np.dtype(entry["dtype"]), buffer=shm.buf)
+        else:
+            shm = None
+            with open(self._object_filename(key), "rb") as f:
+                value = pickle.load(f)
+
+        self._attached[key] = (entry["version"], value, shm)
+        return value
+
+    def version(self, key: str):
+        with self._lock():
+            entry = self._read_registry().get(key, None)
+
+        return None if entry is None else entry["version"]
+
+    def set(self, key: str, data):
+        attached = self._attached.get(key, None)
+        in_place = attached is not None and attached[2] is not None and data is attached[1]
+
+        if in_place:
+            # data is already the shared segment, only the version must change so other processes reload it
+            shm = attached[2]
+            entry = None
+        elif isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            segment = "annotat3d_{}".format(uuid.uuid4().hex[:16])
+            shm = self._open_segment(segment, create=True, size=max(1, data.nbytes))
+            value = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            value[...] = data
+            entry = {"kind": "array", "segment": segment, "shape": list(data.shape), "dtype": data.dtype.str}
+        else:
+            shm = None
+            value = data
+            entry = {"kind": "object"}
+
+        with self._lock(exclusive=True):
+            registry = self._read_registry()
+            old_entry = registry.get(key, None)
+            # time based, so a volume set after a delete never reuses a version
+            version = time.time_ns() if old_entry is None else max(time.time_ns(), old_entry["version"] + 1)
+
+            if in_place:
+                registry[key]["version"] = version
+            else:
+                if entry["kind"] == "object":
+                    with open(self._object_filename(key), "wb") as f:
+                        pickle.dump(data, f)
+                if old_entry is not None and (old_entry["kind"] == "array" or entry["kind"] == "array"):
+                    self._release(old_entry, key)
+                entry["version"] = version
+                registry[key] = entry
+
+            self._write_registry(registry)
+
+        if in_place:
+            self._attached[key] = (version, attached[1], shm)
+        else:
+            self._detach(key)
+            self._attached[key] = (version, value, shm)
+
+    def delete(self, key: str):
+        with self._lock(exclusive=True):
+            registry = self._read_registry()
+            entry = registry.pop(key)
+            self._write_registry(registry)
+            self._release(entry, key)
+
+        self._detach(key)
+
+    def keys(self) -> list:
+        with self._lock():
+            return list(self._read_registry().keys())
+
+    def close(self):
+        with self._lock(exclusive=True):
+            registry = self._read_registry()
+            for key, entry in registry.items():
+                self._release(entry, key)
+            self._write_registry(dict())
+
+        for key in list(self._attached.keys()):
+            self._detach(key)
+
+
+_backends = {
+    MemoryImageStore.name: MemoryImageStore,
+    HDF5ImageStore.name: HDF5ImageStore,
+    SharedMemoryImageStore.name: SharedMemoryImageStore,
+}
+
+
+def create_store(backend: str = None, **kwargs):
+    """
+    Create a storage backend by name
+
+    Notes:
+        When backend is None, the backend is read from the env variable ANNOTAT3D_STORAGE_BACKEND ("memory" by default).
+        The hdf5 backend also reads ANNOTAT3D_STORAGE_PATH, ANNOTAT3D_STORAGE_CHUNK and ANNOTAT3D_STORAGE_COMPRESSION
+        when these options are not given, the shm backend reads ANNOTAT3D_STORAGE_PATH.
+
+    Args:
+        backend (str): backend name, "memory", "hdf5" or "shm"
+        **kwargs: options forwarded to the backend constructor
+
+    Returns:
+        (MemoryImageStore | HDF5ImageStore | SharedMemoryImageStore): the storage backend
+
+    """
+    if backend is None:
+        backend = os.environ.get("ANNOTAT3D_STORAGE_BACKEND", MemoryImageStore.name)
+
+    backend = backend.lower()
+    if backend not in _backends:
+        raise ValueError("Unknown storage backend {}. Possible values: {}".format(backend, list(_backends.keys())))
+
+    if backend == HDF5ImageStore.name:
+        kwargs.setdefault("path", os.environ.get("ANNOTAT3D_STORAGE_PATH", None))
+        kwargs.setdefault("chunk_size", int(os.environ.get("ANNOTAT3D_STORAGE_CHUNK", 64)))
+        kwargs.setdefault("compression", os.environ.get("ANNOTAT3D_STORAGE_COMPRESSION", "lzf"))
+    elif backend == SharedMemoryImageStore.name:
+        kwargs.setdefault("path", os.environ.get("ANNOTAT3D_STORAGE_PATH", None))
+
+    return _backends[backend](**kwargs)
@@ -0,0 +1,168 @@
+"""
+This script contains a byte-budgeted LRU cache for the compressed slices sent to the frontend.
+
+Each entry is keyed by a tuple that starts with the image key, followed by the image version and the request parameters
+(axis, slice, contour, ...). As the version changes on every data_repo.set_image, stale entries are never served, and
+data_repo also invalidates them to release their memory.
+
+The budget is read from the env variable ANNOTAT3D_SLICE_CACHE_BYTES (256 MB by default, 0 disables the cache).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class SliceCache:
+    """
+    Thread safe LRU cache of compressed slices with a budget in bytes
+
+    Args:
+        max_bytes (int): maximum number of bytes kept in the cache
+
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            payload = self._entries.get(key, None)
+
+            if payload is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+
+            return payload
+
+    def contains(self, key: tuple) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: tuple, payload: bytes):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old_payload = self._entries.pop(key, None)
+            if old_payload is not None:
+                self._nbytes -= len(old_payload)
+
+            self._entries[key] = payload
+            self._nbytes += size
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= len(evicted)
+
+    def invalidate(self, image_key: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == image_key]:
+                self._nbytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hitRate": self._hits / requests if requests > 0 else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "maxBytes": self.max_bytes,
+            }
+
+
+_cache = SliceCache(int(os.environ.get("ANNOTAT3D_SLICE_CACHE_BYTES", 256 * 1024 * 1024)))
+
+
+def get(key: tuple):
+    """
+    Function that gets a compressed slice from the cache
+
+    Args:
+        key(tuple): (image key, image version, request parameters ...)
+
+    Returns:
+        (bytes): the cached payload, or None if it's not in the cache
+
+    """
+    return _cache.get(key)
+
+
+def contains(key: tuple):
+    """
+    Function that checks if a slice is in the cache, without changing the hit/miss counters
+
+    Args:
+        key(tuple): (image key, image version, request parameters ...)
+
+    Returns:
+        (bool): True if the slice is in the cache
+
+    """
+    return _cache.contains(key)
+
+
+def put(key: tuple, payload: bytes):
+    """
+    Function that adds a compressed slice to the cache, evicting the least recently used slices if needed
+
+    Args:
+        key(tuple): (image key, image version, request parameters ...)
+        payload(bytes): compressed slice
+
+    Returns:
+        None
+
+    """
+    _cache.put(key, payload)
+
+
+def invalidate(image_key: str):
+    """
+    Function that removes all slices of an image from the cache
+
+    Args:
+        image_key(str): image key in data_repo, e.g. "image", "superpixel" or "label"
+
+    Returns:
+        None
+
+    """
+    _cache.invalidate(image_key)
+
+
+def clear():
+    """
+    Function that removes all slices from the cache
+
+    Returns:
+        None
+
+    """
+    _cache.clear()
+
+
+def stats():
+    """
+    Function that gets the cache counters
+
+    Returns:
+        (dict): hits, misses, hitRate, entries, bytes and maxBytes
+
+    """
+    return _cache.stats()
@@ -0,0 +1,266 @@
+"""
+This script contains the wire formats used to send slices to the frontend.
+
+The default encoding ("zlib") is the npy file of the slice compressed with zlib, as the frontend always received. The
+other encodings send the raw little-endian buffer of the slice, with its dtype and shape in the response headers:
+
+    - "raw": uncompressed buffer
+    - "lz4": buffer compressed with lz4 frames (requires the lz4 package)
+    - "zstd": buffer compressed with zstandard (requires the zstandard package)
+
+The encoding is chosen by the "encoding" field of the request json or, if it's missing, by the Accept header. Encodings
+whose package is not installed fall back to zlib.
+"""
+
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+from flask import Response, send_file
+from sscAnnotat3D import utils
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_ENCODING = "zlib"
+
+_mimetypes = {
+    "zlib": "application/gzip",
+    "zstd": "application/zstd",
+    "lz4": "application/x-lz4",
+    "raw": "application/octet-stream",
+}
+
+_headers = ("X-Slice-Encoding", "X-Slice-Dtype", "X-Slice-Shape")
+
+TILES_MIMETYPE = "application/x-annotat3d-tiles"
+
+
+def available_encodings():
+    """
+    Function that gets the encodings that can be used in this environment
+
+    Returns:
+        (list): list of encodings, e.g. ["zlib", "raw", "lz4"]
+
+    """
+    encodings = [DEFAULT_ENCODING, "raw"]
+
+    if lz4_frame is not None:
+        encodings.append("lz4")
+
+    if zstandard is not None:
+        encodings.append("zstd")
+
+    return encodings
+
+
+def negotiate(request):
+    """
+    Function that chooses the encoding of a slice request
+
+    Args:
+        request (flask.Request): the slice request
+
+    Returns:
+        (str): the encoding, zlib if the requested one is not available
+
+    """
+    encoding = request.json.get("encoding", None) if request.is_json else None
+
+    if encoding is None:
+        mimetype = request.accept_mimetypes.best_match(list(_mimetypes.values()), default=_mimetypes[DEFAULT_ENCODING])
+        encoding = next(key for key, value in _mimetypes.items() if value == mimetype)
+
+    if encoding not in available_encodings():
+        encoding = DEFAULT_ENCODING
+
+    return encoding
+
+
+class EncodedSlice:
+    """
+    A slice encoded to be sent to the frontend, it can be kept in the slice cache.
+
+    Args:
+        payload (bytes): the encoded slice
+        encoding (str): the encoding used
+        shape (tuple): the slice shape
+        dtype (np.dtype): the slice dtype
+
+    """
+
+    __slots__ = ("payload", "encoding", "shape", "dtype")
+
+    def __init__(self, payload: bytes, encoding: str, shape: tuple, dtype: np.dtype):
+        self.payload = payload
+        self.encoding = encoding
+        self.shape = shape
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.payload)
+
+    def to_response(self):
+        """
+        Build the flask response of the slice
+
+        Returns:
+            (flask.Response): the response, the zlib encoding keeps the same response of send_file as before
+
+        """
+        if self.encoding == DEFAULT_ENCODING:
+            return send_file(io.BytesIO(self.payload), _mimetypes[DEFAULT_ENCODING])
+
+        response = Response(self.payload, mimetype=_mimetypes[self.encoding])
+        response.headers["X-Slice-Encoding"] = self.encoding
+        response.headers["X-Slice-Dtype"] = self.dtype.str
+        response.headers["X-Slice-Shape"] = ",".join(str(s) for s in self.shape)
+        response.headers["Access-Control-Expose-Headers"] = ", ".join(_headers)
+        return response
+
+
+def encode(img_slice: np.ndarray, encoding: str = DEFAULT_ENCODING):
+    """
+    Function that encodes a slice
+
+    Notes:
+        The raw buffer is read from the slice without copying when the slice is contiguous and little-endian. WSGI
+        servers only write bytes, so the raw encoding still makes a single copy of the slice.
+
+    Args:
+        img_slice (np.ndarray): the slice
+        encoding (str): "zlib", "raw", "lz4" or "zstd"
+
+    Returns:
+        (EncodedSlice): the encoded slice
+
+    """
+    if encoding == DEFAULT_ENCODING:
+        payload = zlib.compress(utils.toNpyBytes(img_slice))
+        return EncodedSlice(payload, encoding, img_slice.shape, img_slice.dtype)
+
+    img_slice = np.ascontiguousarray(img_slice, dtype=img_slice.dtype.newbyteorder("<"))
+    buffer = memoryview(img_slice).cast("B")
+
+    if encoding == "raw":
+        payload = buffer.tobytes()
+    elif encoding == "lz4":
+        payload = lz4_frame.compress(buffer)
+    elif encoding == "zstd":
+        payload = zstandard.ZstdCompressor(level=1).compress(buffer)
+    else:
+        raise ValueError("Unknown slice encoding {}. Possible values: {}".format(encoding, available_encodings()))
+
+    return EncodedSlice(payload, encoding, img_slice.shape, img_slice.dtype)
+
+
+def pack_tiles(tiles: list):
+    """
+    Function that packs several encoded slices (tiles) in a single response
+
+    Notes:
+        The body starts with the size of a json header as a little-endian uint32, followed by the json header and by
+        the payloads. The header is a list with the offset (from the end of the header), length, encoding, dtype and
+        shape of each tile, in the same order of the request. A tile that could not be built has a null entry.
+
+    Args:
+        tiles (list): list of EncodedSlice (or None)
+
+    Returns:
+        (flask.Response): the packed tiles
+
+    """
+    header = []
+    offset = 0
+
+    for tile in tiles:
+        if tile is None:
+            header.append(None)
+            continue
+
+        header.append(
+            {
+                "offset": offset,
+                "length": len(tile),
+                "encoding": tile.encoding,
+                "dtype": tile.dtype.str,
+                "shape": list(tile.shape),
+            }
+        )
+        offset += len(tile)
+
+    header = json.dumps(header).encode("utf-8")
+    body = b"".join([struct.pack("<I", len(header)), header] + [tile.payload for tile in tiles if tile is not None])
+
+    return Response(body, mimetype=TILES_MIMETYPE)
+
+
+def encode_delta(before: np.ndarray, after: np.ndarray, version: int = None):
+    """
+    Function that encodes the change of an annotation slice, so the frontend can patch its copy in place
+
+    Notes:
+        The patch is the bounding box of the changed pixels in the new slice, run-length encoded in row-major order:
+        "values" holds the value of each run and "counts" its length.
+
+    Args:
+        before (np.ndarray): 2D slice before the change
+        after (np.ndarray): 2D slice after the change
+        version (int): version of the annotation after the change
+
+    Returns:
+        (dict): {"bbox": [x0, y0, x1, y1] or None if nothing changed, "rle": {"values": [...], "counts": [...]},
+            "version": version}
+
+    """
+    changed = before != after
+    rows = np.flatnonzero(changed.any(axis=1))
+
+    if rows.size == 0:
+        return encode_patch(None, None, version)
+
+    cols = np.flatnonzero(changed.any(axis=0))
+    y0, y1 = int(rows[0]), int(rows[-1]) + 1
+    x0, x1 = int(cols[0]), int(cols[-1]) + 1
+
+    return encode_patch((y0, y1, x0, x1), after[y0:y1, x0:x1], version)
+
+
+def encode_patch(bbox: tuple, window: np.ndarray, version: int = None):
+    """
+    Function that encodes a window of an annotation slice in the format of encode_delta, for changes whose bounding box
+    is already known
+
+    Args:
+        bbox (tuple): (row0, row1, col0, col1) of the window in the slice, or None if nothing changed
+        window (np.ndarray): 2D content of the window after the change
+        version (int): version of the annotation after the change
+
+    Returns:
+        (dict): see encode_delta
+
+    """
+    if bbox is None:
+        return {"bbox": None, "rle": {"values": [], "counts": []}, "version": version}
+
+    y0, y1, x0, x1 = (int(b) for b in bbox)
+
+    flat = np.ascontiguousarray(window).ravel()
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    counts = np.diff(np.concatenate((starts, [flat.size])))
+
+    return {
+        "bbox": [x0, y0, x1, y1],
+        "rle": {"values": flat[starts].tolist(), "counts": counts.tolist()},
+        "version": version,
+    }
@@ -0,0 +1,236 @@
+"""
+This script contains the builders of the encoded slices sent to the frontend.
+
+Each kind of slice (image, annotation, superpixel) has a builder that gets the encoded slice from the slice cache when
+possible, or reads, downsamples and encodes it otherwise. The builders are shared by the blueprints that serve slices
+and tiles, and are registered in the prefetcher, see prefetch.
+"""
+
+import time
+
+import numpy as np
+from harpia.watershed.watershed import boundaries
+from sscAnnotat3D import label, prefetch, pyramid, slice_encoding, utils
+from sscAnnotat3D.repository import data_repo, module_repo, slice_cache
+
+
+def image_slice(
+    axis: str,
+    slice_num: int,
+    prefetch: bool = False,
+    image_id: str = "image",
+    contour: bool = False,
+    encoding: str = slice_encoding.DEFAULT_ENCODING,
+    level: int = 0,
+    roi: tuple = None,
+):
+    """
+    Function that gets the encoded slice of an image, from the slice cache when possible
+
+    Args:
+        axis (str): The axis to be considered ('XY' | 'XZ' | 'YZ')
+        slice_num (int): the slice number
+        prefetch (bool): if True, only builds the slice if it's not cached (without counting a cache hit or miss)
+        image_id (str): image key in data_repo
+        contour (bool): if True, returns the contour of the labels in the slice
+        encoding (str): wire format of the slice, see slice_encoding
+        level (int): pyramid level, the slice is downsampled by 2**level
+        roi (tuple): (x0, y0, x1, y1) window of the slice in full resolution coordinates, or None for the whole slice
+
+    Returns:
+        (slice_encoding.EncodedSlice): the encoded slice, or None if it's already cached during a prefetch
+
+    """
+    factor = pyramid.scale(level)
+    # the full resolution slices of a level block share the same level slice
+    cache_key = (
+        image_id, data_repo.get_image_version(image_id), axis, slice_num // factor, bool(contour), encoding, level, roi
+    )
+
+    if prefetch:
+        if slice_cache.contains(cache_key):
+            return None
+    else:
+        encoded_slice = slice_cache.get(cache_key)
+        if encoded_slice is not None:
+            return encoded_slice
+
+    image = pyramid.get_level(image_id, level)
+    slice_range = utils.get_3d_slice_range_from(axis, slice_num // factor, roi=pyramid.scale_roi(roi, level))
+    img_slice = image[slice_range]
+
+    if contour:
+        img_slice = label.label_slice_contour(img_slice + 1) - 1
+
+    comp_st = time.time()
+    encoded_slice = slice_encoding.encode(img_slice, encoding)
+    comp_en = time.time()
+
+    if not prefetch:
+        print("{} encoding time: ".format(encoding), comp_en - comp_st)
+
+    slice_cache.put(cache_key, encoded_slice)
+
+    return encoded_slice
+
+
+def annotation_slice(
+    axis: str,
+    slice_num: int,
+    prefetch: bool = False,
+    encoding: str = slice_encoding.DEFAULT_ENCODING,
+    level: int = 0,
+    roi: tuple = None,
+):
+    """
+    Function that gets the encoded slice of the annotation, from the slice cache when possible
+
+    Args:
+        axis (str): The axis to be considered ('XY' | 'XZ' | 'YZ')
+        slice_num (int): the slice number
+        prefetch (bool): if True, only builds the slice if it's not cached (without counting a cache hit or miss)
+        encoding (str): wire format of the slice, see slice_encoding
+        level (int): pyramid level, the slice is downsampled by 2**level with the mode of each block
+        roi (tuple): (x0, y0, x1, y1) window of the slice in full resolution coordinates, or None for the whole slice
+
+    Returns:
+        (slice_encoding.EncodedSlice): the encoded slice, or None if there's no annotation (or it's already cached
+            during a prefetch)
+
+    """
+    if level < 0 or level > pyramid.MAX_LEVEL:
+        raise ValueError("Invalid pyramid level {}. Possible values: 0 to {}".format(level, pyramid.MAX_LEVEL))
+
+    annot_module = module_repo.get_module('annotation')
+
+    if (annot_module != None):
+        annotation_image = annot_module.annotation_image
+        cache_key = ('annotation', annot_module.version, axis, slice_num, encoding, level, roi)
+    else:
+        # with the shm storage backend, the annotation may have been created by another server process.
+        # Its in-place changes are not versioned, so it's never cached
+        annotation_image = data_repo.get_image('annotation', lazy=True)
+        cache_key = None
+
+    if annotation_image is None:
+        return None
+
+    if cache_key is not None:
+        if prefetch:
+            if slice_cache.contains(cache_key):
+                return None
+        else:
+            img_slice = slice_cache.get(cache_key)
+            if img_slice is not None:
+                return img_slice
+
+    if roi is not None and level > 0:
+        # the annotation changes on every stroke, so its levels are downsampled from the slice on demand.
+        # The roi is aligned to the level blocks to match the image pyramid
+        slice_shape = [s for i, s in enumerate(annotation_image.shape) if i != utils.get_axis_num(axis)]
+        roi = pyramid.align_roi(roi, level, slice_shape)
+
+    slice_range = utils.get_3d_slice_range_from(axis, slice_num, roi=roi)
+    img_slice = annotation_image[tuple(slice_range)]
+
+    img_slice = pyramid.downsample_slice(img_slice, level, label=True)
+
+    img_slice = slice_encoding.encode(img_slice, encoding)
+
+    if cache_key is not None:
+        slice_cache.put(cache_key, img_slice)
+
+    return img_slice
+
+
+def superpixel_slice(
+    axis: str,
+    slice_num: int,
+    prefetch: bool = False,
+    encoding: str = slice_encoding.DEFAULT_ENCODING,
+    roi: tuple = None,
+):
+    """
+    Function that gets the encoded borders of a superpixel slice, from the slice cache when possible
+
+    Args:
+        axis (str): The axis to be considered ('XY' | 'XZ' | 'YZ')
+        slice_num (int): the slice number
+        prefetch (bool): if True, only builds the slice if it's not cached (without counting a cache hit or miss)
+        encoding (str): wire format of the slice, see slice_encoding
+        roi (tuple): (x0, y0, x1, y1) window of the slice, or None for the whole slice
+
+    Returns:
+        (slice_encoding.EncodedSlice): the encoded slice, or None if it's already cached during a prefetch
+
+    """
+    cache_key = ("superpixel", data_repo.get_image_version("superpixel"), axis, slice_num, encoding, roi)
+
+    if prefetch:
+        if slice_cache.contains(cache_key):
+            return None
+    else:
+        compressed_slice_superpixels = slice_cache.get(cache_key)
+        if compressed_slice_superpixels is not None:
+            return compressed_slice_superpixels
+
+    img_superpixels = data_repo.get_image("superpixel", lazy=True)
+
+    if roi is not None:
+        # a halo of one pixel around the roi, so the borders on its edges match the ones of the whole slice
+        rows, cols = [s for i, s in enumerate(img_superpixels.shape) if i != utils.get_axis_num(axis)]
+        x0, y0, x1, y1 = roi
+        x1, y1 = min(x1, cols), min(y1, rows)
+        halo_roi = (max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, cols), min(y1 + 1, rows))
+        crop = (slice(y0 - halo_roi[1], y1 - halo_roi[1]), slice(x0 - halo_roi[0], x1 - halo_roi[0]))
+    else:
+        halo_roi = None
+        crop = (slice(None), slice(None))
+
+    slice_range = utils.get_3d_slice_range_from(axis, slice_num, roi=halo_roi)
+
+    slice_superpixels = img_superpixels[slice_range]
+
+    slice_superpixels = boundaries(slice_superpixels.astype(np.int32)).astype(np.uint8)
+    slice_superpixels = np.ascontiguousarray(slice_superpixels[crop])
+
+    compressed_slice_superpixels = slice_encoding.encode(slice_superpixels, encoding)
+
+    slice_cache.put(cache_key, compressed_slice_superpixels)
+
+    return compressed_slice_superpixels
+
+
+def annotation_delta(annot_module, axis: str, slice_num: int):
+    """
+    Function that encodes the window of an annotation slice changed by the last edit, see slice_encoding.encode_delta
+
+    Notes:
+        The 2D edit endpoints send this delta instead of their default response when the request json field "delta" is
+        set. Only the window changed, known by the annotation module, is read, so the cost depends on the size of the
+        edit and not on the size of the slice.
+
+    Args:
+        annot_module (AnnotationModule): the annotation module
+        axis (str): The axis to be considered ('XY' | 'XZ' | 'YZ')
+        slice_num (int): the slice number
+
+    Returns:
+        (dict): bbox, rle patch and version of the annotation
+
+    """
+    bbox = annot_module.changed_window(utils.get_axis_num(axis), slice_num)
+
+    if bbox is None:
+        return slice_encoding.encode_patch(None, None, annot_module.version)
+
+    y0, y1, x0, x1 = bbox
+    slice_range = utils.get_3d_slice_range_from(axis, slice_num, roi=(x0, y0, x1, y1))
+    window = annot_module.annotation_image[tuple(slice_range)]
+
+    return slice_encoding.encode_patch(bbox, window, annot_module.version)
+
+
+prefetch.register("image", image_slice)
+prefetch.register("annotation", annotation_slice)
+prefetch.register("superpixel", superpixel_slice)
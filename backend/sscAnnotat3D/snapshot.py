@@ -0,0 +1,337 @@
+"""
+This script contains the session snapshot, used to restore the workspace after a backend restart.
+
+A snapshot is a directory with:
+
+    - manifest.json: format version, the session that wrote it and, for each entry, its file, version, shape and dtype
+    - images/<key>.npy: the volumes of data_repo (image, label, superpixel, ...), as plain npy files so they can be
+      memory-mapped on restore
+    - annotation.bin: the annotation volume, as zlib compressed slabs of int16 slices (mostly -1, so it compresses well)
+    - state.pkl: the rest of data_repo (info, superpixel state, feature extraction params, classification model) and
+      the state of the annotation module (labels, markers, annotated slices, ...)
+
+Snapshots are incremental: saving again to the same directory in the same session only writes the volumes whose
+version changed since the last snapshot. Restoring memory-maps the volumes in copy-on-write mode, so only the slices
+that are used are read from disk.
+
+A snapshot saved in the background runs while the user keeps editing. The annotation module state and its sparse
+annotation planes are copied together at the start, so they always match. Dense volumes (the annotation with the shm
+backend or after 3D edits, and the volumes of data_repo) are too large to copy and are read slab by slab. An edit made
+during the save may then be only partly in the snapshot. The version recorded is always the one read before the
+volume, so the next snapshot to the same directory writes that volume again.
+"""
+
+import copy
+import json
+import logging
+import os
+import pickle
+import re
+import time
+import uuid
+import zlib
+
+import numpy as np
+from sscAnnotat3D import pyramid, utils
+from sscAnnotat3D.modules.sparse_annotation import SparseAnnotationVolume, plane_index
+from sscAnnotat3D.repository import data_repo, module_repo
+
+FORMAT_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+STATE_FILE = "state.pkl"
+ANNOTATION_FILE = "annotation.bin"
+IMAGES_DIR = "images"
+
+# versions are only comparable inside the process that created them
+_session = uuid.uuid4().hex
+
+# slices per compressed slab of the annotation volume
+_annotation_slab = 16
+
+# attributes of the AnnotationModule saved with the snapshot, the volume is saved apart
+_annotation_attrs = (
+    "order_markers",
+    "current_label",
+    "added_labels",
+    "radius",
+    "annotation_slice_dict",
+    "current_axis",
+    "xyslice",
+    "xzslice",
+    "yzslice",
+)
+
+_valid_key = re.compile(r"^[\w.-]+$")
+
+
+def _read_manifest(path: str):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+
+    os.replace(tmp_path, path)
+
+
+def _is_unchanged(previous: dict, entry_key: str, version, path: str):
+    if previous is None or previous.get("session") != _session:
+        return False
+
+    entry = previous.get("entries", {}).get(entry_key, None)
+
+    return entry is not None and entry["version"] == version and os.path.isfile(os.path.join(path, entry["file"]))
+
+
+def _save_annotation(path: str, annotation_image: np.ndarray):
+    """
+    Write the annotation volume as zlib compressed slabs, returns the (offset, length) of each slab.
+    """
+    slabs = []
+    tmp_path = os.path.join(path, "{}.{}.tmp".format(ANNOTATION_FILE, uuid.uuid4().hex[:8]))
+
+    with open(tmp_path, "wb") as f:
+        for z in range(0, annotation_image.shape[0], _annotation_slab):
+            slab = np.ascontiguousarray(annotation_image[z : z + _annotation_slab], dtype=np.int16)
+            payload = zlib.compress(slab, 1)
+            slabs.append([f.tell(), len(payload)])
+            f.write(payload)
+
+    os.replace(tmp_path, os.path.join(path, ANNOTATION_FILE))
+
+    return slabs
+
+
+def _load_annotation(path: str, entry: dict):
+    shape = tuple(entry["shape"])
+    annotation_image = np.empty(shape, dtype=np.int16)
+
+    with open(os.path.join(path, entry["file"]), "rb") as f:
+        for i, (offset, length) in enumerate(entry["slabs"]):
+            f.seek(offset)
+            z = i * _annotation_slab
+            slab = np.frombuffer(zlib.decompress(f.read(length)), dtype=np.int16)
+            annotation_image[z : z + _annotation_slab] = slab.reshape((-1, *shape[1:]))
+
+    return annotation_image
+
+
+def _restore_annotation_image(annot_module, annotation_image: np.ndarray):
+    """
+    Copy the annotated planes to the (sparse) annotation volume of the module, voxels annotated out of these planes
+    (e.g. by 3D operations) make the volume dense.
+    """
+    if not isinstance(annot_module.annotation_image, SparseAnnotationVolume):
+        annot_module.set_annotation_image(annotation_image)
+        return
+
+    for axis, slice_nums in annot_module.annotation_slice_dict.items():
+        for slice_num in slice_nums:
+            annot_module.annotation_image[plane_index(axis, slice_num)] = annotation_image[plane_index(axis, slice_num)]
+            annotation_image[plane_index(axis, slice_num)] = -1
+
+    remaining = annotation_image >= 0
+    if remaining.any():
+        annot_module.annotation_image[remaining] = annotation_image[remaining]
+
+    annot_module.mark_bulk_change()
+    annot_module.touch()
+
+
+def _copy_annotation(annot_module):
+    """
+    Copy the version, the sparse annotation volume and the state of the annotation module, so a snapshot saved in the
+    background is consistent with itself. A dense annotation volume is not copied, see the notes at the top of this
+    script.
+    """
+    # the version is read first, so the next snapshot writes the volume again if an edit is running. The annotated
+    # slices are read last, so they hold every plane of the copy
+    version = annot_module.version
+
+    annotation_image = annot_module.annotation_image
+    if isinstance(annotation_image, SparseAnnotationVolume) and not annotation_image.is_dense:
+        annotation_image = annotation_image.copy()
+
+    module_state = copy.deepcopy({attr: getattr(annot_module, attr) for attr in _annotation_attrs})
+
+    return version, annotation_image, module_state
+
+
+def save(path: str):
+    """
+    Function that saves the session to a snapshot directory
+
+    Notes:
+        Volumes whose version didn't change since the last snapshot written to the same directory by this session are
+        not written again.
+
+    Args:
+        path (str): snapshot directory, created if needed
+
+    Returns:
+        (dict): the manifest, with the list of entries written in "written"
+
+    """
+    os.makedirs(os.path.join(path, IMAGES_DIR), exist_ok=True)
+    previous = _read_manifest(path)
+
+    manifest = {"format": FORMAT_VERSION, "session": _session, "created": time.time(), "entries": {}}
+    written = []
+    state = {"data_repo": data_repo.get_session_state(), "annotation_module": None, "values": {}}
+
+    for key in data_repo.get_images_keys():
+        # the annotation volume is saved with the annotation module below
+        if key == "annotation":
+            continue
+
+        # the version is read first, a volume replaced meanwhile is written again by the next snapshot
+        version = data_repo.get_image_version(key)
+        data = data_repo.get_image(key, lazy=True)
+
+        if data is None:
+            continue
+
+        if not hasattr(data, "shape") or data.ndim == 0 or not _valid_key.match(key):
+            state["values"][key] = data
+            continue
+
+        entry_key = "images/" + key
+        entry = {
+            "file": os.path.join(IMAGES_DIR, key + ".npy"),
+            "version": version,
+            "shape": list(data.shape),
+            "dtype": np.dtype(data.dtype).str,
+        }
+
+        if not _is_unchanged(previous, entry_key, version, path):
+            status = utils.save_volume(os.path.join(path, entry["file"]), entry["dtype"], data)
+            if status["error_msg"] != "":
+                raise IOError("Unable to save {} in the snapshot: {}".format(key, status["error_msg"]))
+            written.append(entry_key)
+
+        manifest["entries"][entry_key] = entry
+
+    annot_module = module_repo.get_module("annotation")
+
+    if annot_module is not None:
+        version, annotation_image, module_state = _copy_annotation(annot_module)
+
+        entry = {
+            "file": ANNOTATION_FILE,
+            "version": version,
+            "shape": list(annotation_image.shape),
+            "dtype": np.dtype(np.int16).str,
+        }
+
+        if _is_unchanged(previous, "annotation", version, path):
+            entry["slabs"] = previous["entries"]["annotation"]["slabs"]
+        else:
+            entry["slabs"] = _save_annotation(path, annotation_image)
+            written.append("annotation")
+
+        manifest["entries"]["annotation"] = entry
+        state["annotation_module"] = module_state
+
+    _write_atomic(os.path.join(path, STATE_FILE), pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+    manifest["state"] = STATE_FILE
+
+    # volumes deleted since the last snapshot
+    for entry_key, entry in (previous or {}).get("entries", {}).items():
+        if entry_key not in manifest["entries"] and os.path.isfile(os.path.join(path, entry["file"])):
+            os.remove(os.path.join(path, entry["file"]))
+
+    _write_atomic(os.path.join(path, MANIFEST_FILE), json.dumps(manifest, indent=2).encode("utf-8"))
+
+    manifest["written"] = written
+    return manifest
+
+
+def restore(path: str):
+    """
+    Function that restores a session from a snapshot directory
+
+    Notes:
+        The volumes of the current session that are not in the snapshot are deleted. The volumes are memory-mapped in
+        copy-on-write mode, edits never reach the snapshot files. The manifest is rewritten with the versions of this
+        session, so the next snapshot to the same directory only writes the volumes changed after the restore.
+
+    Args:
+        path (str): snapshot directory
+
+    Returns:
+        (dict): the manifest
+
+    """
+    manifest = _read_manifest(path)
+
+    if manifest is None:
+        raise FileNotFoundError("No snapshot found in {}".format(path))
+
+    if manifest.get("format", None) != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot format {}".format(manifest.get("format", None)))
+
+    with open(os.path.join(path, manifest["state"]), "rb") as f:
+        state = pickle.load(f)
+
+    # volumes of the current session that are not in the snapshot would be mixed with the restored ones
+    restored_keys = set(state["values"].keys())
+    for entry_key in manifest["entries"]:
+        if entry_key.startswith("images/"):
+            restored_keys.add(entry_key[len("images/") :])
+    if "annotation" in manifest["entries"]:
+        # replaced by the restored annotation module
+        restored_keys.add("annotation")
+    elif module_repo.get_module("annotation") is not None:
+        module_repo.delete_module("annotation")
+
+    for key in list(data_repo.get_images_keys()):
+        if key not in restored_keys:
+            data_repo.delete_image(key)
+
+    data_repo.set_session_state(state["data_repo"])
+
+    for key, value in state["values"].items():
+        data_repo.set_image(key, value)
+
+    for entry_key, entry in manifest["entries"].items():
+        if not entry_key.startswith("images/"):
+            continue
+
+        key = entry_key[len("images/") :]
+        data_repo.set_image(key, np.load(os.path.join(path, entry["file"]), mmap_mode="c"))
+        entry["version"] = data_repo.get_image_version(key)
+
+    if "annotation" in manifest["entries"]:
+        # imported here, the annotation module imports data_repo
+        from sscAnnotat3D.modules import annotation_module
+
+        entry = manifest["entries"]["annotation"]
+        annot_module = annotation_module.AnnotationModule(tuple(entry["shape"]))
+
+        for attr, value in (state["annotation_module"] or {}).items():
+            setattr(annot_module, attr, value)
+
+        _restore_annotation_image(annot_module, _load_annotation(path, entry))
+
+        module_repo.set_module("annotation", module=annot_module)
+        entry["version"] = annot_module.version
+
+    manifest["session"] = _session
+    _write_atomic(os.path.join(path, MANIFEST_FILE), json.dumps(manifest, indent=2).encode("utf-8"))
+
+    if data_repo.get_image("image", lazy=True) is not None:
+        pyramid.build_async("image")
+
+    logging.info("Session restored from {}".format(path))
+
+    return manifest
@@ -0,0 +1,125 @@
+"""
+This script contains the brush stroke rasterizer used by the annotation module.
+
+A stroke is the polyline of the cursor positions sent by the frontend. Consecutive positions are joined by a line
+with one pixel steps, so fast strokes (far apart positions) are drawn without gaps, and the brush disk is drawn on
+every pixel of the line. Each row of the disk is a span of columns, filled by a compiled kernel, so the cost depends
+only on the length of the line and the brush diameter, not on the size of the slice. The stroke is drawn on its
+bounding box, so the annotation module only copies and writes that window of the slice.
+"""
+
+import numpy as np
+from sscAnnotat3D import cython
+
+
+def disk(radius: int) -> np.ndarray:
+    """
+    Function that builds the brush footprint, the same disk of skimage.draw.disk((radius, radius), radius)
+
+    Args:
+        radius (int): brush radius
+
+    Returns:
+        (np.ndarray): bool array of shape (2 * radius + 1, 2 * radius + 1)
+
+    """
+    yy, xx = np.mgrid[-radius : radius + 1, -radius : radius + 1]
+    return yy**2 + xx**2 < radius**2
+
+
+def polyline(points: np.ndarray) -> np.ndarray:
+    """
+    Function that rasterizes the line between consecutive points, with one pixel steps
+
+    Args:
+        points (np.ndarray): (N, 2) int array of (row, col)
+
+    Returns:
+        (np.ndarray): (M, 2) int array of (row, col), starting at points[0] and ending at points[-1]
+
+    """
+    if len(points) < 2:
+        return points
+
+    delta = np.diff(points, axis=0)
+    steps = np.maximum(np.abs(delta).max(axis=1), 1)
+
+    segment = np.repeat(np.arange(len(delta)), steps)
+    # step of each pixel inside its segment
+    k = np.arange(segment.size) - np.repeat(np.cumsum(steps) - steps, steps)
+    line = points[segment] + np.rint(delta[segment] * (k / steps[segment])[:, None]).astype(points.dtype)
+
+    return np.concatenate((line, points[-1:]))
+
+
+def rasterize_window(points, radius: int, shape: tuple):
+    """
+    Function that draws a brush stroke on the bounding box of the stroke only
+
+    Notes:
+        Line pixels out of the image are not stamped, as the cursor positions out of the image were ignored before.
+
+    Args:
+        points (array_like): (N, 2) cursor positions as (row, col), floored to the pixel
+        radius (int): brush radius
+        shape (tuple): shape of the slice
+
+    Returns:
+        (tuple): bool mask of the stroke in the window, and the window (row slice, col slice) of the slice it covers.
+            The window is empty if nothing is drawn
+
+    """
+    points = np.floor(np.asarray(points, dtype=np.float64).reshape(-1, 2)).astype(np.int64)
+
+    centers = polyline(points)
+    inside = (centers >= 0).all(axis=1) & (centers[:, 0] < shape[0]) & (centers[:, 1] < shape[1])
+    centers = centers[inside]
+
+    footprint = disk(radius)
+    # rows of the disk with at least one pixel, and the half width of each one
+    span_rows = np.flatnonzero(footprint.any(axis=1))
+    half_widths = footprint[span_rows].sum(axis=1) // 2
+    span_rows = span_rows - radius
+
+    if centers.size == 0 or span_rows.size == 0:
+        return np.zeros((0, 0), dtype=np.bool_), (slice(0, 0), slice(0, 0))
+
+    # the line repeats the points joining two segments
+    centers = centers[np.concatenate(([True], (centers[1:] != centers[:-1]).any(axis=1)))]
+
+    reach = int(max(span_rows.max(), -span_rows.min(), half_widths.max()))
+    y0, x0 = np.maximum(centers.min(axis=0) - reach, 0)
+    y1, x1 = np.minimum(centers.max(axis=0) + reach + 1, shape)
+    window = (slice(int(y0), int(y1)), slice(int(x0), int(x1)))
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.bool_)
+
+    cython.cython_draw_spans(
+        mask.view(np.uint8),
+        np.ascontiguousarray(centers - (y0, x0), dtype=np.int32),
+        np.ascontiguousarray(span_rows, dtype=np.int32),
+        np.ascontiguousarray(half_widths, dtype=np.int32),
+    )
+
+    return mask, window
+
+
+def rasterize(points, radius: int, shape: tuple) -> np.ndarray:
+    """
+    Function that draws a brush stroke, see rasterize_window
+
+    Args:
+        points (array_like): (N, 2) cursor positions as (row, col), floored to the pixel
+        radius (int): brush radius
+        shape (tuple): shape of the slice
+
+    Returns:
+        (np.ndarray): bool mask of the stroke with the given shape
+
+    """
+    window_mask, window = rasterize_window(points, radius, shape)
+
+    mask = np.zeros(shape, dtype=np.bool_)
+    mask[window] = window_mask
+
+    return mask
@@ -1,5 +1,6 @@
 import ctypes
 import io
+import math
 import os
 
 import numpy
@@ -7,9 +8,13 @@ from sklearn.preprocessing import LabelEncoder
 
 import os
 import re
+import uuid
+
 import numpy as np
 import tifffile
 
+from sscAnnotat3D import progressbar
+
 # Had to comment this, on singularity this 'steals' the GPU form the SPIN/HARPIA module makeing it malfunction
 # However the same effect does not happen on old singularity recipe and on new docker recipe (weird, don't you agree?)
 # try:
@@ -25,13 +30,15 @@ FILE_EXTENSION_IMAGE_FILTER = "Images (*.tif *.tiff *.TIFF *TIF *.b *.raw);; TIF
 __axis_num = {"xy": 0, "xz": 1, "yz": 2}
 
 
-def get_3d_slice_range_from(axis: str, slice_num: int, slice_num_to: int = None):
+def get_3d_slice_range_from(axis: str, slice_num: int, slice_num_to: int = None, roi: tuple = None):
     """
     Given an axis and a slice, returns the range to acess the 2d image from a 3d volume.
     Args:
         axis (str): The axis to be considered ('XY' | 'XZ' | 'YZ').
         slice_num: The slice to be extracted from the given axis.
         slice_num_to: If defined, determine the from (slice_num, slice_num_to) to be extracted
+        roi: If defined, (x0, y0, x1, y1) window of the 2d slice to be extracted, where x is the slice column and
+            y the slice row (e.g. for 'XZ', y is z and x is x)
     Return:
         The range to extract that slice number from that axis.
         Example:
@@ -44,10 +51,40 @@ def get_3d_slice_range_from(axis: str, slice_num: int, slice_num_to: int = None)
         val = slice(slice_num, slice_num_to, None)
 
     s = [slice(None, None, None), slice(None, None, None), slice(None, None, None)]
-    s[__axis_num[axis.lower()]] = val
+    axis_num = __axis_num[axis.lower()]
+    s[axis_num] = val
+
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        rows_axis, cols_axis = [i for i in range(3) if i != axis_num]
+        s[rows_axis] = slice(y0, y1, None)
+        s[cols_axis] = slice(x0, x1, None)
+
     return s
 
 
+def parse_roi(roi):
+    """
+    Given the roi sent by the frontend, returns it as a tuple.
+    Args:
+        roi: None, a list [x0, y0, x1, y1] or a dict {"x0": ..., "y0": ..., "x1": ..., "y1": ...}
+    Return:
+        None or the tuple (x0, y0, x1, y1) of ints.
+    """
+    if roi is None:
+        return None
+
+    if isinstance(roi, dict):
+        roi = [roi["x0"], roi["y0"], roi["x1"], roi["y1"]]
+
+    x0, y0, x1, y1 = [int(v) for v in roi]
+
+    if x0 < 0 or y0 < 0 or x1 <= x0 or y1 <= y0:
+        raise ValueError("Invalid roi {}".format(roi))
+
+    return x0, y0, x1, y1
+
+
 def get_axis_num(axis: str):
     """
     Given an axis, returns the numeric equivalent of such.
@@ -276,6 +313,75 @@ def headless_mode():
     return bool(os.environ.get("ANNOTAT3D_HEADLESS", 0))
 
 
+def lazy_loading_mode():
+    """
+    Whether volumes should be memory-mapped instead of read into RAM when no explicit choice is made.
+    Controlled by the ANNOTAT3D_LAZY_LOADING environment variable.
+    """
+    return os.environ.get("ANNOTAT3D_LAZY_LOADING", "0").lower() in ("1", "true", "yes", "on")
+
+
+def io_workers():
+    """
+    Number of threads used to decode and encode tiff pages.
+    Controlled by the ANNOTAT3D_IO_WORKERS environment variable, all cores by default.
+    """
+    return int(os.environ.get("ANNOTAT3D_IO_WORKERS", 0)) or os.cpu_count() or 1
+
+
+def save_slab_bytes():
+    """
+    Approximate size of the slabs written at once when saving a volume.
+    Controlled by the ANNOTAT3D_SAVE_SLAB_BYTES environment variable, 64MB by default.
+    """
+    return int(os.environ.get("ANNOTAT3D_SAVE_SLAB_BYTES", 64 * 1024**2))
+
+
+def execute_pipeline_depth():
+    """
+    Number of blocks whose features are extracted ahead of the classification when a segmentation is executed in
+    blocks, 0 extracts and classifies each block in turn.
+    Controlled by the ANNOTAT3D_EXECUTE_PIPELINE_DEPTH environment variable, 1 by default.
+    """
+    return max(0, int(os.environ.get("ANNOTAT3D_EXECUTE_PIPELINE_DEPTH", 1)))
+
+
+def debug_feature_stats():
+    """
+    Whether the min, max, mean and std of the features are logged on each extraction, scaling and training, a full
+    pass over the features each.
+    Controlled by the ANNOTAT3D_DEBUG_FEATURE_STATS environment variable.
+    """
+    return os.environ.get("ANNOTAT3D_DEBUG_FEATURE_STATS", "0").lower() in ("1", "true", "yes", "on")
+
+
+def tiff_compression():
+    """
+    Compression used when saving tiff files, e.g. "zlib" or "zstd".
+    Controlled by the ANNOTAT3D_TIFF_COMPRESSION environment variable, uncompressed by default.
+    """
+    compression = os.environ.get("ANNOTAT3D_TIFF_COMPRESSION", "").lower()
+    return None if compression in ("", "none") else compression
+
+
+def tiff_tile():
+    """
+    Shape (length, width) of the tiles used when saving tiff files, e.g. "256" or "256,512", multiples of 16.
+    Controlled by the ANNOTAT3D_TIFF_TILE environment variable, pages are written in strips (untiled) by default.
+    """
+    tile = os.environ.get("ANNOTAT3D_TIFF_TILE", "").lower()
+    if tile in ("", "none", "0"):
+        return None
+
+    tile = tuple(int(t) for t in tile.split(","))
+    tile = tile * 2 if len(tile) == 1 else tile
+
+    if len(tile) != 2 or any(t <= 0 or t % 16 != 0 for t in tile):
+        raise ValueError("Invalid ANNOTAT3D_TIFF_TILE {}, the tile length and width must be multiples of 16".format(tile))
+
+    return tile
+
+
 def normalize_labels(labels):
     label_enc = LabelEncoder()
     return label_enc.fit_transform(labels.ravel()).reshape(labels.shape)
@@ -337,15 +443,23 @@ def _parse_raw_info_from_filename(filename: str):
     return None, None
 
 
-def read_volume(path, backend="numpy", shape=None, dtype=None):
+def read_volume(path, backend="numpy", shape=None, dtype=None, lazy=False):
     """
     Read a volume from raw, tiff/tif, or npy files.
 
+    Notes:
+        With lazy=True, raw and npy files are memory-mapped in copy-on-write mode, so only the pages
+        touched by slicing are read from disk and in-place edits never reach the file. Uncompressed
+        contiguous tiff files are memory-mapped the same way, other tiff files are decoded into a
+        temporary memory-mapped file.
+        Tiff pages are decoded in parallel by io_workers() threads.
+
     Args:
         path (str): path to file
         backend (str): only "numpy" supported for now
         shape (tuple): (z, y, x) for raw data
         dtype (str or np.dtype): dtype for raw data
+        lazy (bool): memory-map raw/npy files instead of reading them into RAM
 
     Returns:
         (np.ndarray, dict):
@@ -357,10 +471,10 @@ def read_volume(path, backend="numpy", shape=None, dtype=None):
 
     try:
         if ext in [".tif", ".tiff"]:
-            image = tifffile.imread(path)
+            image = _read_tiff(path, lazy)
 
         elif ext == ".npy":
-            image = np.load(path)
+            image = np.load(path, mmap_mode="c" if lazy else None)
 
         elif ext in [".raw", ".b"]:
             # try filename parsing if shape/dtype not passed
@@ -370,7 +484,10 @@ def read_volume(path, backend="numpy", shape=None, dtype=None):
                     shape, dtype = parsed_shape, parsed_dtype
             if shape is None or dtype is None:
                 raise ValueError("Raw file requires shape=(z,y,x) and dtype (unless encoded in filename)")
-            image = np.fromfile(path, dtype=np.dtype(dtype)).reshape(shape)
+            if lazy:
+                image = np.memmap(path, dtype=np.dtype(dtype), mode="c", shape=tuple(shape))
+            else:
+                image = np.fromfile(path, dtype=np.dtype(dtype)).reshape(shape)
 
         else:
             raise ValueError(f"Unsupported extension: {ext}")
@@ -382,14 +499,110 @@ def read_volume(path, backend="numpy", shape=None, dtype=None):
     return image, info
 
 
+def _read_tiff(path, lazy=False):
+    if lazy:
+        try:
+            return tifffile.memmap(path, mode="c")
+        except ValueError:
+            # compressed or non contiguous pages can't be mapped, decode them into a temporary memory-mapped file
+            return tifffile.imread(path, out="memmap", maxworkers=io_workers())
+
+    return tifffile.imread(path, maxworkers=io_workers())
+
+
+def _iter_slabs(image, dtype):
+    """
+    Slabs of consecutive pages of the image converted to dtype, the conversion copies a single slab and only happens
+    when the dtype changes.
+    """
+    if image.ndim == 0:
+        yield np.asarray(image).astype(dtype, copy=False)
+        return
+
+    page_bytes = max(1, int(np.prod(image.shape[1:])) * dtype.itemsize)
+    step = max(1, save_slab_bytes() // page_bytes)
+    bar = progressbar.get("main")
+
+    if bar is not None:
+        bar.set_max(math.ceil(image.shape[0] / step))
+
+    for start in range(0, image.shape[0], step):
+        yield np.ascontiguousarray(image[start : start + step], dtype=dtype)
+
+        if bar is not None:
+            bar.inc()
+
+    if bar is not None:
+        bar.reset()
+
+
+def _write_raw(path, dtype, image):
+    with open(path, "wb") as f:
+        for slab in _iter_slabs(image, dtype):
+            slab.tofile(f)
+
+
+def _write_npy(path, dtype, image):
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": image.shape}
+
+    with open(path, "wb") as f:
+        try:
+            np.lib.format.write_array_header_1_0(f, header)
+        except ValueError:
+            # header too long for the 1.0 format (a lot of dimensions)
+            f.seek(0)
+            f.truncate()
+            np.lib.format.write_array_header_2_0(f, header)
+
+        for slab in _iter_slabs(image, dtype):
+            slab.tofile(f)
+
+
+def _iter_tiles(pages, tile):
+    # tifffile pads the incomplete tiles on the borders
+    for page in pages:
+        for row in range(0, page.shape[0], tile[0]):
+            for col in range(0, page.shape[1], tile[1]):
+                yield page[row : row + tile[0], col : col + tile[1]]
+
+
+def _write_tiff(path, dtype, image):
+    compression = tiff_compression()
+    bigtiff = image.size * dtype.itemsize >= 2**32 - 2**25
+    # only the grayscale pages are tiled, see tiff_tile()
+    tile = tiff_tile() if image.ndim in (2, 3) else None
+
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+        if image.ndim < 3:
+            tif.write(
+                np.asarray(image).astype(dtype, copy=False), compression=compression, tile=tile, maxworkers=io_workers()
+            )
+        else:
+            pages = (page for slab in _iter_slabs(image, dtype) for page in slab)
+            if tile is not None:
+                pages = _iter_tiles(pages, tile)
+            tif.write(
+                pages, shape=image.shape, dtype=dtype, compression=compression, tile=tile, maxworkers=io_workers()
+            )
+
+
+_volume_writers = {".tif": _write_tiff, ".tiff": _write_tiff, ".npy": _write_npy, ".raw": _write_raw, ".b": _write_raw}
+
+
 def save_volume(path, dtype, image):
     """
     Save a volume to raw, tiff/tif, or npy.
 
+    Notes:
+        The volume is written slab by slab (see save_slab_bytes()), each slab is converted to dtype only if needed, so
+        saving never holds a converted copy of the whole volume. The file is written to a temporary file in the same
+        directory and renamed at the end, so a failed save never leaves a truncated file behind. The progress is
+        reported on the "main" progress bar.
+
     Args:
         path (str): output path
         dtype (str): data type name (e.g., "float32")
-        image (np.ndarray): array to save
+        image (np.ndarray): array to save, it can also be a memory-mapped or on-disk (ChunkedVolume) volume
 
     Returns:
         dict with file_name, extension, error_msg
@@ -398,18 +611,22 @@ def save_volume(path, dtype, image):
     info = {"file_name": os.path.basename(path), "extension": ext, "error_msg": ""}
 
     try:
-        if ext in [".tif", ".tiff"]:
-            tifffile.imwrite(path, image.astype(dtype))
-
-        elif ext == ".npy":
-            np.save(path, image.astype(dtype))
-
-        elif ext in [".raw", ".b"]:
-            image.astype(dtype).tofile(path)
-
-        else:
+        if ext not in _volume_writers:
             raise ValueError(f"Unsupported extension for saving: {ext}")
 
+        # same directory, so the rename is atomic
+        tmp_path = os.path.join(
+            os.path.dirname(os.path.abspath(path)), ".{}.{}.tmp{}".format(info["file_name"], uuid.uuid4().hex[:8], ext)
+        )
+
+        try:
+            _volume_writers[ext](tmp_path, np.dtype(dtype), image)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
     except Exception as e:
         info["error_msg"] = str(e)
 
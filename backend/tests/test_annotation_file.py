@@ -0,0 +1,85 @@
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip("harpia")
+
+from sscAnnotat3D import annotation_file
+from sscAnnotat3D.modules.annotation_module import AnnotationModule
+
+SHAPE = (8, 20, 24)
+LABEL_NAMES = [{"labelName": "Background", "id": 0, "color": [], "alpha": 1}]
+
+
+def _annotated_module(rng):
+    annot_module = AnnotationModule(SHAPE)
+    annotation = annot_module.annotation_image
+
+    for axis, slice_num in ((0, 2), (0, 5), (1, 7), (2, 11)):
+        index = [slice(None)] * 3
+        index[axis] = slice_num
+        plane = annotation[tuple(index)]
+        mask = rng.random(plane.shape) < 0.2
+        plane[mask] = rng.integers(0, 4, mask.sum())
+        annotation[tuple(index)] = plane
+        annot_module.annotation_slice_dict[axis].add(slice_num)
+
+    return annot_module
+
+
+def test_round_trip(tmp_path):
+    annot_module = _annotated_module(np.random.default_rng(0))
+    path = str(tmp_path / "annotation.a3d")
+
+    annotation_file.save(
+        path, annot_module.annotation_image, annot_module.get_annotation_slice_dict(), LABEL_NAMES
+    )
+    loaded = AnnotationModule(SHAPE)
+
+    assert annotation_file.is_annotation_file(path)
+    assert annotation_file.load(path, loaded) == LABEL_NAMES
+    assert loaded.get_annotation_slice_dict() == annot_module.get_annotation_slice_dict()
+    np.testing.assert_array_equal(np.asarray(loaded.annotation_image), np.asarray(annot_module.annotation_image))
+
+
+def test_shape_mismatch(tmp_path):
+    annot_module = _annotated_module(np.random.default_rng(1))
+    path = str(tmp_path / "annotation.a3d")
+    annotation_file.save(path, annot_module.annotation_image, annot_module.get_annotation_slice_dict(), [])
+
+    with pytest.raises(ValueError):
+        annotation_file.load(path, AnnotationModule((4, 4, 4)))
+
+
+def test_legacy_coordinates(tmp_path):
+    annot_module = _annotated_module(np.random.default_rng(2))
+    coords, labels = annot_module.get_annotation_coords()
+    path = str(tmp_path / "annotation.pkl")
+
+    with open(path, "wb") as f:
+        pickle.dump([LABEL_NAMES, coords, labels, annot_module.get_annotation_slice_dict()], f)
+
+    loaded = AnnotationModule(SHAPE)
+
+    assert annotation_file.load(path, loaded) == LABEL_NAMES
+    np.testing.assert_array_equal(np.asarray(loaded.annotation_image), np.asarray(annot_module.annotation_image))
+
+
+def test_legacy_dict(tmp_path):
+    rng = np.random.default_rng(3)
+    coords = {(int(z), int(y), int(x)) for z, y, x in zip(rng.integers(0, 8, 50), rng.integers(0, 20, 50), [4] * 50)}
+    annot_data = {coord: (int(rng.integers(0, 3)), 1) for coord in coords}
+    path = str(tmp_path / "annotation.pkl")
+
+    with open(path, "wb") as f:
+        pickle.dump(annot_data, f)
+
+    loaded = AnnotationModule(SHAPE)
+    label_names = annotation_file.load(path, loaded)
+
+    assert {label["id"] for label in label_names} == {label for label, _ in annot_data.values()}
+    annotation = np.asarray(loaded.annotation_image)
+    for coord, (label, _) in annot_data.items():
+        assert annotation[coord] == label
+    assert (annotation >= 0).sum() == len(annot_data)
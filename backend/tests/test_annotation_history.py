@@ -0,0 +1,93 @@
+import numpy as np
+from sscAnnotat3D.modules.annotation_history import AnnotationHistory
+from sscAnnotat3D.modules.sparse_annotation import SparseAnnotationVolume, plane_index
+
+SHAPE = (6, 32, 32)
+
+
+def _edit(rng, history, volume):
+    axis = int(rng.integers(0, 3))
+    slice_num = int(rng.integers(0, SHAPE[axis]))
+    index = plane_index(axis, slice_num)
+
+    before = volume[index].copy()
+    after = before.copy()
+    row, col = rng.integers(0, after.shape[0] - 4), rng.integers(0, after.shape[1] - 4)
+    after[row : row + 4, col : col + 4] = rng.integers(0, 4)
+
+    volume[index] = after
+    history.record([(index, before, after)])
+
+
+def test_undo_redo_restore_every_state():
+    rng = np.random.default_rng(0)
+    volume = SparseAnnotationVolume(SHAPE)
+    history = AnnotationHistory()
+    states = [volume.to_dense()]
+
+    for _ in range(20):
+        _edit(rng, history, volume)
+        states.append(volume.to_dense())
+
+    for state in reversed(states[:-1]):
+        assert history.undo(volume) is not None
+        np.testing.assert_array_equal(volume.to_dense(), state)
+    assert history.undo(volume) is None
+
+    for state in states[1:]:
+        assert history.redo(volume) is not None
+        np.testing.assert_array_equal(volume.to_dense(), state)
+    assert history.redo(volume) is None
+
+
+def test_windowed_changes():
+    volume = np.full(SHAPE, -1, dtype=np.int16)
+    history = AnnotationHistory()
+
+    before = volume[2, 10:14, 5:9].copy()
+    after = np.full_like(before, 3)
+    volume[2, 10:14, 5:9] = after
+    entry = history.record([(plane_index(0, 2), before, after, (10, 5))])
+
+    assert entry.patches[0].bbox == (10, 14, 5, 9)
+    history.undo(volume)
+    assert (volume == -1).all()
+    history.redo(volume)
+    assert (volume[2, 10:14, 5:9] == 3).all()
+
+
+def test_budget_drops_the_oldest_edits():
+    rng = np.random.default_rng(1)
+    volume = np.full(SHAPE, -1, dtype=np.int16)
+    history = AnnotationHistory(max_bytes=300)
+
+    for _ in range(50):
+        _edit(rng, history, volume)
+
+    stats = history.stats()
+    assert 0 < stats["undo"] < 50
+    assert stats["bytes"] <= 300 or stats["undo"] == 1
+
+    # the edits kept are still undone and redone in order
+    final = volume.copy()
+    undone = 0
+    while history.undo(volume) is not None:
+        undone += 1
+    assert undone == stats["undo"]
+    while history.redo(volume) is not None:
+        pass
+    np.testing.assert_array_equal(volume, final)
+
+
+def test_record_discards_the_redo_stack():
+    rng = np.random.default_rng(2)
+    volume = np.full(SHAPE, -1, dtype=np.int16)
+    history = AnnotationHistory()
+
+    _edit(rng, history, volume)
+    _edit(rng, history, volume)
+    history.undo(volume)
+    _edit(rng, history, volume)
+
+    assert history.redo(volume) is None
+    assert history.stats()["undo"] == 2
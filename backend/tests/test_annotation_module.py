@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("harpia")
+
+from sscAnnotat3D.modules.annotation_module import _greedy_slice_cover
+
+
+def test_greedy_slice_cover():
+    rng = np.random.default_rng(4)
+    shape = (10, 12, 14)
+
+    for _ in range(20):
+        coords = np.stack([rng.integers(0, s, 40) for s in shape], axis=1)
+        cover = _greedy_slice_cover(coords, shape)
+
+        on_cover = np.zeros(len(coords), dtype=bool)
+        for axis, slice_nums in cover.items():
+            on_cover |= np.isin(coords[:, axis], list(slice_nums))
+        assert on_cover.all()
+
+    # points on a single plane are covered by it
+    coords = np.stack([rng.integers(0, 10, 30), np.full(30, 5), rng.integers(0, 14, 30)], axis=1)
+    assert _greedy_slice_cover(coords, shape) == {0: set(), 1: {5}, 2: set()}
+
+    assert _greedy_slice_cover(np.zeros((0, 3), dtype=np.int64), shape) == {0: set(), 1: set(), 2: set()}
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("harpia")
+
+from sscAnnotat3D import aux_functions as functions
+from sscAnnotat3D.modules.pixel_segmentation_module import PixelSegmentationModule
+from sscAnnotat3D.modules.superpixel_segmentation_module import SuperpixelSegmentationModule
+
+SHAPE = (24, 20, 18)
+SIGMAS = (1, 2)
+
+
+def _image():
+    rng = np.random.default_rng(0)
+    return (rng.random(SHAPE) * 1000).astype(np.int32)
+
+
+@pytest.mark.parametrize("block_size", [1, 5, 24])
+def test_pixel_blocks_match_the_whole_image(block_size):
+    module = PixelSegmentationModule(_image())
+    module._feature_extraction_params["sigmas"] = SIGMAS
+    image = module._image
+
+    whole = functions.pixel_feature_extraction(image, **module._feature_extraction_params)
+    blocks = list(module._feature_blocks(image, block_size))
+
+    assert [(z, z1) for z, z1, _, _ in blocks] == [
+        (z, min(SHAPE[0], z + block_size)) for z in range(0, SHAPE[0], block_size)
+    ]
+    for z, z1, features_block, _ in blocks:
+        assert features_block.flags["C_CONTIGUOUS"]
+        np.testing.assert_allclose(features_block, whole[:, z:z1], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("slab_size", [3, 8, 24])
+def test_superpixel_slabs_match_the_whole_image(slab_size):
+    # superpixels of 2 x 4 x 6 voxels, numbered from 1
+    z, y, x = np.indices(SHAPE)
+    superpixels = (z // 2) * 30 + (y // 4) * 3 + x // 6 + 1
+    module = SuperpixelSegmentationModule(_image(), superpixels.astype(np.int32))
+    module._feature_extraction_params["sigmas"] = SIGMAS
+    features_args, sigmas, _ = module._get_feature_args()
+
+    whole = functions.superpixel_feature_extraction(
+        module.image, module._superpixels, features_args, sigmas, module._min_superpixel_label
+    )
+
+    seen = []
+    for slab_superpixels, features_slab, _, _ in module._slab_features(slab_size, features_args, sigmas):
+        np.testing.assert_allclose(
+            features_slab[1:], whole[slab_superpixels - module._min_superpixel_label], rtol=1e-5, atol=1e-5
+        )
+        seen.append(slab_superpixels)
+
+    np.testing.assert_array_equal(np.sort(np.concatenate(seen)), np.unique(superpixels))
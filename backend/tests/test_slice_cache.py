@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("h5py")
+
+from sscAnnotat3D.repository.slice_cache import SliceCache
+
+
+def test_lru_eviction_under_the_byte_budget():
+    cache = SliceCache(max_bytes=10)
+    cache.put(("image", 1, "XY", 0), b"aaaa")
+    cache.put(("image", 1, "XY", 1), b"bbbb")
+
+    # the first entry is the most recently used one
+    assert cache.get(("image", 1, "XY", 0)) == b"aaaa"
+    cache.put(("image", 1, "XY", 2), b"cccc")
+
+    assert cache.contains(("image", 1, "XY", 0))
+    assert not cache.contains(("image", 1, "XY", 1))
+    assert cache.contains(("image", 1, "XY", 2))
+    assert cache.stats()["bytes"] == 8
+
+
+def test_replacing_an_entry_updates_the_bytes():
+    cache = SliceCache(max_bytes=10)
+    cache.put(("image", 1, "XY", 0), b"aaaa")
+    cache.put(("image", 1, "XY", 0), b"aa")
+
+    assert cache.get(("image", 1, "XY", 0)) == b"aa"
+    assert cache.stats()["bytes"] == 2
+
+
+def test_payloads_over_the_budget_are_not_kept():
+    cache = SliceCache(max_bytes=4)
+    cache.put(("image", 1, "XY", 0), b"aaaaa")
+
+    assert not cache.contains(("image", 1, "XY", 0))
+    assert cache.stats()["bytes"] == 0
+
+
+def test_invalidate_drops_the_entries_of_an_image():
+    cache = SliceCache(max_bytes=100)
+    cache.put(("image", 1, "XY", 0), b"aaaa")
+    cache.put(("annotation", 3, "XY", 0), b"bbbb")
+
+    cache.invalidate("image")
+
+    assert cache.get(("image", 1, "XY", 0)) is None
+    assert cache.get(("annotation", 3, "XY", 0)) == b"bbbb"
+    stats = cache.stats()
+    assert stats["bytes"] == 4
+    assert (stats["hits"], stats["misses"]) == (1, 1)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("sklearn")
+
+from sscAnnotat3D import slice_encoding
+
+
+def _apply_delta(annotation_slice, delta):
+    values = np.repeat(delta["rle"]["values"], delta["rle"]["counts"])
+    x0, y0, x1, y1 = delta["bbox"]
+    annotation_slice[y0:y1, x0:x1] = values.reshape(y1 - y0, x1 - x0)
+
+
+def test_delta_round_trip():
+    rng = np.random.default_rng(0)
+
+    for _ in range(20):
+        before = rng.integers(-1, 3, (24, 30)).astype(np.int16)
+        after = before.copy()
+        row, col = rng.integers(0, 20), rng.integers(0, 26)
+        after[row : row + rng.integers(1, 5), col : col + rng.integers(1, 5)] = rng.integers(-1, 5)
+        after[rng.integers(0, 24), rng.integers(0, 30)] = 7
+
+        delta = slice_encoding.encode_delta(before, after, version=3)
+        patched = before.copy()
+        _apply_delta(patched, delta)
+
+        assert delta["version"] == 3
+        np.testing.assert_array_equal(patched, after)
+
+
+def test_delta_bbox_is_the_changed_window():
+    before = np.full((10, 12), -1, dtype=np.int16)
+    after = before.copy()
+    after[2, 3] = 1
+    after[5, 8] = 2
+
+    delta = slice_encoding.encode_delta(before, after)
+
+    assert delta["bbox"] == [3, 2, 9, 6]
+    assert sum(delta["rle"]["counts"]) == 4 * 6
+
+
+def test_empty_delta():
+    before = np.zeros((4, 4), dtype=np.int16)
+    delta = slice_encoding.encode_delta(before, before.copy(), version=1)
+
+    assert delta == {"bbox": None, "rle": {"values": [], "counts": []}, "version": 1}
+
+
+def test_patch_matches_delta():
+    rng = np.random.default_rng(1)
+    window = rng.integers(-1, 2, (3, 5)).astype(np.int16)
+
+    delta = slice_encoding.encode_patch((4, 7, 2, 7), window, version=2)
+
+    assert delta["bbox"] == [2, 4, 7, 7]
+    np.testing.assert_array_equal(np.repeat(delta["rle"]["values"], delta["rle"]["counts"]), window.ravel())
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+from sscAnnotat3D.modules.sparse_annotation import SparseAnnotationVolume, plane_index
+
+SHAPE = (12, 16, 20)
+
+
+def _random_plane_writes(rng, volume, dense, num_writes):
+    for _ in range(num_writes):
+        axis = int(rng.integers(0, 3))
+        slice_num = int(rng.integers(0, SHAPE[axis]))
+        index = plane_index(axis, slice_num)
+        plane = dense[index].copy()
+        mask = rng.random(plane.shape) < 0.3
+        plane[mask] = rng.integers(-1, 4, mask.sum())
+
+        volume[index] = plane
+        dense[index] = plane
+
+
+def test_planes_match_dense_along_intersections():
+    rng = np.random.default_rng(0)
+    volume = SparseAnnotationVolume(SHAPE)
+    dense = np.full(SHAPE, -1, dtype=np.int16)
+
+    _random_plane_writes(rng, volume, dense, 60)
+
+    assert not volume.is_dense
+    # every stored plane holds the writes of the planes crossing it
+    for axis, slice_num in volume.planes():
+        np.testing.assert_array_equal(volume[plane_index(axis, slice_num)], dense[plane_index(axis, slice_num)])
+
+    # planes not stored are composed from the lines of the stored ones
+    for axis in range(3):
+        for slice_num in range(SHAPE[axis]):
+            np.testing.assert_array_equal(volume[plane_index(axis, slice_num)], dense[plane_index(axis, slice_num)])
+
+    np.testing.assert_array_equal(volume.to_dense(), dense)
+
+
+def test_windowed_plane_write():
+    volume = SparseAnnotationVolume(SHAPE)
+    dense = np.full(SHAPE, -1, dtype=np.int16)
+
+    volume[:, 3, 2:7] = 2
+    dense[:, 3, 2:7] = 2
+    volume[5, 1:4] = 1
+    dense[5, 1:4] = 1
+
+    np.testing.assert_array_equal(volume[:, 3, :], dense[:, 3, :])
+    np.testing.assert_array_equal(volume[5], dense[5])
+    np.testing.assert_array_equal(volume[5, 2:6, 1:9], dense[5, 2:6, 1:9])
+
+
+def test_coordinates_on_stored_planes_keep_the_volume_sparse():
+    rng = np.random.default_rng(1)
+    volume = SparseAnnotationVolume(SHAPE)
+    dense = np.full(SHAPE, -1, dtype=np.int16)
+    volume.add_plane(0, 4)
+    volume.add_plane(2, 7)
+
+    z = np.concatenate((np.full(30, 4), rng.integers(0, SHAPE[0], 30)))
+    y = rng.integers(0, SHAPE[1], 60)
+    x = np.concatenate((rng.integers(0, SHAPE[2], 30), np.full(30, 7)))
+    labels = rng.integers(0, 5, 60).astype(np.int16)
+
+    volume[(z, y, x)] = labels
+    dense[(z, y, x)] = labels
+
+    assert not volume.is_dense
+    np.testing.assert_array_equal(volume[(z, y, x)], dense[(z, y, x)])
+    np.testing.assert_array_equal(volume.to_dense(), dense)
+
+
+def test_writes_outside_the_planes_make_the_volume_dense():
+    volume = SparseAnnotationVolume(SHAPE)
+    volume[2] = 1
+
+    volume[(np.array([5]), np.array([5]), np.array([5]))] = 3
+    assert volume.is_dense
+
+    expected = np.full(SHAPE, -1, dtype=np.int16)
+    expected[2] = 1
+    expected[5, 5, 5] = 3
+    np.testing.assert_array_equal(np.asarray(volume), expected)
+
+
+def test_reads_are_copies():
+    volume = SparseAnnotationVolume(SHAPE)
+    volume[3] = 1
+
+    plane = volume[3]
+    plane[...] = 2
+    assert (volume[3] == 1).all()
+
+    volume.densify()
+    plane = volume[3]
+    plane[...] = 2
+    assert (volume[3] == 1).all()
+
+
+def test_crop_and_copy_are_independent():
+    volume = SparseAnnotationVolume(SHAPE)
+    volume[:, :, 4] = 2
+
+    crop = volume[2:6, :, 3:8]
+    copy = volume.copy()
+    assert isinstance(crop, SparseAnnotationVolume)
+    assert crop.shape == (4, SHAPE[1], 5)
+    np.testing.assert_array_equal(crop.to_dense(), volume.to_dense()[2:6, :, 3:8])
+
+    volume[:, :, 4] = 3
+    assert (crop[:, :, 1] == 2).all()
+    assert (copy[:, :, 4] == 2).all()
+
+
+def test_in_place_ufunc_writes_the_volume():
+    volume = SparseAnnotationVolume(SHAPE)
+    volume[1] = 0
+
+    result = np.add(volume, 1, out=volume)
+
+    assert result is volume
+    assert volume.is_dense
+    assert (volume[1] == 1).all()
+    assert (volume[0] == 0).all()
+
+
+def test_unknown_attributes_raise():
+    volume = SparseAnnotationVolume(SHAPE)
+
+    assert volume.max() == -1
+    with pytest.raises(AttributeError):
+        volume.resize
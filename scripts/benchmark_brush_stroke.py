@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Compare the brush stroke rasterizer (see sscAnnotat3D.stroke) with the previous per-point disk stamping loop.
+
+The per-point loop leaves gaps when the cursor moves faster than the brush diameter between two positions, the
+rasterizer joins the positions, so "px" (pixels drawn) is larger for the rasterizer on sparse strokes.
+
+The rasterizer uses the sscAnnotat3D.cython extensions, build them first (python setup.py build_ext --inplace, from
+backend).
+
+Usage:
+    python scripts/benchmark_brush_stroke.py --size 2048 --lengths 10 100 1000 --radii 1 5 20
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from sscAnnotat3D import stroke  # noqa: E402
+
+
+def per_point_loop(points: np.ndarray, radius: int, shape: tuple) -> np.ndarray:
+    """
+    The previous draw_marker_curve loop, a disk stamped at each cursor position.
+
+    """
+    size = 2 * radius + 1
+    disk_mask = stroke.disk(radius)
+    assert disk_mask.shape == (size, size)
+
+    mask = np.zeros(shape, dtype=np.bool_)
+
+    for coord in points:
+        if 0 <= coord[0] < shape[0] and 0 <= coord[1] < shape[1]:
+            y, x = list(map(int, np.floor(coord)))
+            y_start = max(0, y - radius)
+            x_start = max(0, x - radius)
+            y_end = min(shape[0], y + radius + 1)
+            x_end = min(shape[1], x + radius + 1)
+
+            mask[y_start:y_end, x_start:x_end] += disk_mask[
+                radius - (y - y_start) : radius + (y_end - y), radius - (x - x_start) : radius + (x_end - x)
+            ]
+
+    return mask
+
+
+def make_stroke(length: int, size: int, step: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Random walk of the cursor, with steps of about `step` pixels.
+
+    """
+    angles = np.cumsum(rng.normal(0, 0.3, length))
+    moves = step * np.stack((np.sin(angles), np.cos(angles)), axis=1)
+    return np.clip(size / 2 + np.cumsum(moves, axis=0), 0, size - 1)
+
+
+def measure(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="slice edge size")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per measure")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000], help="cursor positions per stroke")
+    parser.add_argument("--radii", type=int, nargs="+", default=[1, 5, 20], help="brush radii")
+    parser.add_argument("--step", type=float, default=4.0, help="pixels between cursor positions")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.size, args.size)
+
+    print("{:>7} {:>6} {:>12} {:>12} {:>8} {:>10} {:>10}".format(
+        "length", "radius", "loop ms", "stroke ms", "speedup", "loop px", "stroke px"
+    ))
+
+    for length in args.lengths:
+        points = make_stroke(length, args.size, args.step, rng)
+
+        for radius in args.radii:
+            loop_time = measure(lambda: per_point_loop(points, radius, shape), args.repeat)
+            stroke_time = measure(lambda: stroke.rasterize(points, radius, shape), args.repeat)
+
+            loop_mask = per_point_loop(points, radius, shape)
+            stroke_mask = stroke.rasterize(points, radius, shape)
+            # every pixel of the previous loop is drawn by the rasterizer
+            assert not (loop_mask & ~stroke_mask).any()
+
+            print("{:>7} {:>6} {:>12.3f} {:>12.3f} {:>8.1f} {:>10} {:>10}".format(
+                length,
+                radius,
+                loop_time * 1e3,
+                stroke_time * 1e3,
+                loop_time / stroke_time,
+                int(loop_mask.sum()),
+                int(stroke_mask.sum()),
+            ))
+
+
+if __name__ == "__main__":
+    main()
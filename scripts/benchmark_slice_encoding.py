@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compare the latency and size of the slice wire formats (see sscAnnotat3D.slice_encoding).
+
+Usage:
+    python scripts/benchmark_slice_encoding.py --size 4096 --repeat 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from sscAnnotat3D import slice_encoding  # noqa: E402
+
+
+def make_slice(dtype: str, size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Build a synthetic slice with smooth structures plus noise, closer to a tomography slice than pure noise.
+    Annotation slices (int16) are mostly -1 with a few labeled blobs.
+
+    """
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    smooth = 0.5 + 0.25 * np.sin(12 * xx) * np.cos(9 * yy)
+
+    if dtype == "int16":
+        annotation = np.full((size, size), -1, dtype=np.int16)
+        annotation[smooth > 0.7] = 1
+        annotation[smooth < 0.3] = 2
+        return annotation
+
+    img = smooth + 0.05 * rng.standard_normal((size, size), dtype=np.float32)
+
+    if dtype == "float32":
+        return img.astype(np.float32)
+
+    info = np.iinfo(dtype)
+    return np.clip(img * info.max, 0, info.max).astype(dtype)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4096, help="slice edge size")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per measure")
+    parser.add_argument("--dtypes", nargs="+", default=["uint8", "uint16", "float32", "int16"])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    encodings = slice_encoding.available_encodings()
+
+    print("available encodings: {}".format(", ".join(encodings)))
+    print("{:>8} {:>6} {:>12} {:>12} {:>8}".format("dtype", "codec", "ms", "MB", "ratio"))
+
+    for dtype in args.dtypes:
+        img_slice = make_slice(dtype, args.size, rng)
+
+        for encoding in encodings:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                encoded = slice_encoding.encode(img_slice, encoding)
+                timings.append(time.perf_counter() - start)
+
+            print(
+                "{:>8} {:>6} {:>12.2f} {:>12.2f} {:>8.2f}".format(
+                    dtype,
+                    encoding,
+                    1000 * np.median(timings),
+                    len(encoded) / 1024**2,
+                    img_slice.nbytes / len(encoded),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()